@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import json
+import time
+import argparse
+
+from intrinsic_calibration import find_chessboard_corners
+from synthetic_chessboard import SyntheticChessboard
+
+
+RESOLUTIONS = {
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160)
+}
+
+
+class DetectionBenchmark:
+    def __init__(self, resolution='1080p', pattern_size=(7, 5), board_frames=20, empty_frames=5, seed=0):
+        self.pattern_size = pattern_size
+        self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+        # frames with and without a chessboard, in the chessboard videos most frames have none
+        synthetic = SyntheticChessboard(RESOLUTIONS[resolution], pattern_size, seed=seed)
+        self.board_frames = [synthetic.render() for _ in range(board_frames)]  # gray frame, true corners
+        self.empty_frames = [synthetic.render_empty() for _ in range(empty_frames)]
+
+        self.results = {}
+
+
+    def corner_error(self, corners, true_corners):
+        # the detected corners may start at either end of the symmetric board
+        errors = np.linalg.norm(corners.reshape(-1, 2) - true_corners.reshape(-1, 2), axis=1)
+        errors_reversed = np.linalg.norm(corners.reshape(-1, 2)[::-1] - true_corners.reshape(-1, 2), axis=1)
+
+        return errors if errors.mean() < errors_reversed.mean() else errors_reversed
+
+
+    def run_mode(self, name, detection_scale, fast_check):
+        errors = []
+
+        start = time.perf_counter()
+        for gray_frame, true_corners in self.board_frames:
+            corners = find_chessboard_corners(gray_frame, self.pattern_size, self.criteria, detection_scale, fast_check)
+            if corners is not None:
+                errors.append(self.corner_error(corners, true_corners))
+        board_duration = time.perf_counter() - start
+
+        false_positives = 0
+        start = time.perf_counter()
+        for gray_frame in self.empty_frames:
+            corners = find_chessboard_corners(gray_frame, self.pattern_size, self.criteria, detection_scale, fast_check)
+            if corners is not None:
+                false_positives += 1
+        empty_duration = time.perf_counter() - start
+
+        detected = len(errors)
+        errors = np.concatenate(errors) if errors else np.array([np.nan])
+
+        self.results[name] = {
+            'detection_scale': detection_scale,
+            'fast_check': fast_check,
+            'detection_rate': detected / max(1, len(self.board_frames)),
+            'false_positives': false_positives,
+            'mean_corner_error_px': float(np.mean(errors)),
+            'max_corner_error_px': float(np.max(errors)),
+            'ms_per_board_frame': 1000 * board_duration / max(1, len(self.board_frames)),
+            'ms_per_empty_frame': 1000 * empty_duration / max(1, len(self.empty_frames))
+        }
+        self.print_result(name)
+
+
+    def print_result(self, name):
+        result = self.results[name]
+        print(f'{name:<30}{result["detection_rate"]:>10.0%}{result["false_positives"]:>12}'
+              f'{result["mean_corner_error_px"]:>10.3f}{result["max_corner_error_px"]:>10.3f}'
+              f'{result["ms_per_board_frame"]:>12.1f}{result["ms_per_empty_frame"]:>12.1f}')
+
+
+    def run(self, scales=(0.5, 0.25), full_resolution=True):
+        # the full resolution search is very slow on frames without a board, especially at 4K
+        print(f'{"mode":<30}{"detected":>10}{"false pos.":>12}{"mean err":>10}{"max err":>10}{"ms/board":>12}{"ms/empty":>12}')
+        if full_resolution:
+            self.run_mode('full resolution', None, False)
+            self.run_mode('full resolution, fast check', None, True)
+        for scale in scales:
+            self.run_mode(f'scale {scale}', scale, False)
+            self.run_mode(f'scale {scale}, fast check', scale, True)
+
+
+    def save(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.results, outfile, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the coarse-to-fine chessboard detection against the full resolution one on synthetic frames.')
+    parser.add_argument('--resolution', choices=RESOLUTIONS.keys(), default='1080p')
+    parser.add_argument('--board-frames', type=int, default=20, help='number of frames with a chessboard')
+    parser.add_argument('--empty-frames', type=int, default=5, help='number of frames without a chessboard')
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.5, 0.25], help='detection scales to compare')
+    parser.add_argument('--skip-full-resolution', action='store_true', help='only run the coarse-to-fine modes')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    db = DetectionBenchmark(resolution=args.resolution, board_frames=args.board_frames, empty_frames=args.empty_frames)
+    db.run(scales=args.scales, full_resolution=not args.skip_full_resolution)
+    if args.output:
+        db.save(args.output)
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import json
+import os
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+from synthetic_chessboard import SyntheticChessboard
+
+
+RESOLUTIONS = {
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160)
+}
+
+# true camera of the synthetic chessboard videos, for 4K (scaled for other resolutions)
+TRUE_CAMERA_MATRIX = np.array([[3000., 0, 1919.5],
+                               [0, 3000., 1079.5],
+                               [0, 0, 1]])
+TRUE_DISTORTION = np.array([-0.25, 0.08, 0.001, -0.001, 0.])
+
+
+def run_stage(stage, workdir, *args):
+    # run a stage, timing it and tracking its peak memory - the stages run in their own fresh
+    # process, so the peak resident memory belongs to the stage alone
+    os.chdir(workdir)
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        items, result = stage(*args)
+    duration = time.perf_counter() - start
+
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    metrics = {
+        'seconds': duration,
+        'items': items,
+        'items_per_second': items / duration if duration > 0 else None,
+        'peak_traced_mb': peak_traced / 1e6,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    }
+    return metrics, result
+
+
+def stage_get_frames(camera, frame_ids):
+    from intrinsic_calibration import IntrinsicCalibration
+
+    ic = IntrinsicCalibration([camera])
+    frames = sum(1 for _ in ic.get_frames(camera, frame_ids))
+
+    return frames, None
+
+
+def stage_detect_chessboards(camera, frame_ids, detection_workers, detection_scale):
+    from intrinsic_calibration import IntrinsicCalibration
+
+    # decode first, only the detection is timed
+    ic = IntrinsicCalibration([camera], detection_workers=detection_workers, detection_scale=detection_scale)
+    frames = list(ic.get_frames(camera, frame_ids))
+
+    corners = ic.detect_chessboards(camera, iter(frames))
+
+    return len(frames), {'corners': corners, 'image_shape': frames[0][1].shape}
+
+
+def stage_calibrate_camera(camera, corners, image_shape):
+    from intrinsic_calibration import IntrinsicCalibration
+
+    ic = IntrinsicCalibration([camera])
+    object_points, image_points = ic.get_calibration_points(camera, corners)
+    mtx, dist = ic.calibrate_camera(object_points, image_points, image_shape[::-1], image_shape)[:2]
+
+    return len(image_points), {'camera_matrix': mtx, 'distortion': dist}
+
+
+def stage_extrinsic_calibration(repeat):
+    from extrinsic_calibration import ExtrinsicCalibration
+
+    ec = ExtrinsicCalibration()
+    for _ in range(repeat):
+        ec.calculate_extrinsic_matrices()
+
+    return repeat * len(ec.extrinsic_matrices), ec.extrinsic_matrices
+
+
+def stage_homography_calibration(repeat):
+    from homography_calibration import HomographyCalibration
+
+    hc = HomographyCalibration()
+    for _ in range(repeat):
+        hc.calculate_homography_matrices()
+
+    return repeat * len(hc.homographies), None
+
+
+class PipelineBenchmark:
+    def __init__(self, resolutions=('1080p', '4k'), frames=300, frame_step=15, detection_workers=1,
+                 detection_scale=0.25, repeat=100, seed=0):
+        self.resolutions = resolutions
+        self.frames = frames
+        self.frame_step = frame_step  # every frame_step-th frame shows a new board pose and is decoded
+        self.detection_workers = detection_workers
+        self.detection_scale = detection_scale
+        self.repeat = repeat  # the extrinsic and homography solves are fast, repeat them
+        self.seed = seed
+
+        self.camera = '1'
+        self.results = {}
+
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='calibration_benchmark_')
+
+
+    def true_camera(self, resolution):
+        # the 4K camera scaled to the resolution, principal point in the center
+        width, height = RESOLUTIONS[resolution]
+        camera_matrix = TRUE_CAMERA_MATRIX.copy()
+        camera_matrix[:2] *= width / 3840
+        camera_matrix[0, 2] = (width - 1) / 2
+        camera_matrix[1, 2] = (height - 1) / 2
+
+        return camera_matrix, TRUE_DISTORTION
+
+
+    def render_video(self, workdir, resolution):
+        # chessboard video with a new random board pose every frame_step frames, the frames in between
+        # repeat it so only the decoded frames have to be rendered
+        os.makedirs(f'{workdir}/input/chessboard_videos', exist_ok=True)
+        camera_matrix, distortion = self.true_camera(resolution)
+        synthetic = SyntheticChessboard(RESOLUTIONS[resolution], (7, 5), camera_matrix, distortion, seed=self.seed)
+
+        writer = cv2.VideoWriter(f'{workdir}/input/chessboard_videos/out{self.camera}F.mp4',
+                                 cv2.VideoWriter_fourcc(*'mp4v'), 30, RESOLUTIONS[resolution])
+        for i in range(self.frames):
+            if i % self.frame_step == 0:
+                frame = cv2.cvtColor(synthetic.render()[0], cv2.COLOR_GRAY2BGR)
+            writer.write(frame)
+        writer.release()
+
+
+    def write_court_calibration(self, workdir, resolution, cameras=10):
+        # image and world points of court points for cameras placed around the court, together with
+        # the true intrinsics, the inputs of the extrinsic and homography calibration
+        os.makedirs(f'{workdir}/results', exist_ok=True)
+        camera_matrix, distortion = self.true_camera(resolution)
+        width, height = RESOLUTIONS[resolution]
+        rng = np.random.default_rng(self.seed)
+
+        # court points in mm, on the lines and around the court
+        xs, ys = np.meshgrid(np.arange(-3000, 21001, 1500), np.arange(-3000, 12001, 1500))
+        world_points = np.column_stack((xs.ravel(), ys.ravel(), np.zeros(xs.size)))
+
+        intrinsic, distortions, image_points_json, world_points_json = {}, {}, {}, {}
+        for c in range(cameras):
+            # camera on a circle around the court, 6 m high (z points down), looking at the court center
+            angle = 2 * np.pi * c / cameras
+            position = np.array([9000 + 20000 * np.cos(angle), 4500 + 14000 * np.sin(angle), -6000])
+            forward = np.array([9000, 4500, 0]) - position
+            forward /= np.linalg.norm(forward)
+            right = np.cross(forward, [0, 0, -1])
+            right /= np.linalg.norm(right)
+            down = np.cross(forward, right)
+            rotation_matrix = np.array([right, down, forward])
+            tvec = -rotation_matrix @ position
+
+            projected, _ = cv2.projectPoints(world_points, cv2.Rodrigues(rotation_matrix)[0], tvec, camera_matrix, distortion)
+            projected = projected.reshape(-1, 2) + rng.normal(0, 0.5, size=(len(world_points), 2))
+            in_front = (world_points - position) @ forward > 0
+            visible = in_front & (projected[:, 0] > 0) & (projected[:, 0] < width) & (projected[:, 1] > 0) & (projected[:, 1] < height)
+
+            intrinsic[str(c + 1)] = camera_matrix.tolist()
+            distortions[str(c + 1)] = [distortion.tolist()]
+            image_points_json[str(c + 1)] = projected[visible].tolist()
+            world_points_json[str(c + 1)] = world_points[visible].tolist()
+
+        for name, data in [('intrinsic', intrinsic), ('distortions', distortions),
+                           ('extrinsic_image_points', image_points_json), ('extrinsic_world_points', world_points_json)]:
+            with open(f'{workdir}/results/{name}.json', 'w') as outfile:
+                json.dump(data, outfile)
+
+
+    def run_resolution(self, resolution):
+        workdir = f'{self.tmp_dir.name}/{resolution}'
+        print(f'Rendering {self.frames} frames at {resolution}...')
+        self.render_video(workdir, resolution)
+        self.write_court_calibration(workdir, resolution)
+
+        frame_ids = list(range(0, self.frames, self.frame_step))
+        results = {}
+
+        # every stage in a fresh process forked from the small fork server, a spawned process would
+        # inherit the peak memory of this one (rendering the videos) across exec
+        context = multiprocessing.get_context('forkserver')
+        def run(stage, *args):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                metrics, result = executor.submit(run_stage, stage, workdir, *args).result()
+            print(f'{resolution:>6} {stage.__name__:<30}{metrics["seconds"]:>9.3f} s{metrics["items_per_second"]:>12.1f} /s'
+                  f'{metrics["peak_rss_mb"]:>10.0f} MB')
+            return metrics, result
+
+        results['get_frames'], _ = run(stage_get_frames, self.camera, frame_ids)
+        results['get_frames']['video_frames'] = self.frames
+
+        results['detect_chessboards'], detection = run(stage_detect_chessboards, self.camera, frame_ids,
+                                                       self.detection_workers, self.detection_scale)
+        results['detect_chessboards']['detection_workers'] = self.detection_workers
+        results['detect_chessboards']['detection_scale'] = self.detection_scale
+        results['detect_chessboards']['detected'] = sum(c is not None for c in detection['corners'].values())
+
+        results['calibrate_camera'], calibration = run(stage_calibrate_camera, self.camera, detection['corners'],
+                                                       detection['image_shape'])
+        true_camera_matrix, _ = self.true_camera(resolution)
+        results['calibrate_camera']['focal_length_error_px'] = float(abs(calibration['camera_matrix'][0, 0] - true_camera_matrix[0, 0]))
+
+        results['calculate_extrinsic_matrices'], _ = run(stage_extrinsic_calibration, self.repeat)
+        results['calculate_homography_matrices'], _ = run(stage_homography_calibration, self.repeat)
+
+        self.results[resolution] = results
+
+
+    def run(self):
+        for resolution in self.resolutions:
+            self.run_resolution(resolution)
+        self.tmp_dir.cleanup()
+
+
+    def get_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+    def save(self, path):
+        report = {
+            'commit': self.get_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpu_count': os.cpu_count(),
+                'python': platform.python_version(),
+                'opencv': cv2.__version__,
+                'numpy': np.__version__
+            },
+            'settings': {
+                'frames': self.frames,
+                'frame_step': self.frame_step,
+                'detection_workers': self.detection_workers,
+                'detection_scale': self.detection_scale,
+                'repeat': self.repeat
+            },
+            'results': self.results
+        }
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+        print(f'Results saved to {path}')
+
+
+    def compare(self, path):
+        # relative change of the time of every stage against an earlier run
+        with open(path) as f:
+            baseline = json.load(f)
+
+        print(f'Compared to {baseline["commit"]} ({baseline["time"]}):')
+        for resolution, results in self.results.items():
+            for stage, metrics in results.items():
+                previous = baseline['results'].get(resolution, {}).get(stage)
+                if previous:
+                    change = metrics['seconds'] / previous['seconds'] - 1
+                    print(f'{resolution:>6} {stage:<30}{change:>+9.1%}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the calibration stages on synthetic chessboard videos.')
+    parser.add_argument('--resolutions', nargs='+', choices=RESOLUTIONS.keys(), default=['1080p', '4k'])
+    parser.add_argument('--frames', type=int, default=300, help='length of the synthetic videos')
+    parser.add_argument('--frame-step', type=int, default=15, help='decode every n-th frame')
+    parser.add_argument('--detection-workers', type=int, default=1)
+    parser.add_argument('--detection-scale', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=100, help='repetitions of the extrinsic and homography solves')
+    parser.add_argument('--output', default=None, help='JSON file for the results (default: results/benchmarks/<commit>.json)')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    pb = PipelineBenchmark(resolutions=args.resolutions, frames=args.frames, frame_step=args.frame_step,
+                           detection_workers=args.detection_workers, detection_scale=args.detection_scale,
+                           repeat=args.repeat)
+    pb.run()
+    pb.save(args.output or f'results/benchmarks/{(pb.get_commit() or "unknown")[:10]}.json')
+    if args.compare:
+        pb.compare(args.compare)
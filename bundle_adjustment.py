@@ -0,0 +1,413 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import json
+import time
+import argparse
+
+from evaluation import rodrigues, project_points
+from calibration_store import CalibrationStore
+
+
+# camera parameters: pose (rotation vector, translation in meters of the world in the camera) and
+# optionally the intrinsics
+POSE_PARAMETERS = 6
+INTRINSIC_PARAMETERS = ['fx', 'fy', 'cx', 'cy', 'k1', 'k2', 'p1', 'p2', 'k3']
+
+
+def sum_by(index, values, count):
+    # sums of the rows of values (N, ...) with the same index, (count, ...) - much faster than np.add.at
+    flat = values.reshape(len(values), -1)
+    sums = np.stack([np.bincount(index, weights=flat[:, k], minlength=count) for k in range(flat.shape[1])], axis=1)
+    return sums.reshape((count,) + values.shape[1:])
+
+
+class BundleAdjustment:
+    def __init__(self, refine_intrinsics=False, point_sigma=0.01, focal_sigma=0.02, principal_sigma=50,
+                 distortion_sigma=0.05, loss_scale=None, data=None):
+        # point_sigma: meters the court points may move, the intrinsics are held to the intrinsic calibration by
+        # focal_sigma (relative), principal_sigma (pixels) and distortion_sigma - loss_scale: Huber threshold
+        # in pixels (None = least squares) - data: matrices and points in the format of the results files
+        self.refine_intrinsics = refine_intrinsics
+        self.point_sigma = point_sigma
+        self.loss_scale = loss_scale
+        self.camera_parameters = POSE_PARAMETERS + (len(INTRINSIC_PARAMETERS) if refine_intrinsics else 0)
+
+        data = self.load_data() if data is None else data
+        self.intrinsic_matrices = data['intrinsic']
+        self.distortions = data['distortions']
+        self.extrinsic_matrices = data['extrinsic']
+        self.ground_truth_cameras = data.get('ground_truth', {})
+
+        self.cameras = [camera for camera in self.extrinsic_matrices.keys()
+                        if camera in data['image_points'] and camera in self.intrinsic_matrices]
+        self.build_problem(data['image_points'], data['world_points'])
+        self.fixed_intrinsics = np.array([self.intrinsics_vector(camera) for camera in self.cameras])
+
+        self.intrinsic_sigmas = np.array([focal_sigma, focal_sigma, principal_sigma, principal_sigma] + [distortion_sigma] * 5)
+
+        # result
+        self.cameras_refined = None
+        self.points_refined = None
+        self.history = []
+
+
+    def load_data(self):
+        store = CalibrationStore()
+        return {section: store.section(section)
+                for section in ['intrinsic', 'distortions', 'extrinsic', 'image_points', 'world_points', 'ground_truth']}
+
+
+    def build_problem(self, image_points, world_points):
+        # the same court point seen by several cameras is one point of the adjustment
+        points = {}
+        observation_cameras, observation_points, observations = [], [], []
+        for i, camera in enumerate(self.cameras):
+            for world_point, image_point in zip(world_points[camera], image_points[camera]):
+                key = tuple(np.round(world_point, 1))
+                points.setdefault(key, len(points))
+                observation_cameras.append(i)
+                observation_points.append(points[key])
+                observations.append(image_point)
+
+        # court points in meters
+        self.points_prior = np.array(list(points.keys()), dtype=float) / 1000
+        self.observation_cameras = np.array(observation_cameras)
+        self.observation_points = np.array(observation_points)
+        self.observations = np.array(observations, dtype=float)
+
+        print(f'{len(self.cameras)} cameras, {len(self.points_prior)} points, {len(self.observations)} observations')
+
+
+    def initial_parameters(self):
+        cameras = np.zeros((len(self.cameras), self.camera_parameters))
+        for i, camera in enumerate(self.cameras):
+            # extrinsic matrices are the camera poses in the world, the projection needs the inverse
+            camera_f_world = np.linalg.inv(self.extrinsic_matrices[camera])
+            cameras[i, :3] = cv2.Rodrigues(camera_f_world[:3, :3])[0].ravel()
+            cameras[i, 3:6] = camera_f_world[:3, 3]
+
+            if self.refine_intrinsics:
+                cameras[i, 6:] = self.intrinsics_vector(camera)
+
+        return cameras, self.points_prior.copy()
+
+
+    def intrinsics_vector(self, camera):
+        k = self.intrinsic_matrices[camera]
+        distortion = np.zeros(5)
+        distortion[:min(5, self.distortions[camera].size)] = self.distortions[camera].ravel()[:5]
+        return np.concatenate(([k[0, 0], k[1, 1], k[0, 2], k[1, 2]], distortion))
+
+
+    def project(self, cameras, points, camera_index, point_index):
+        # image positions of the observations for the given (possibly perturbed) parameters, the matrices are
+        # built per camera and only then spread over the observations
+        intrinsics = cameras[:, 6:] if self.refine_intrinsics else self.fixed_intrinsics
+
+        camera_matrices = np.zeros((len(cameras), 3, 3))
+        camera_matrices[:, 0, 0], camera_matrices[:, 1, 1] = intrinsics[:, 0], intrinsics[:, 1]
+        camera_matrices[:, 0, 2], camera_matrices[:, 1, 2] = intrinsics[:, 2], intrinsics[:, 3]
+        camera_matrices[:, 2, 2] = 1
+
+        return project_points(points[point_index], rodrigues(cameras[:, :3])[camera_index], cameras[camera_index, 3:6],
+                              camera_matrices[camera_index], intrinsics[camera_index, 4:])
+
+
+    def residuals(self, cameras, points):
+        return self.project(cameras, points, self.observation_cameras, self.observation_points) - self.observations
+
+
+    def weights(self, residuals):
+        # Huber weights of the observations (iteratively reweighted least squares)
+        if self.loss_scale is None:
+            return np.ones(len(residuals))
+
+        norms = np.linalg.norm(residuals, axis=1)
+        return np.minimum(1, self.loss_scale / np.maximum(norms, 1e-12))
+
+
+    def cost(self, cameras, points, initial_intrinsics):
+        residuals = self.residuals(cameras, points)
+        norms = np.linalg.norm(residuals, axis=1)
+        if self.loss_scale is None:
+            cost = np.sum(norms ** 2)
+        else:
+            cost = np.sum(np.where(norms <= self.loss_scale, norms ** 2, 2 * self.loss_scale * norms - self.loss_scale ** 2))
+
+        cost += np.sum(((points - self.points_prior) / self.point_sigma) ** 2)
+        if self.refine_intrinsics:
+            cost += np.sum(((cameras[:, 6:] - initial_intrinsics) / self.prior_scales(initial_intrinsics)) ** 2)
+
+        return 0.5 * cost
+
+
+    def prior_scales(self, initial_intrinsics):
+        # standard deviations of the intrinsics, the focal lengths relative to their value
+        scales = np.tile(self.intrinsic_sigmas, (len(initial_intrinsics), 1))
+        scales[:, :2] *= initial_intrinsics[:, :2]
+        return scales
+
+
+    def jacobians(self, cameras, points):
+        # block Jacobians of the observations by central differences, every parameter is perturbed for all
+        # observations at once: (observations, 2, camera parameters) and (observations, 2, 3)
+        n = len(self.observations)
+        camera_jacobian = np.zeros((n, 2, self.camera_parameters))
+        point_jacobian = np.zeros((n, 2, 3))
+
+        for k in range(self.camera_parameters):
+            step = 1e-6 * (1 + np.abs(cameras[:, k]))
+            plus, minus = cameras.copy(), cameras.copy()
+            plus[:, k] += step
+            minus[:, k] -= step
+            camera_jacobian[:, :, k] = ((self.project(plus, points, self.observation_cameras, self.observation_points)
+                                         - self.project(minus, points, self.observation_cameras, self.observation_points))
+                                        / (2 * step[self.observation_cameras, None]))
+
+        for k in range(3):
+            step = 1e-6 * (1 + np.abs(points[:, k]))
+            plus, minus = points.copy(), points.copy()
+            plus[:, k] += step
+            minus[:, k] -= step
+            point_jacobian[:, :, k] = ((self.project(cameras, plus, self.observation_cameras, self.observation_points)
+                                        - self.project(cameras, minus, self.observation_cameras, self.observation_points))
+                                       / (2 * step[self.observation_points, None]))
+
+        return camera_jacobian, point_jacobian
+
+
+    def normal_equations(self, cameras, points, initial_intrinsics):
+        # blocks of J^T J and J^T r: U per camera, V per point, W per observation (camera x point)
+        residuals = self.residuals(cameras, points)
+        weights = self.weights(residuals)
+        camera_jacobian, point_jacobian = self.jacobians(cameras, points)
+
+        camera_jacobian_weighted = camera_jacobian * weights[:, None, None]
+        point_jacobian_weighted = point_jacobian * weights[:, None, None]
+
+        u = sum_by(self.observation_cameras, np.einsum('nri,nrj->nij', camera_jacobian_weighted, camera_jacobian), len(self.cameras))
+        v = sum_by(self.observation_points, np.einsum('nri,nrj->nij', point_jacobian_weighted, point_jacobian), len(points))
+        w = np.einsum('nri,nrj->nij', camera_jacobian_weighted, point_jacobian)
+
+        gradient_cameras = sum_by(self.observation_cameras, np.einsum('nri,nr->ni', camera_jacobian_weighted, residuals),
+                                  len(self.cameras))
+        gradient_points = sum_by(self.observation_points, np.einsum('nri,nr->ni', point_jacobian_weighted, residuals), len(points))
+
+        # priors of the points and the intrinsics
+        v += np.eye(3) / self.point_sigma ** 2
+        gradient_points += (points - self.points_prior) / self.point_sigma ** 2
+        if self.refine_intrinsics:
+            precision = 1 / self.prior_scales(initial_intrinsics) ** 2
+            u[:, 6:, 6:] += precision[:, :, None] * np.eye(len(INTRINSIC_PARAMETERS))
+            gradient_cameras[:, 6:] += (cameras[:, 6:] - initial_intrinsics) * precision
+
+        return u, v, w, gradient_cameras, gradient_points
+
+
+    def solve_step(self, u, v, w, gradient_cameras, gradient_points, damping):
+        # Schur complement: eliminate the points (independent 3x3 blocks), solve the small reduced camera system
+        # and substitute back - the camera x point blocks of W go into one matrix, so the reduction is a single
+        # matrix product
+        cameras, c, points = len(self.cameras), self.camera_parameters, len(v)
+        u = u + damping * u * np.eye(c) + 1e-12 * np.eye(c)
+        v = v + damping * v * np.eye(3)
+        v_inverse = np.linalg.inv(v)
+
+        w_matrix = sum_by(self.observation_cameras * points + self.observation_points, w, cameras * points)
+        w_matrix = w_matrix.reshape(cameras, points, c, 3).transpose(0, 2, 1, 3).reshape(cameras * c, points, 3)
+
+        # Y = W V^-1, S = U - Y W^T
+        y = np.einsum('apj,pjk->apk', w_matrix, v_inverse).reshape(cameras * c, 3 * points)
+        w_matrix = w_matrix.reshape(cameras * c, 3 * points)
+
+        s = -y @ w_matrix.T
+        for i in range(cameras):
+            s[i * c:(i + 1) * c, i * c:(i + 1) * c] += u[i]
+
+        right_side = -gradient_cameras.ravel() + y @ gradient_points.ravel()
+        camera_step = np.linalg.solve(s, right_side)
+
+        # back substitution: V dp = -g_p - W^T dc
+        point_right_side = -gradient_points - (w_matrix.T @ camera_step).reshape(points, 3)
+        point_step = np.einsum('pij,pj->pi', v_inverse, point_right_side)
+
+        return camera_step.reshape(cameras, c), point_step
+
+
+    def run(self, iterations=50, tolerance=1e-10):
+        # Levenberg-Marquardt
+        start = time.perf_counter()
+        cameras, points = self.initial_parameters()
+        initial_intrinsics = cameras[:, 6:].copy()
+
+        cost = self.cost(cameras, points, initial_intrinsics)
+        self.history = [cost]
+        damping = 1e-3
+
+        for _ in range(iterations):
+            u, v, w, gradient_cameras, gradient_points = self.normal_equations(cameras, points, initial_intrinsics)
+
+            # retry with more damping until the cost drops
+            while damping < 1e10:
+                camera_step, point_step = self.solve_step(u, v, w, gradient_cameras, gradient_points, damping)
+                new_cost = self.cost(cameras + camera_step, points + point_step, initial_intrinsics)
+                if new_cost < cost:
+                    break
+                damping *= 4
+            else:
+                break
+
+            cameras, points = cameras + camera_step, points + point_step
+            improvement = cost - new_cost
+            cost = new_cost
+            self.history.append(cost)
+            damping = max(damping / 3, 1e-10)
+
+            if improvement < tolerance * cost:
+                break
+
+        self.cameras_refined, self.points_refined = cameras, points
+        print(f'Bundle adjustment: {len(self.history) - 1} iterations, cost {self.history[0]:.1f} -> {cost:.1f}, '
+              f'{time.perf_counter() - start:.2f} s')
+
+        return cameras, points
+
+
+    def camera_positions(self, cameras):
+        # camera centers in the world (meters)
+        rotations = rodrigues(cameras[:, :3])
+        return -np.einsum('nji,nj->ni', rotations, cameras[:, 3:6])
+
+
+    def refined_matrices(self):
+        # results in the format of the results files
+        extrinsic, intrinsic, distortions = {}, {}, {}
+        rotations = rodrigues(self.cameras_refined[:, :3])
+        for i, camera in enumerate(self.cameras):
+            world_f_camera = np.eye(4)
+            world_f_camera[:3, :3] = rotations[i].T
+            world_f_camera[:3, 3] = -rotations[i].T @ self.cameras_refined[i, 3:6]
+            extrinsic[camera] = world_f_camera.tolist()
+
+            if self.refine_intrinsics:
+                fx, fy, cx, cy = self.cameras_refined[i, 6:10]
+                intrinsic[camera] = [[fx, 0, cx], [0, fy, cy], [0, 0, 1]]
+                distortions[camera] = [self.cameras_refined[i, 10:].tolist()]
+
+        return extrinsic, intrinsic, distortions
+
+
+    def report(self):
+        # reprojection errors and distances to the ground truth camera positions before and after
+        initial_cameras, initial_points = self.initial_parameters()
+        report = {'cameras': {}}
+
+        for name, cameras, points in [('before', initial_cameras, initial_points),
+                                      ('after', self.cameras_refined, self.points_refined)]:
+            errors = np.linalg.norm(self.residuals(cameras, points), axis=1)
+            positions = self.camera_positions(cameras)
+
+            report[f'reprojection_rms_px_{name}'] = float(np.sqrt(np.mean(errors ** 2)))
+            position_errors = []
+            for i, camera in enumerate(self.cameras):
+                entry = report['cameras'].setdefault(camera, {})
+                entry[f'reprojection_rms_px_{name}'] = float(np.sqrt(np.mean(errors[self.observation_cameras == i] ** 2)))
+                if camera in self.ground_truth_cameras:
+                    entry[f'position_error_m_{name}'] = float(np.linalg.norm(positions[i] - self.ground_truth_cameras[camera]))
+                    position_errors.append(entry[f'position_error_m_{name}'])
+
+            if position_errors:
+                report[f'position_error_m_mean_{name}'] = float(np.mean(position_errors))
+                report[f'position_error_m_median_{name}'] = float(np.median(position_errors))
+
+        report['point_shift_m_max'] = float(np.max(np.linalg.norm(self.points_refined - self.points_prior, axis=1)))
+
+        print(f'{"camera":>8}{"rms before":>12}{"rms after":>11}{"pos. before":>13}{"pos. after":>12}  [px, px, m, m]')
+        for camera, entry in report['cameras'].items():
+            print(f'{camera:>8}{entry["reprojection_rms_px_before"]:>12.2f}{entry["reprojection_rms_px_after"]:>11.2f}'
+                  f'{entry.get("position_error_m_before", np.nan):>13.2f}{entry.get("position_error_m_after", np.nan):>12.2f}')
+        print(f'Reprojection RMS: {report["reprojection_rms_px_before"]:.2f} px -> {report["reprojection_rms_px_after"]:.2f} px')
+        if 'position_error_m_mean_before' in report:
+            print(f'Mean camera position error: {report["position_error_m_mean_before"]:.2f} m -> '
+                  f'{report["position_error_m_mean_after"]:.2f} m')
+
+        return report
+
+
+    def save_matrices(self):
+        extrinsic, intrinsic, distortions = self.refined_matrices()
+        store = CalibrationStore()
+        store.update('extrinsic_bundle_adjusted', extrinsic, replace=True)
+        if self.refine_intrinsics:
+            store.update('intrinsic_bundle_adjusted', intrinsic, replace=True)
+            store.update('distortions_bundle_adjusted', distortions, replace=True)
+        store.save()
+
+
+
+def synthetic_data(cameras=50, points=2000, noise=0.5, pose_noise=0.02, seed=0):
+    # cameras on a ring around the court looking at random court points, the poses disturbed - to measure
+    # how the adjustment scales
+    rng = np.random.default_rng(seed)
+    camera_matrix = np.array([[3000, 0, 1920], [0, 3000, 1080], [0, 0, 1]], dtype=float)
+    world_points = np.column_stack((rng.uniform(-2, 20, points), rng.uniform(-2, 11, points), np.zeros(points))) * 1000
+
+    data = {'intrinsic': {}, 'distortions': {}, 'extrinsic': {}, 'image_points': {}, 'world_points': {}, 'ground_truth': {}}
+    for i in range(cameras):
+        angle = 2 * np.pi * i / cameras
+        position = np.array([9 + 16 * np.cos(angle), 4.5 + 12 * np.sin(angle), -6])
+
+        # look at the court center, the world z axis points down
+        forward = np.array([9, 4.5, 0]) - position
+        forward /= np.linalg.norm(forward)
+        right = np.cross(forward, [0, 0, 1])
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        rotation = np.array([right, down, forward])
+
+        rvec = cv2.Rodrigues(rotation)[0].ravel()
+        tvec = -rotation @ position * 1000
+        projected, _ = cv2.projectPoints(world_points, rvec, tvec, camera_matrix, np.zeros(5))
+        projected = projected.reshape(-1, 2) + rng.normal(0, noise, (points, 2))
+        in_front = (world_points / 1000 - position) @ forward > 0
+        visible = in_front & (projected[:, 0] > 0) & (projected[:, 0] < 3840) & (projected[:, 1] > 0) & (projected[:, 1] < 2160)
+
+        disturbed = cv2.Rodrigues(rvec + rng.normal(0, pose_noise, 3))[0]
+        world_f_camera = np.eye(4)
+        world_f_camera[:3, :3] = disturbed.T
+        world_f_camera[:3, 3] = position + rng.normal(0, 10 * pose_noise, 3)
+
+        camera = str(i + 1)
+        data['intrinsic'][camera] = camera_matrix
+        data['distortions'][camera] = np.zeros((1, 5))
+        data['extrinsic'][camera] = world_f_camera
+        data['image_points'][camera] = projected[visible]
+        data['world_points'][camera] = world_points[visible]
+        data['ground_truth'][camera] = position
+
+    return data
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Joint refinement of all cameras on the shared court points.')
+    parser.add_argument('--intrinsics', action='store_true', help='refine the intrinsics as well')
+    parser.add_argument('--point-sigma', type=float, default=0.01, help='meters the court points may move')
+    parser.add_argument('--loss-scale', type=float, default=None, help='Huber threshold in pixels (default: least squares)')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--output', default='results/bundle_adjustment_report.json', help='JSON file for the report')
+    parser.add_argument('--synthetic', nargs=2, type=int, metavar=('CAMERAS', 'POINTS'), default=None,
+                        help='adjust a synthetic scene instead of the calibration results (nothing is saved)')
+    args = parser.parse_args()
+
+    data = synthetic_data(*args.synthetic) if args.synthetic else None
+    ba = BundleAdjustment(refine_intrinsics=args.intrinsics, point_sigma=args.point_sigma, loss_scale=args.loss_scale, data=data)
+    ba.run(iterations=args.iterations)
+    report = ba.report()
+
+    if not args.synthetic:
+        ba.save_matrices()
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
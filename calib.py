@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import runpy
+import argparse
+import subprocess
+
+
+# command: script run by it, everything else is imported by the scripts only when their command runs
+COMMANDS = {
+    'intrinsic': 'intrinsic_calibration',
+    'extrinsic': 'extrinsic_calibration',
+    'homography': 'homography_calibration',
+    'plot': 'plot_camera_positions',
+    'tool': 'homography_tool',
+    'pipeline': 'pipeline',
+    'bundle': 'bundle_adjustment',
+    'evaluate': 'evaluation',
+    'coverage': 'visibility_index',
+    'frames': 'frame_extraction',
+    'court': 'court_detection',
+    'drift': 'drift_monitor',
+    'triangulate': 'triangulation',
+    'store': 'calibration_store'
+}
+
+
+def run_command(command, arguments):
+    # the script runs as if it was started directly, it parses the remaining arguments itself
+    sys.argv[1:] = arguments
+    runpy.run_module(COMMANDS[command], run_name='__main__', alter_sys=True)
+
+
+def time_import(statement, repeat):
+    # wall time in ms of a fresh interpreter running the statement, the fastest of the repetitions
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True)
+        times.append(1000 * (time.perf_counter() - start))
+
+    return min(times)
+
+
+def slowest_imports(module, count=5):
+    # packages imported by the module itself with the largest cumulative import time in ms, from python -X importtime
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True).stderr
+
+    packages = {}
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1 and '.' not in name.strip():
+            packages[name.strip()] = int(cumulative) / 1000
+
+    return sorted(packages.items(), key=lambda item: -item[1])[:count]
+
+
+def benchmark_imports(repeat=5, detail=False):
+    # startup cost of every command: interpreter start plus importing its script
+    baseline = time_import('pass', repeat)
+    print(f'Interpreter start: {baseline:.0f} ms')
+    print(f'{"command":>12}{"start ms":>10}{"import ms":>11}  matplotlib')
+
+    results = {}
+    for command, module in COMMANDS.items():
+        total = time_import(f'import {module}', repeat)
+        matplotlib = subprocess.run([sys.executable, '-c', f'import sys, {module}; print("matplotlib" in sys.modules)'],
+                                    capture_output=True, text=True, check=True).stdout.strip() == 'True'
+        results[command] = {'start_ms': total, 'import_ms': total - baseline, 'matplotlib': matplotlib}
+        print(f'{command:>12}{total:>10.0f}{total - baseline:>11.0f}  {"yes" if matplotlib else "no"}')
+
+        if detail:
+            print('              ' + ', '.join(f'{name} {ms:.0f} ms' for name, ms in slowest_imports(module)))
+
+    return results
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='calib', description='Calibration of the volleyball court cameras.',
+                                     epilog='Run "calib <command> --help" for the options of a command.')
+    parser.add_argument('command', choices=list(COMMANDS.keys()) + ['imports'],
+                        help='step to run, "imports" measures the start up time of every command')
+    parser.add_argument('arguments', nargs=argparse.REMAINDER, help='options of the command')
+    args = parser.parse_args()
+
+    if args.command == 'imports':
+        imports_parser = argparse.ArgumentParser(prog='calib imports', description='Start up time of every command.')
+        imports_parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per command, the fastest counts')
+        imports_parser.add_argument('--detail', action='store_true', help='list the slowest imported packages of every command')
+        imports_args = imports_parser.parse_args(args.arguments)
+        benchmark_imports(imports_args.repeat, imports_args.detail)
+    else:
+        run_command(args.command, args.arguments)
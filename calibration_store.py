@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+import numpy as np
+import json
+import os
+import fcntl
+import argparse
+from contextlib import contextmanager
+
+
+# sections of the store and the JSON files they are imported from and exported to
+SECTIONS = {
+    'intrinsic': 'results/intrinsic.json',
+    'intrinsic_refined': 'results/intrinsic_refined.json',
+    'distortions': 'results/distortions.json',
+    'extrinsic': 'results/extrinsic.json',
+    'homography': 'results/homography.json',
+    'homography_undistorted': 'results/homography_undistorted.json',
+    'image_points': 'results/extrinsic_image_points.json',
+    'world_points': 'results/extrinsic_world_points.json',
+    'ground_truth': 'results/ground_truth_cameras.json',
+    'extrinsic_bundle_adjusted': 'results/extrinsic_bundle_adjusted.json',
+    'intrinsic_bundle_adjusted': 'results/intrinsic_bundle_adjusted.json',
+    'distortions_bundle_adjusted': 'results/distortions_bundle_adjusted.json'
+}
+
+
+class CalibrationStore:
+    # bump when the layout of the store changes, older stores are rebuilt from the JSON files
+    version = 1
+
+    def __init__(self, path='results/calibration.npz', sections=SECTIONS):
+        # all calibration results in one uncompressed npz file, the arrays of a camera are only read when
+        # they are used - the JSON files stay the exchange format: edited JSON files are imported again,
+        # saved sections are exported to them - only save() writes, so reading the store never changes it
+        self.path = path
+        self.sections = sections
+
+        self.data = None  # open npz file
+        self.cameras = {}  # section: cameras in the store, in order
+        self.mtimes = {}  # section: modification time (ns) of the JSON file when it was last imported or exported
+        self.arrays = {}  # (section, camera): array read or set in this process
+
+        self.stale = False  # the npz file has to be written
+        self.changed = set()  # sections imported, updated or dropped in this process
+        self.exports = set()  # sections to be written to their JSON files
+
+        self.open()
+        self.sync()
+
+
+    def read_file(self):
+        # open npz file, section: cameras and section: JSON mtime in it - only the names are read, not the arrays
+        if not os.path.exists(self.path):
+            return None, {}, {}
+
+        data = np.load(self.path)
+        if 'version' not in data.files or int(data['version']) != self.version:
+            data.close()
+            return None, {}, {}
+
+        cameras, mtimes = {}, {}
+        for key in data.files:
+            kind, _, name = key.partition('/')
+            if kind == 'mtime':
+                mtimes[name] = int(data[key])
+            elif kind == 'array':
+                section, _, camera = name.partition('/')
+                cameras.setdefault(section, []).append(camera)
+
+        return data, cameras, mtimes
+
+
+    def open(self):
+        self.data, self.cameras, self.mtimes = self.read_file()
+
+
+    def get_json_mtime(self, section):
+        path = self.sections[section]
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+    def sync(self):
+        # JSON files written by hand or by other tools since the last import replace their section, the
+        # sections of deleted JSON files are dropped
+        for section in self.sections.keys():
+            mtime = self.get_json_mtime(section)
+            if mtime is not None and mtime != self.mtimes.get(section):
+                self.import_json(section)
+            elif mtime is None and self.mtimes.get(section) is not None:
+                self.drop(section)
+
+
+    def drop(self, section):
+        for camera in self.cameras.pop(section, []):
+            self.arrays.pop((section, camera), None)
+        self.mtimes.pop(section, None)
+
+        self.changed.add(section)
+        self.stale = True
+
+
+    def import_json(self, section, path=None):
+        with open(path or self.sections[section]) as f:
+            matrices = json.load(f)
+
+        self.cameras[section] = list(matrices.keys())
+        for camera, matrix in matrices.items():
+            self.arrays[(section, camera)] = np.array(matrix, dtype=float)
+
+        if path is None:
+            self.mtimes[section] = self.get_json_mtime(section)
+        else:
+            self.exports.add(section)
+        self.changed.add(section)
+        self.stale = True
+
+
+    def export_json(self, section, path=None):
+        path = path or self.sections[section]
+        with open(f'{path}.tmp', 'w') as outfile:
+            json.dump({camera: matrix.tolist() for camera, matrix in self.section(section).items()}, outfile)
+
+        return f'{path}.tmp'
+
+
+    def get(self, section, camera):
+        # array of one camera, read from the file on first use
+        key = (section, camera)
+        if key not in self.arrays:
+            self.arrays[key] = self.data[f'array/{section}/{camera}']
+
+        return self.arrays[key]
+
+
+    def section(self, section, cameras=None):
+        # camera: array of a section, only of the given cameras if cameras is not None
+        return {camera: self.get(section, camera) for camera in self.cameras.get(section, [])
+                if cameras is None or camera in cameras}
+
+
+    def update(self, section, matrices, replace=False):
+        # add or change the cameras of a section (or replace the section), written by save()
+        if replace or section not in self.cameras:
+            self.cameras[section] = []
+
+        for camera, matrix in matrices.items():
+            if camera not in self.cameras[section]:
+                self.cameras[section].append(camera)
+            self.arrays[(section, camera)] = np.array(matrix, dtype=float)
+
+        self.exports.add(section)
+        self.changed.add(section)
+        self.stale = True
+
+
+    @contextmanager
+    def lock(self):
+        # one writer at a time, released by the system even if the process dies
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+    def merge(self):
+        # another process may have saved since this one opened the store: its sections are taken over, only
+        # the sections changed here replace them
+        data, cameras, mtimes = self.read_file()
+        for section in set(self.cameras.keys()) | set(cameras.keys()):
+            if section in self.changed:
+                continue
+
+            for camera in self.cameras.pop(section, []):
+                self.arrays.pop((section, camera), None)
+            if section in cameras:
+                self.cameras[section] = cameras[section]
+                for camera in cameras[section]:
+                    self.arrays[(section, camera)] = data[f'array/{section}/{camera}']
+            self.mtimes.pop(section, None)
+            if section in mtimes:
+                self.mtimes[section] = mtimes[section]
+
+        if data is not None:
+            data.close()
+
+
+    def save(self):
+        # JSON files of the changed sections and the npz file, everything is written to temporary files first
+        # and only then swapped in, so a crash never leaves half written or mismatching files behind
+        with self.lock():
+            self.merge()
+
+            exports = {section: self.export_json(section) for section in self.exports}
+            for section, path in exports.items():
+                os.replace(path, self.sections[section])
+                self.mtimes[section] = self.get_json_mtime(section)
+            self.exports.clear()
+
+            # the new file needs all arrays, read the remaining ones before the old file is replaced
+            arrays = {'version': np.array(self.version)}
+            for section, cameras in self.cameras.items():
+                for camera in cameras:
+                    arrays[f'array/{section}/{camera}'] = self.get(section, camera)
+            for section, mtime in self.mtimes.items():
+                if mtime is not None:
+                    arrays[f'mtime/{section}'] = np.array(mtime, dtype=np.int64)
+
+            with open(f'{self.path}.tmp', 'wb') as outfile:
+                np.savez(outfile, **arrays)
+            if self.data is not None:
+                self.data.close()
+            os.replace(f'{self.path}.tmp', self.path)
+
+        self.data = np.load(self.path)
+        self.changed.clear()
+        self.stale = False
+
+
+    def info(self):
+        for section, cameras in self.cameras.items():
+            print(f'{section:>28}: {", ".join(cameras)}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibration results in one binary file, synchronized with the JSON files.')
+    parser.add_argument('--export', action='store_true', help='write all sections to their JSON files')
+    args = parser.parse_args()
+
+    # opening the store imports all changed JSON files, saving writes them to the npz file
+    store = CalibrationStore()
+    if args.export:
+        store.exports.update(store.cameras.keys())
+        store.changed.update(store.cameras.keys())
+    if store.stale or args.export:
+        store.save()
+    store.info()
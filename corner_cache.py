@@ -0,0 +1,130 @@
+import numpy as np
+import hashlib
+import os
+
+
+class CornerCache:
+    # bump when the layout of the cache files changes
+    version = 1
+
+    def __init__(self, camera, video_path, pattern_size, detection_scale=None, fast_check=False,
+                 cache_dir='results/corner_cache'):
+        self.camera = camera
+        self.video_path = video_path
+        self.path = f'{cache_dir}/out{camera}F.npz'
+
+        # everything the detected corners depend on besides the frame itself
+        self.pattern_size = tuple(pattern_size)
+        self.detection_scale = np.nan if detection_scale is None else float(detection_scale)
+        self.fast_check = bool(fast_check)
+
+        # video
+        self.video_hash = None
+        self.video_stat = None  # size, modification time - to skip rehashing an unchanged video
+        self.frame_count = None
+        self.image_shape = None  # (height, width)
+
+        # entries: frame_id, corners (None if no chessboard was found)
+        self.corners = {}
+
+        self.load()
+
+
+    def get_video_stat(self):
+        stat = os.stat(self.video_path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+    def hash_video(self):
+        # content hash of the video, read in chunks so the video is never fully in memory
+        sha = hashlib.sha1()
+        with open(self.video_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 22), b''):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+
+    def load(self):
+        if not os.path.exists(self.video_path):
+            # without the video only the cache is left, use it as it is
+            if os.path.exists(self.path):
+                self.read(check_video=False)
+            return
+
+        self.video_stat = self.get_video_stat()
+
+        if os.path.exists(self.path):
+            self.read(check_video=True)
+
+        if self.video_hash is None:
+            self.video_hash = self.hash_video()
+
+
+    def read(self, check_video):
+        with np.load(self.path) as cache:
+            if int(cache['version']) != self.version:
+                return
+
+            # a touched video is rehashed, only if its content changed the entries are dropped
+            if not check_video:
+                self.video_stat = cache['video_stat']
+            elif not np.array_equal(cache['video_stat'], self.video_stat):
+                self.video_hash = self.hash_video()
+                if self.video_hash != str(cache['video_hash']):
+                    return
+            self.video_hash = str(cache['video_hash'])
+
+            self.frame_count = int(cache['frame_count'])
+            self.image_shape = tuple(int(x) for x in cache['image_shape'])
+
+            # entries for another board or other detection settings do not apply
+            if (tuple(cache['pattern_size']) != self.pattern_size
+                    or not np.array_equal(cache['detection_scale'], self.detection_scale, equal_nan=True)
+                    or bool(cache['fast_check']) != self.fast_check):
+                return
+
+            for frame_id, found, corners in zip(cache['frame_ids'], cache['found'], cache['corners']):
+                self.corners[int(frame_id)] = corners.reshape(-1, 1, 2) if found else None
+
+
+    def set_video_info(self, frame_count, image_shape):
+        self.frame_count = frame_count
+        self.image_shape = tuple(image_shape)
+
+
+    def missing(self, frame_ids):
+        return [i for i in frame_ids if i not in self.corners]
+
+
+    def add(self, frame_id, corners):
+        self.corners[frame_id] = corners
+
+
+    def save(self):
+        frame_ids = np.array(sorted(self.corners.keys()), dtype=np.int64)
+        found = np.array([self.corners[i] is not None for i in frame_ids], dtype=bool)
+
+        # corners of frames without a chessboard are stored as zeros
+        corners = np.zeros((len(frame_ids), self.pattern_size[0] * self.pattern_size[1], 2), dtype=np.float32)
+        for j, i in enumerate(frame_ids):
+            if found[j]:
+                corners[j] = self.corners[i].reshape(-1, 2)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        # write to a temporary file first, so an interrupted run never leaves a broken cache
+        tmp_path = f'{self.path}.tmp.npz'
+        np.savez_compressed(tmp_path,
+                            version=self.version,
+                            video_hash=self.video_hash,
+                            video_stat=self.video_stat,
+                            frame_count=self.frame_count,
+                            image_shape=np.array(self.image_shape),
+                            pattern_size=np.array(self.pattern_size),
+                            detection_scale=self.detection_scale,
+                            fast_check=self.fast_check,
+                            frame_ids=frame_ids,
+                            found=found,
+                            corners=corners)
+        os.replace(tmp_path, self.path)
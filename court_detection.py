@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from calibration_store import CalibrationStore
+from court_renderer import COURT_LINES
+from frame_extraction import FrameExtraction
+from projection import HomographyProjection
+from undistortion import Undistortion
+
+
+# court lines crossing each other: the lines across the court (x = 0, 6, 9, 12, 18) and the side lines (y = 0, 9)
+CROSS_LINES = [i for i, (start, end) in enumerate(COURT_LINES) if start[0] == end[0]]
+SIDE_LINES = [i for i, (start, end) in enumerate(COURT_LINES) if start[1] == end[1]]
+
+
+def line_through(points):
+    # line (a, b, c) with a x + b y + c = 0 and a^2 + b^2 = 1 fitted robustly through the points (N, 2)
+    vx, vy, x, y = cv2.fitLine(np.asarray(points, dtype=np.float32), cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+    return np.array([vy, -vx, vx * y - vy * x])
+
+
+def intersect(lines_a, lines_b):
+    # intersections (N, 2) of the lines (N, 3) pairwise, NaN for parallel or missing lines
+    points = np.cross(lines_a, lines_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return points[:, :2] / points[:, 2:]
+
+
+
+class CourtDetection:
+    def __init__(self, video_dir='input/videos', frames=20, scale=0.5, gate=80, max_angle=10, min_support=200,
+                 undistort=False, image_scale=(3840, 2160)):
+        # court points found from the white lines of the court: the lines are detected in many frames of the
+        # court video, only segments close to the lines predicted by the current homography are used
+        # (gate: pixels, max_angle: degrees), the intersections of the fitted lines are the court points
+        self.video_dir = video_dir
+        self.frames = frames
+        self.scale = scale  # the lines are searched on frames downscaled by this factor
+        self.gate = gate
+        self.max_angle = max_angle
+        self.min_support = min_support  # length in pixels of the segments a line needs to be fitted
+        self.image_scale = image_scale
+
+        # with undistort, the lines are fitted on undistorted points, where the court lines are straight
+        self.undistortion = Undistortion(image_scale) if undistort else None
+        self.projection = HomographyProjection(image_scale=image_scale, undistortion=self.undistortion)
+        self.extraction = FrameExtraction(video_dir=video_dir, workers=1)
+
+        # court model: intersections of every cross line with every side line, in millimeters like the clicked points
+        self.pairs = [(i, j) for i in CROSS_LINES for j in SIDE_LINES]
+        self.world_points = np.array([[1000 * COURT_LINES[i][0][0], 1000 * COURT_LINES[j][0][1], 0] for i, j in self.pairs])
+
+        # results
+        self.image_points = {}  # camera: (points, 2), NaN where a point was not found
+        self.reports = {}  # camera: frames, points found, spread over the frames, shift from the prior, time
+
+
+    def get_frames(self, camera):
+        # frames spread evenly over the video, players covering a line in one frame have moved in the others
+        cap = cv2.VideoCapture(self.extraction.get_video_path(camera))
+        duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / (cap.get(cv2.CAP_PROP_FPS) or 25)
+        cap.release()
+
+        timestamps = list(np.linspace(0, duration, self.frames + 2)[1:-1])
+        size = (int(self.image_scale[0] * self.scale), int(self.image_scale[1] * self.scale))
+        frames = self.extraction.extract_camera(camera, timestamps, size)
+        return [frames[timestamp] for timestamp in timestamps if frames[timestamp] is not None]
+
+
+    def line_masks(self, frames):
+        # white line pixels of all (downscaled) frames at once (frames, height, width): bright, unsaturated and
+        # brighter than their surroundings (top hat)
+        stack = np.array(frames)
+        blue, green, red = stack[..., 0], stack[..., 1], stack[..., 2]
+        # elementwise over the channels instead of max(axis=3), which is an order of magnitude slower
+        value = np.maximum(np.maximum(blue, green), red)
+        saturation = value - np.minimum(np.minimum(blue, green), red)
+
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15))
+        tophat = np.array([cv2.morphologyEx(v, cv2.MORPH_TOPHAT, kernel) for v in value])
+
+        return ((tophat > 25) & (saturation < 60) & (value > 120)).astype(np.uint8) * 255
+
+
+    def predict_lines(self, camera):
+        # court lines in the image according to the current homography: lines (L, 3), their extent along the
+        # line direction (L, 2) and whether they are seen at all (L,) - in the space the lines are fitted in
+        t = np.linspace(0, 1, 50)
+        samples = np.array([np.outer(1 - t, start) + np.outer(t, end) for start, end in COURT_LINES])
+        image, visible = self.projection.world_to_image(samples.reshape(-1, 2), [camera])
+        image, visible = self.to_line_space(camera, image[0]).reshape(len(COURT_LINES), -1, 2), visible[0].reshape(len(COURT_LINES), -1)
+
+        lines = np.full((len(COURT_LINES), 3), np.nan)
+        extents = np.full((len(COURT_LINES), 2), np.nan)
+        for i in range(len(COURT_LINES)):
+            if visible[i].sum() < 2:
+                continue
+            lines[i] = line_through(image[i][visible[i]])
+            along = image[i][visible[i]] @ np.array([-lines[i, 1], lines[i, 0]])
+            extents[i] = along.min(), along.max()
+
+        return lines, extents, ~np.isnan(lines[:, 0])
+
+
+    def to_line_space(self, camera, points):
+        # full resolution image points to the space the lines are fitted in
+        if self.undistortion is None:
+            return points
+        return self.undistortion.undistort_points(camera, points)
+
+
+    def from_line_space(self, camera, points):
+        if self.undistortion is None:
+            return points
+        return self.undistortion.distort_points(camera, points)
+
+
+    def detect_segments(self, mask, step=10):
+        # line segments of a mask as points sampled every step pixels along them (full resolution) and the
+        # segment every point belongs to
+        segments = cv2.HoughLinesP(mask, 1, np.pi / 360, threshold=40, minLineLength=30, maxLineGap=5)
+        if segments is None:
+            return np.zeros((0, 4)), np.zeros((0, 2)), np.zeros(0, int)
+
+        segments = segments.reshape(-1, 4) / self.scale
+        counts = np.maximum(2, (np.linalg.norm(segments[:, 2:] - segments[:, :2], axis=1) // step).astype(int))
+        index = np.repeat(np.arange(len(segments)), counts)
+        t = (np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)) / np.repeat(counts - 1, counts)
+
+        points = segments[index, :2] + t[:, None] * (segments[index, 2:] - segments[index, :2])
+        return segments, points, index
+
+
+    def assign_segments(self, camera, segments, lines, extents, seen):
+        # predicted court line of every segment, -1 for none: both ends within the gate, about the same
+        # direction and within the extent of the line
+        ends = self.to_line_space(camera, segments.reshape(-1, 2)).reshape(-1, 2, 2)
+        direction = ends[:, 1] - ends[:, 0]
+        direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+
+        homogeneous = np.concatenate((ends, np.ones((len(ends), 2, 1))), axis=2)
+        distances = np.abs(np.einsum('snk,lk->snl', homogeneous, np.nan_to_num(lines))).max(axis=1)
+        angles = np.degrees(np.arccos(np.clip(np.abs(direction @ np.nan_to_num(lines[:, :2]).T), 0, 1)))
+        along = ends.mean(axis=1) @ np.column_stack((-lines[:, 1], lines[:, 0])).T
+
+        candidate = (seen[None] & (distances < self.gate) & (np.abs(90 - angles) < self.max_angle)
+                     & (along > extents[:, 0] - self.gate) & (along < extents[:, 1] + self.gate))
+        assignment = np.where(candidate.any(axis=1), np.argmin(np.where(candidate, distances, np.inf), axis=1), -1)
+
+        return assignment
+
+
+    def detect_frame(self, camera, mask, lines, extents, seen):
+        # court points (points, 2) of one frame, NaN where a line was not found
+        segments, points, index = self.detect_segments(mask)
+        fitted = np.full((len(COURT_LINES), 3), np.nan)
+        if len(segments):
+            assignment = self.assign_segments(camera, segments, lines, extents, seen)
+            lengths = np.linalg.norm(segments[:, 2:] - segments[:, :2], axis=1)
+            line_points = self.to_line_space(camera, points)
+
+            for i in range(len(COURT_LINES)):
+                if lengths[assignment == i].sum() >= self.min_support:
+                    fitted[i] = line_through(line_points[assignment[index] == i])
+
+        cross, side = np.array(self.pairs).T
+        return intersect(fitted[cross], fitted[side])
+
+
+    def detect_camera(self, camera, min_frames=0.5):
+        # court points of a camera as the median over the frames, points found in less than min_frames of
+        # the frames or outside the image are dropped
+        start = time.perf_counter()
+        frames = self.get_frames(camera)
+        if not frames:
+            return np.full((len(self.pairs), 2), np.nan), {'frames': 0}
+
+        lines, extents, seen = self.predict_lines(camera)
+        masks = self.line_masks(frames)
+        detections = np.array([self.detect_frame(camera, mask, lines, extents, seen) for mask in masks])
+
+        found = ~np.isnan(detections[:, :, 0])
+        median = np.full((len(self.pairs), 2), np.nan)
+        spread = np.full(len(self.pairs), np.nan)
+        enough = found.mean(axis=0) >= min_frames
+        if enough.any():
+            median[enough] = np.nanmedian(detections[:, enough], axis=0)
+            spread[enough] = np.nanmedian(np.linalg.norm(detections[:, enough] - median[enough], axis=2), axis=0)
+
+        points = np.full((len(self.pairs), 2), np.nan)
+        if enough.any():
+            points[enough] = self.from_line_space(camera, median[enough])
+        points[~self.projection.in_image(points)] = np.nan
+
+        # how far the points are from where the current homography puts them, large for a moved camera
+        prior, _ = self.projection.world_to_image(self.world_points[:, :2] / 1000, [camera])
+        shift = np.linalg.norm(points - prior[0], axis=1)
+
+        valid = ~np.isnan(points[:, 0])
+        report = {
+            'frames': len(frames),
+            'points': int(valid.sum()),
+            'spread_px': float(np.nanmean(spread[valid])) if valid.any() else None,
+            'shift_px': float(np.nanmean(shift[valid])) if valid.any() else None,
+            'time_ms': 1000 * (time.perf_counter() - start)
+        }
+        return points, report
+
+
+    def detect(self, cameras=None, workers=1):
+        cameras = cameras or self.projection.cameras
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(self.detect_camera, cameras))
+
+        for camera, (points, report) in zip(cameras, results):
+            self.image_points[camera] = points
+            self.reports[camera] = report
+
+
+    def correspondences(self, camera):
+        # image points (N, 2) and world points (N, 3, millimeters) of the court points found for a camera
+        valid = ~np.isnan(self.image_points[camera][:, 0])
+        return self.image_points[camera][valid], self.world_points[valid]
+
+
+    def print_report(self):
+        print(f'{"camera":>8}{"frames":>8}{"points":>8}{"spread px":>11}{"shift px":>10}{"time ms":>9}')
+        for camera, report in self.reports.items():
+            spread = report.get('spread_px') if report.get('spread_px') is not None else np.nan
+            shift = report.get('shift_px') if report.get('shift_px') is not None else np.nan
+            print(f'{camera:>8}{report["frames"]:>8}{report.get("points", 0):>8}{spread:>11.1f}{shift:>10.1f}'
+                  f'{report.get("time_ms", 0):>9.0f}')
+
+
+    def save(self, path):
+        results = {}
+        for camera in self.image_points.keys():
+            image_points, world_points = self.correspondences(camera)
+            results[camera] = {'image_points': image_points.tolist(), 'world_points': world_points.tolist(),
+                               **self.reports[camera]}
+
+        with open(path, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+
+
+    def apply(self, min_points=4):
+        # replace the clicked points of the cameras with enough court points found, the calibrations
+        # (or pipeline.py) then solve these cameras again
+        store = CalibrationStore()
+        image_points, world_points = {}, {}
+        for camera in self.image_points.keys():
+            image, world = self.correspondences(camera)
+            if len(image) >= min_points:
+                image_points[camera], world_points[camera] = image, world
+            else:
+                print(f'Only {len(image)} court points found for camera {camera}, keeping its clicked points.')
+
+        store.update('image_points', image_points)
+        store.update('world_points', world_points)
+        store.save()
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the court points in the court videos from the white court lines.')
+    parser.add_argument('--cameras', nargs='+', default=None, help='cameras to process (default: all with a homography)')
+    parser.add_argument('--frames', type=int, default=20, help='frames per video the lines are searched in')
+    parser.add_argument('--gate', type=float, default=80, help='max distance in pixels of a line from its predicted position')
+    parser.add_argument('--undistort', action='store_true', help='fit the lines on undistorted points (with homography_undistorted.json)')
+    parser.add_argument('--workers', type=int, default=4, help='number of cameras processed at once')
+    parser.add_argument('--output', default='results/court_points.json', help='JSON file for the court points')
+    parser.add_argument('--apply', action='store_true',
+                        help='replace the clicked image and world points with the court points found')
+    args = parser.parse_args()
+
+    cd = CourtDetection(frames=args.frames, gate=args.gate, undistort=args.undistort)
+    cd.detect(args.cameras, args.workers)
+    cd.print_report()
+    cd.save(args.output)
+    if args.apply:
+        cd.apply()
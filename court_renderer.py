@@ -0,0 +1,55 @@
+import numpy as np
+import cv2
+
+
+# volleyball court in meters: lines at x = 0, 6, 9, 12, 18 between y = 0 and 9
+COURT_LINES = [((0, 0), (0, 9)),
+               ((6, 0), (6, 9)),
+               ((9, 0), (9, 9)),
+               ((12, 0), (12, 9)),
+               ((18, 0), (18, 9)),
+               ((0, 0), (18, 0)),
+               ((0, 9), (18, 9))]
+
+
+class CourtRenderer:
+    def __init__(self, size, x_range=(-5, 23), y_range=(-5, 14)):
+        # size: (width, height) of the rendered court in pixels, x_range/y_range: visible area in meters
+        self.size = size
+
+        # fixed meters to pixels transform with the same scale for x and y, centered, origin in the top left
+        # corner like in the plots (y points down)
+        self.scale = min(size[0] / (x_range[1] - x_range[0]), size[1] / (y_range[1] - y_range[0]))
+        self.offset = np.array([size[0] / 2 - self.scale * (x_range[0] + x_range[1]) / 2,
+                                size[1] / 2 - self.scale * (y_range[0] + y_range[1]) / 2])
+
+        self.base = self.render_base()
+
+
+    def world_to_pixel(self, points):
+        # world points (x, y) in meters, shape (2,) or (N, 2), to pixels
+        return np.asarray(points, dtype=float)[..., :2] * self.scale + self.offset
+
+
+    def render_base(self):
+        # white background with blue lines and corner points, rendered once
+        court = np.full((self.size[1], self.size[0], 3), 255, np.uint8)
+
+        for start, end in COURT_LINES:
+            cv2.line(court, tuple(self.world_to_pixel(start).astype(int)), tuple(self.world_to_pixel(end).astype(int)),
+                     (255, 0, 0), 2, cv2.LINE_AA)
+
+        for x in [0, 6, 9, 12, 18]:
+            for y in [0, 9]:
+                cv2.circle(court, tuple(self.world_to_pixel((x, y)).astype(int)), 4, (255, 0, 0), -1, cv2.LINE_AA)
+
+        return court
+
+
+    def render(self, world_points=()):
+        # copy of the court with the world points (meters) marked in red
+        court = self.base.copy()
+        for point in world_points:
+            cv2.circle(court, tuple(self.world_to_pixel(point).astype(int)), 5, (0, 0, 255), -1, cv2.LINE_AA)
+
+        return court
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from calibration_store import CalibrationStore
+from frame_extraction import FrameExtraction, CALIBRATION_TIMES, parse_time
+from image_store import ImageStore
+
+
+class DriftMonitor:
+    def __init__(self, video_dir='input/videos', rate=1.0, scale=0.25, features=400, max_rotation=0.5,
+                 max_translation=0.1, max_reprojection_error=10.0, persistence=2, image_scale=(3840, 2160)):
+        # camera poses over the court videos: every sample (rate per second) is registered against the frame the
+        # court points were clicked on, the court points are moved along and the pose is solved again, warm
+        # started from the previous sample - alerts when the pose moved by more than max_rotation (degrees) or
+        # max_translation (meters) or the points fit worse than on the calibration frame by more than
+        # max_reprojection_error (pixels), in persistence samples in a row
+        self.video_dir = video_dir
+        self.rate = rate
+        self.scale = scale  # frames are registered downscaled by this factor
+        self.features = features
+        self.max_rotation = max_rotation
+        self.max_translation = max_translation
+        self.max_reprojection_error = max_reprojection_error
+        self.persistence = persistence
+        self.image_scale = image_scale
+        self.size = (int(image_scale[0] * scale), int(image_scale[1] * scale))
+
+        self.store = CalibrationStore()
+        self.intrinsic_matrices = self.store.section('intrinsic')
+        self.distortions = self.store.section('distortions')
+        self.extrinsic_matrices = self.store.section('extrinsic')
+        self.image_points = self.store.section('image_points')
+        self.world_points = self.store.section('world_points')
+
+        self.images = ImageStore()
+        self.extraction = FrameExtraction(video_dir=video_dir, workers=1)
+
+        # results per camera
+        self.series = {}  # camera: list of samples (time, pose delta, reprojection error, tracked features)
+        self.alerts = {}  # camera: list of (time, reasons)
+        self.timings = {}  # camera: decode, registration and pose time in ms per sample
+        self.wall_time = 0.0
+
+
+    def get_reference(self, camera, reference_time=None):
+        # grayscale frame the court points were clicked on: the calibration image, else the frame of the video
+        image = self.images.get(camera) if reference_time is None else None
+        if image is None:
+            timestamp = parse_time(reference_time if reference_time is not None else CALIBRATION_TIMES[camera])
+            image = self.extraction.extract_camera(camera, [timestamp])[timestamp]
+        if image is None:
+            return None
+
+        return cv2.cvtColor(cv2.resize(image, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+
+    def read_samples(self, camera, start=0.0, end=None):
+        # (time, downscaled grayscale frame, decode time in ms) every 1 / rate seconds - close samples are reached
+        # by grabbing the frames in between, which skips their conversion, far ones by seeking - decoding takes
+        # most of the time, so a hardware decoder is used where OpenCV finds one
+        cap = cv2.VideoCapture(self.extraction.get_video_path(camera), cv2.CAP_ANY,
+                               [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+        if not cap.isOpened():
+            print(f'Video of camera {camera} not found.')
+            return
+
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25
+        duration = cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps
+        end = duration if end is None else min(end, duration)
+
+        position = None  # index of the next frame the capture returns
+        for timestamp in np.arange(start, end, 1 / self.rate):
+            started = time.perf_counter()
+            target = int(round(timestamp * fps))
+            if position is None or target < position or target - position > 2 * fps:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            else:
+                for _ in range(target - position):
+                    cap.grab()
+
+            ok, frame = cap.read()
+            if not ok:
+                break
+            position = target + 1
+
+            gray = cv2.cvtColor(cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            yield timestamp, gray, 1000 * (time.perf_counter() - started)
+
+        cap.release()
+
+
+    def solve_pose(self, camera, image_points, rvec, tvec):
+        # pose of the camera (world to camera, millimeters) from the court points, starting from the given one
+        _, rvec, tvec = cv2.solvePnP(self.world_points[camera].astype(np.float64), image_points.astype(np.float64),
+                                     self.intrinsic_matrices[camera], self.distortions[camera], rvec.copy(), tvec.copy(),
+                                     useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+        projected, _ = cv2.projectPoints(self.world_points[camera].astype(np.float64), rvec, tvec,
+                                         self.intrinsic_matrices[camera], self.distortions[camera])
+        error = np.sqrt(np.mean(np.sum((projected.reshape(-1, 2) - image_points) ** 2, axis=1)))
+
+        return rvec, tvec, error
+
+
+    def pose_delta(self, reference, rvec, tvec):
+        # rotation in degrees and camera displacement in meters between the reference pose and the given one
+        rotation_reference, _ = cv2.Rodrigues(reference[0])
+        rotation, _ = cv2.Rodrigues(rvec)
+        angle = np.degrees(np.linalg.norm(cv2.Rodrigues(rotation @ rotation_reference.T)[0]))
+
+        # camera centers in the world: -R^T t
+        center_reference = -rotation_reference.T @ reference[1].ravel()
+        center = -rotation.T @ tvec.ravel()
+        return angle, np.linalg.norm(center - center_reference) / 1000
+
+
+    def monitor_camera(self, camera, start=0.0, end=None, reference_time=None):
+        reference = self.get_reference(camera, reference_time)
+        if reference is None:
+            print(f'No reference frame for camera {camera}.')
+            return [], [], {}
+
+        # features on the reference frame, players moving over the court are rejected by RANSAC later
+        features = cv2.goodFeaturesToTrack(reference, self.features, 0.01, 10)
+        if features is None:
+            print(f'No features to track for camera {camera}.')
+            return [], [], {}
+        features = features.reshape(-1, 2)
+
+        # warm start from the extrinsic calibration: its inverse is the pose in the world, in meters
+        camera_f_world = np.linalg.inv(self.extrinsic_matrices[camera])
+        rvec, _ = cv2.Rodrigues(camera_f_world[:3, :3])
+        tvec = camera_f_world[:3, 3:] * 1000
+        rvec, tvec, reference_error = self.solve_pose(camera, self.image_points[camera], rvec, tvec)
+        reference_pose = (rvec, tvec)
+
+        homography = np.eye(3)  # reference frame to the current frame (downscaled pixels)
+        series, alerts, timings = [], [], {'decode_ms': [], 'register_ms': [], 'pose_ms': []}
+        exceeded = 0
+        for timestamp, frame, decode_time in self.read_samples(camera, start, end):
+            started = time.perf_counter()
+
+            # track from the reference frame, not from the previous sample, so errors don't accumulate - the last
+            # registration gives the starting positions
+            guess = cv2.perspectiveTransform(features[None], homography)[0]
+            tracked, status, _ = cv2.calcOpticalFlowPyrLK(reference, frame, features.astype(np.float32),
+                                                          guess.astype(np.float32), winSize=(21, 21), maxLevel=3,
+                                                          flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+            status = status.ravel() == 1
+            inliers = 0
+            if status.sum() >= 8:
+                estimate, mask = cv2.findHomography(features[status], tracked[status], cv2.RANSAC, 2.0)
+                if estimate is not None:
+                    homography, inliers = estimate, int(mask.sum())
+            register_time = 1000 * (time.perf_counter() - started)
+
+            # court points moved along with the image, in full resolution pixels
+            started = time.perf_counter()
+            points = cv2.perspectiveTransform((self.image_points[camera] * self.scale)[None].astype(np.float64), homography)[0] / self.scale
+            rvec, tvec, error = self.solve_pose(camera, points, rvec, tvec)
+            rotation, translation = self.pose_delta(reference_pose, rvec, tvec)
+            pose_time = 1000 * (time.perf_counter() - started)
+
+            series.append({'time_s': float(timestamp), 'rotation_deg': float(rotation), 'translation_m': float(translation),
+                           'reprojection_error_px': float(error), 'features': int(inliers),
+                           'image_shift_px': float(np.mean(np.linalg.norm(points - self.image_points[camera], axis=1)))})
+            timings['decode_ms'].append(decode_time)
+            timings['register_ms'].append(register_time)
+            timings['pose_ms'].append(pose_time)
+
+            reasons = []
+            if rotation > self.max_rotation:
+                reasons.append(f'rotated {rotation:.2f} deg')
+            if translation > self.max_translation:
+                reasons.append(f'moved {translation:.2f} m')
+            if error > reference_error + self.max_reprojection_error:
+                reasons.append(f'reprojection error {error:.1f} px (calibration: {reference_error:.1f} px)')
+            if inliers < 8:
+                reasons.append('lost the reference')
+
+            exceeded = exceeded + 1 if reasons else 0
+            if exceeded == self.persistence:
+                alerts.append({'time_s': float(timestamp), 'reasons': reasons})
+                print(f'Camera {camera} at {timestamp:.1f} s: {", ".join(reasons)}')
+
+        return series, alerts, timings
+
+
+    def monitor(self, cameras=None, workers=1, start=0.0, end=None, reference_time=None):
+        cameras = cameras or list(self.extrinsic_matrices.keys())
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda camera: self.monitor_camera(camera, start, end, reference_time), cameras))
+        self.wall_time = time.perf_counter() - started
+
+        for camera, (series, alerts, timings) in zip(cameras, results):
+            self.series[camera] = series
+            self.alerts[camera] = alerts
+            self.timings[camera] = timings
+
+
+    def budget(self):
+        # processing time against the video time covered: a real time factor below 1 keeps up with the videos with
+        # the workers used, the processing time per video second is the number of cores all cameras need
+        samples = sum(len(series) for series in self.series.values())
+        video_time = max((len(series) for series in self.series.values()), default=0) / self.rate
+        processing_time = sum(sum(sum(times) for times in timings.values()) for timings in self.timings.values()) / 1000
+        report = {
+            'cameras': len(self.series),
+            'samples': samples,
+            'wall_time_s': self.wall_time,
+            'video_time_s': video_time,
+            'real_time_factor': self.wall_time / video_time if video_time else None,
+            'processing_s_per_video_s': processing_time / video_time if video_time else None
+        }
+        for stage in ['decode_ms', 'register_ms', 'pose_ms']:
+            times = np.concatenate([timings[stage] for timings in self.timings.values() if timings.get(stage)] or [np.zeros(1)])
+            report[f'{stage}_mean'] = float(np.mean(times))
+
+        return report
+
+
+    def print_report(self):
+        print(f'{"camera":>8}{"samples":>9}{"max rot. deg":>14}{"max move m":>12}{"max error px":>14}{"alerts":>8}')
+        for camera, series in self.series.items():
+            if not series:
+                continue
+            print(f'{camera:>8}{len(series):>9}{max(s["rotation_deg"] for s in series):>14.3f}'
+                  f'{max(s["translation_m"] for s in series):>12.3f}{max(s["reprojection_error_px"] for s in series):>14.1f}'
+                  f'{len(self.alerts[camera]):>8}')
+
+        budget = self.budget()
+        print(f'Per sample: decode {budget["decode_ms_mean"]:.1f} ms, registration {budget["register_ms_mean"]:.1f} ms, '
+              f'pose {budget["pose_ms_mean"]:.1f} ms')
+        if budget['real_time_factor'] is not None:
+            print(f'{budget["samples"]} samples of {budget["cameras"]} cameras in {budget["wall_time_s"]:.1f} s for '
+                  f'{budget["video_time_s"]:.1f} s of video: {budget["real_time_factor"]:.2f}x real time '
+                  f'({"keeps up" if budget["real_time_factor"] <= 1 else "falls behind"}), '
+                  f'{budget["processing_s_per_video_s"]:.2f} s of processing per second of video')
+
+
+    def save(self, path):
+        with open(path, 'w') as outfile:
+            json.dump({'series': self.series, 'alerts': self.alerts, 'budget': self.budget()}, outfile, indent=4)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monitor the camera poses over the court videos and alert on drift.')
+    parser.add_argument('--cameras', nargs='+', default=None, help='cameras to monitor (default: all with an extrinsic calibration)')
+    parser.add_argument('--rate', type=float, default=1.0, help='samples per second of video')
+    parser.add_argument('--start', type=float, default=0.0, help='start time in seconds')
+    parser.add_argument('--end', type=float, default=None, help='end time in seconds (default: end of the videos)')
+    parser.add_argument('--reference-time', default=None,
+                        help='take the reference frame from the videos at this time instead of the calibration images')
+    parser.add_argument('--max-rotation', type=float, default=0.5, help='alert above this rotation in degrees')
+    parser.add_argument('--max-translation', type=float, default=0.1, help='alert above this displacement in meters')
+    parser.add_argument('--max-reprojection-error', type=float, default=10.0, help='alert when the RMS error grows by more than this in pixels')
+    parser.add_argument('--persistence', type=int, default=2, help='samples in a row exceeding a threshold before an alert')
+    parser.add_argument('--workers', type=int, default=4, help='number of cameras monitored at once')
+    parser.add_argument('--output', default='results/drift_report.json', help='JSON file for the time series and alerts')
+    args = parser.parse_args()
+
+    dm = DriftMonitor(rate=args.rate, max_rotation=args.max_rotation, max_translation=args.max_translation,
+                      max_reprojection_error=args.max_reprojection_error, persistence=args.persistence)
+    dm.monitor(args.cameras, args.workers, args.start, args.end, args.reference_time)
+    dm.print_report()
+    dm.save(args.output)
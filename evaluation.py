@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+import numpy as np
+import json
+import os
+import sys
+import argparse
+
+from calibration_store import CalibrationStore
+
+
+def rodrigues(rvecs):
+    # rotation vectors (N, 3) to rotation matrices (N, 3, 3)
+    rvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3)
+    theta = np.linalg.norm(rvecs, axis=1)
+    axis = rvecs / np.where(theta > 1e-12, theta, 1)[:, None]
+
+    k = np.zeros((len(rvecs), 3, 3))
+    k[:, 0, 1], k[:, 0, 2], k[:, 1, 2] = -axis[:, 2], axis[:, 1], -axis[:, 0]
+    k[:, 1, 0], k[:, 2, 0], k[:, 2, 1] = axis[:, 2], -axis[:, 1], axis[:, 0]
+
+    sin, cos = np.sin(theta)[:, None, None], np.cos(theta)[:, None, None]
+    return np.eye(3) + sin * k + (1 - cos) * k @ k
+
+
+def project_points(points, rotations, translations, camera_matrices, distortions):
+    # pinhole projection with the distortion model of OpenCV (k1, k2, p1, p2, k3), every point (N, 3) with
+    # its own pose and camera (N, ...), so points of many views and cameras are projected at once
+    camera_points = np.einsum('nij,nj->ni', rotations, points) + translations
+    x, y = camera_points[:, 0] / camera_points[:, 2], camera_points[:, 1] / camera_points[:, 2]
+
+    d = np.zeros((len(points), 5))
+    d[:, :min(5, distortions.shape[1])] = distortions[:, :5]
+    k1, k2, p1, p2, k3 = d.T
+
+    r2 = x * x + y * y
+    radial = 1 + k1 * r2 + k2 * r2 ** 2 + k3 * r2 ** 3
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+
+    u = camera_matrices[:, 0, 0] * xd + camera_matrices[:, 0, 1] * yd + camera_matrices[:, 0, 2]
+    v = camera_matrices[:, 1, 1] * yd + camera_matrices[:, 1, 2]
+    return np.column_stack((u, v))
+
+
+def summarize(errors):
+    return {'mean': float(np.mean(errors)), 'rms': float(np.sqrt(np.mean(np.square(errors)))),
+            'max': float(np.max(errors))}
+
+
+
+class CalibrationEvaluation:
+    def __init__(self, views_dir='results/intrinsic_views'):
+        self.views_dir = views_dir
+
+        self.store = CalibrationStore()
+        self.intrinsic_matrices = self.store.section('intrinsic')
+        self.distortions = self.store.section('distortions')
+        self.extrinsic_matrices = self.store.section('extrinsic')
+        self.homographies = self.store.section('homography')
+        self.image_points = self.store.section('image_points')
+        self.world_points = self.store.section('world_points')
+        self.ground_truth_cameras = self.store.section('ground_truth')
+
+        self.views = self.load_views()
+
+
+    def load_views(self):
+        # per view poses of the intrinsic calibration, only written by newer calibration runs
+        views = {}
+        for camera in self.intrinsic_matrices.keys():
+            path = f'{self.views_dir}/out{camera}.npz'
+            if os.path.exists(path):
+                with np.load(path) as data:
+                    views[camera] = {k: data[k] for k in data.files}
+
+        return views
+
+
+    def gather(self, cameras, points):
+        # points of all cameras concatenated and the camera index of every point
+        index = np.concatenate([np.full(len(points[camera]), i) for i, camera in enumerate(cameras)])
+        return np.concatenate([points[camera] for camera in cameras]), index
+
+
+    def intrinsic_errors(self):
+        # reprojection error of every corner of every calibration view, all cameras in one pass
+        cameras = [camera for camera in self.intrinsic_matrices.keys() if camera in self.views]
+        if not cameras:
+            return {}
+
+        object_points, point_camera = self.gather(cameras, {c: self.views[c]['object_points'].reshape(-1, 3) for c in cameras})
+        image_points, _ = self.gather(cameras, {c: self.views[c]['image_points'].reshape(-1, 2) for c in cameras})
+
+        # view of every point, counted over all cameras
+        view_counts = [len(self.views[camera]['rvecs']) for camera in cameras]
+        points_per_view = [self.views[camera]['object_points'].shape[1] for camera in cameras]
+        point_view = np.concatenate([np.repeat(np.arange(count) + offset, n)
+                                     for count, n, offset in zip(view_counts, points_per_view, np.cumsum([0] + view_counts))])
+
+        rotations = rodrigues(np.concatenate([self.views[camera]['rvecs'] for camera in cameras]))
+        translations = np.concatenate([self.views[camera]['tvecs'] for camera in cameras])
+        camera_matrices = np.array([self.intrinsic_matrices[camera] for camera in cameras])
+        distortions = np.array([self.distortions[camera].ravel()[:5] for camera in cameras])
+
+        projected = project_points(object_points, rotations[point_view], translations[point_view],
+                                   camera_matrices[point_camera], distortions[point_camera])
+        errors = np.linalg.norm(projected - image_points, axis=1)
+
+        results = {}
+        for i, camera in enumerate(cameras):
+            camera_errors = errors[point_camera == i]
+            per_view = np.sqrt(np.mean(np.square(camera_errors.reshape(view_counts[i], -1)), axis=1))
+            results[camera] = {**summarize(camera_errors),
+                               'calibration_rms': float(self.views[camera]['rms']),
+                               'views': int(view_counts[i]),
+                               'per_view_rms': {int(frame_id): float(rms) for frame_id, rms in zip(self.views[camera]['frame_ids'], per_view)}}
+
+        return results
+
+
+    def extrinsic_errors(self):
+        # reprojection error in pixels of the court points through the extrinsic and intrinsic calibration
+        cameras = [camera for camera in self.extrinsic_matrices.keys()
+                   if camera in self.image_points and camera in self.intrinsic_matrices]
+        if not cameras:
+            return {}
+
+        world_points, point_camera = self.gather(cameras, self.world_points)
+        image_points, _ = self.gather(cameras, self.image_points)
+
+        # extrinsic matrices are the camera poses in the world (meters), the world points are in millimeters
+        camera_f_world = np.linalg.inv(np.array([self.extrinsic_matrices[camera] for camera in cameras]))
+        camera_matrices = np.array([self.intrinsic_matrices[camera] for camera in cameras])
+        distortions = np.array([self.distortions[camera].ravel()[:5] for camera in cameras])
+
+        projected = project_points(world_points / 1000, camera_f_world[point_camera, :3, :3], camera_f_world[point_camera, :3, 3],
+                                   camera_matrices[point_camera], distortions[point_camera])
+        errors = np.linalg.norm(projected - image_points, axis=1)
+
+        results = {}
+        for i, camera in enumerate(cameras):
+            results[camera] = {**summarize(errors[point_camera == i]),
+                               'per_point': errors[point_camera == i].tolist()}
+            if camera in self.ground_truth_cameras:
+                results[camera]['position_error_m'] = float(np.linalg.norm(self.extrinsic_matrices[camera][:3, 3]
+                                                                           - self.ground_truth_cameras[camera]))
+
+        return results
+
+
+    def homography_errors(self):
+        # transfer errors of the court points: image to world in millimeters and world to image in pixels
+        cameras = [camera for camera in self.homographies.keys() if camera in self.image_points]
+        if not cameras:
+            return {}
+
+        world_points, point_camera = self.gather(cameras, self.world_points)
+        image_points, _ = self.gather(cameras, self.image_points)
+
+        world_from_image = np.array([self.homographies[camera] for camera in cameras])[point_camera]
+        image_from_world = np.linalg.inv(world_from_image)
+
+        world = np.einsum('nij,nj->ni', world_from_image, np.column_stack((image_points, np.ones(len(image_points)))))
+        world_errors = np.linalg.norm(world[:, :2] / world[:, 2:] - world_points[:, :2], axis=1)
+
+        image = np.einsum('nij,nj->ni', image_from_world, np.column_stack((world_points[:, :2], np.ones(len(world_points)))))
+        image_errors = np.linalg.norm(image[:, :2] / image[:, 2:] - image_points, axis=1)
+
+        results = {}
+        for i, camera in enumerate(cameras):
+            results[camera] = {'world_mm': summarize(world_errors[point_camera == i]),
+                               'image_px': summarize(image_errors[point_camera == i]),
+                               'per_point_world_mm': world_errors[point_camera == i].tolist()}
+
+        return results
+
+
+    def evaluate(self, max_intrinsic_rms=1.0, max_extrinsic_error=10.0, max_homography_error=100.0):
+        # thresholds: pixels for the reprojection errors, millimeters for the homography transfer error
+        report = {
+            'intrinsic': self.intrinsic_errors(),
+            'extrinsic': self.extrinsic_errors(),
+            'homography': self.homography_errors(),
+            'thresholds': {'max_intrinsic_rms_px': max_intrinsic_rms,
+                           'max_extrinsic_error_px': max_extrinsic_error,
+                           'max_homography_error_mm': max_homography_error}
+        }
+
+        flagged = {}
+        for camera, result in report['intrinsic'].items():
+            if result['rms'] > max_intrinsic_rms:
+                flagged.setdefault(camera, []).append(f'intrinsic RMS {result["rms"]:.2f} px')
+        for camera, result in report['extrinsic'].items():
+            if result['max'] > max_extrinsic_error:
+                flagged.setdefault(camera, []).append(f'extrinsic max error {result["max"]:.1f} px')
+        for camera, result in report['homography'].items():
+            if result['world_mm']['max'] > max_homography_error:
+                flagged.setdefault(camera, []).append(f'homography max error {result["world_mm"]["max"]:.0f} mm')
+        report['flagged'] = flagged
+
+        return report
+
+
+    def print_report(self, report):
+        print(f'{"camera":>8}{"intr. rms":>11}{"extr. mean":>12}{"extr. max":>11}{"hom. mean":>11}{"hom. max":>10}  [px, px, px, mm, mm]')
+        for camera in self.intrinsic_matrices.keys():
+            intrinsic = report['intrinsic'].get(camera, {}).get('rms', np.nan)
+            extrinsic = report['extrinsic'].get(camera, {'mean': np.nan, 'max': np.nan})
+            homography = report['homography'].get(camera, {}).get('world_mm', {'mean': np.nan, 'max': np.nan})
+            print(f'{camera:>8}{intrinsic:>11.2f}{extrinsic["mean"]:>12.1f}{extrinsic["max"]:>11.1f}'
+                  f'{homography["mean"]:>11.0f}{homography["max"]:>10.0f}')
+
+        for camera, reasons in report['flagged'].items():
+            print(f'Camera {camera}: {", ".join(reasons)}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reprojection errors of the intrinsic, extrinsic and homography calibration.')
+    parser.add_argument('--output', default='results/calibration_report.json', help='JSON file for the report')
+    parser.add_argument('--max-intrinsic-rms', type=float, default=1.0, help='flag cameras above this RMS error in pixels')
+    parser.add_argument('--max-extrinsic-error', type=float, default=10.0,
+                        help='flag cameras with a court point reprojected further off than this in pixels')
+    parser.add_argument('--max-homography-error', type=float, default=100.0,
+                        help='flag cameras with a court point mapped further off than this in millimeters')
+    parser.add_argument('--fail', action='store_true', help='exit with status 1 if a camera is flagged')
+    args = parser.parse_args()
+
+    ce = CalibrationEvaluation()
+    report = ce.evaluate(args.max_intrinsic_rms, args.max_extrinsic_error, args.max_homography_error)
+    ce.print_report(report)
+
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=4)
+
+    if args.fail and report['flagged']:
+        sys.exit(1)
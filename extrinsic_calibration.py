@@ -2,11 +2,32 @@
 
 import numpy as np 
 import cv2
-import json
+import time
+import argparse
+import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from calibration_store import CalibrationStore
+
+
+def rigid_inverse(rotation_matrix, translation):
+    # inverse of the rigid transform [R | t] as 4x4 matrix, [R^T | -R^T t]
+    inverse = np.eye(4)
+    inverse[:3, :3] = rotation_matrix.T
+    inverse[:3, 3] = -rotation_matrix.T @ translation
+    
+    return inverse
 
 
 class ExtrinsicCalibration():
-    def __init__(self):
+    def __init__(self, ransac=False, workers=1, reprojection_error=8.0):
+        # ransac: robust solve that ignores wrongly clicked points (reprojection_error: inlier threshold 
+        # in pixels), refined on the inliers - workers: cameras solved at once
+        self.ransac = ransac
+        self.workers = workers
+        self.reprojection_error = reprojection_error
+        
         # matrices
         self.intrinsic_matrices = {}
         self.distortions = {}
@@ -17,8 +38,10 @@ class ExtrinsicCalibration():
         
         # result
         self.extrinsic_matrices = {}
+        self.reports = {}  # camera: points, inliers, outliers, time
         
-        # load necessary data
+        # load necessary data, only the arrays used are read from the calibration store
+        self.store = CalibrationStore()
         self.load_intrinsic_matrices()
         self.load_distortions()
         self.load_image_points()
@@ -26,88 +49,152 @@ class ExtrinsicCalibration():
         
     
     def load_intrinsic_matrices(self):
-        with open('results/intrinsic.json') as f:
-            self.intrinsic_matrices = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.intrinsic_matrices.keys():
-            self.intrinsic_matrices[k] = np.array(self.intrinsic_matrices[k])
+        self.intrinsic_matrices = self.store.section('intrinsic')
         
         
     def load_distortions(self):
-        with open('results/distortions.json') as f:
-            self.distortions = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.distortions.keys():
-            self.distortions[k] = np.array(self.distortions[k])
+        self.distortions = self.store.section('distortions')
             
     
     def load_image_points(self):
-        with open('results/extrinsic_image_points.json') as f:
-            self.image_points = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.image_points.keys():
-            self.image_points[k] = np.array(self.image_points[k])
+        self.image_points = self.store.section('image_points')
             
     
     def load_world_points(self):
-        with open('results/extrinsic_world_points.json') as f:
-            self.world_points = json.load(f)
+        self.world_points = self.store.section('world_points') 
+            
+            
+    def solve_pose(self, camera):
+        world_points = self.world_points[camera].astype(np.float64)
+        image_points = self.image_points[camera].astype(np.float64)
         
-        # convert dictionary entries to numpy arrays
-        for k in self.world_points.keys():
-            self.world_points[k] = np.array(self.world_points[k]) 
+        if self.ransac:
+            rvecs, tvecs, inliers = self.solve_pose_ransac(camera, world_points, image_points)
+            if len(inliers) >= 4:
+                # refine on the inliers
+                rvecs, tvecs = cv2.solvePnPRefineLM(world_points[inliers],
+                                                    image_points[inliers],
+                                                    self.intrinsic_matrices[camera],
+                                                    self.distortions[camera],
+                                                    rvecs, tvecs)
+                return rvecs, tvecs, inliers, True
             
+            print(f'RANSAC failed for camera {camera}, using all points.')
+        
+        _, rvecs, tvecs = cv2.solvePnP(world_points,
+                                       image_points,
+                                       self.intrinsic_matrices[camera],
+                                       self.distortions[camera])
+        if not self.ransac:
+            return rvecs, tvecs, np.arange(len(world_points)), None
+        
+        # no consensus: the points within the threshold of the pose from all points are reported as inliers
+        projected, _ = cv2.projectPoints(world_points, rvecs, tvecs, self.intrinsic_matrices[camera], self.distortions[camera])
+        errors = np.linalg.norm(projected.reshape(-1, 2) - image_points, axis=1)
+        return rvecs, tvecs, np.flatnonzero(errors < self.reprojection_error), False
+    
+    
+    def solve_pose_ransac(self, camera, world_points, image_points, iterations=500):
+        # consensus over the poses of 4 point subsets, all of them for the few clicked points of a camera and 
+        # random ones for many - the court points are coplanar, so IPPE solves the subsets (cv2.solvePnPRansac 
+        # with its EPnP and P3P minimal solvers doesn't find the consensus on the points along the court lines)
+        n = len(world_points)
+        if math.comb(n, 4) <= iterations:
+            subsets = itertools.combinations(range(n), 4)
+        else:
+            rng = np.random.default_rng(0)
+            subsets = (rng.choice(n, 4, replace=False) for _ in range(iterations))
+        
+        best_score, best_pose = None, (None, None, np.array([], dtype=int))
+        for subset in subsets:
+            subset = list(subset)
+            _, rvecs_list, tvecs_list, _ = cv2.solvePnPGeneric(world_points[subset],
+                                                               image_points[subset],
+                                                               self.intrinsic_matrices[camera],
+                                                               self.distortions[camera],
+                                                               flags=cv2.SOLVEPNP_IPPE)
             
-    def calculate_extrinsic_matrices(self):
-        for camera in self.intrinsic_matrices.keys():
-            # calibrate extrinsic matrix
-            _, rvecs, tvecs = cv2.solvePnP(self.world_points[camera],
-                                           self.image_points[camera],
-                                           self.intrinsic_matrices[camera],
-                                           self.distortions[camera])
-
-            # make rotation matrix from vector
-            rotation_matrix, _ = cv2.Rodrigues(rvecs)
-
-            # convert from 3x3 to 4x4
-            rotation_matrix = np.pad(rotation_matrix, (0, 1), mode='constant')
-            rotation_matrix[3, 3] = 1
+            for rvecs, tvecs in zip(rvecs_list, tvecs_list):
+                projected, _ = cv2.projectPoints(world_points, rvecs, tvecs, 
+                                                 self.intrinsic_matrices[camera], self.distortions[camera])
+                errors = np.linalg.norm(projected.reshape(-1, 2) - image_points, axis=1)
+                inliers = np.flatnonzero(errors < self.reprojection_error)
+                
+                # most inliers, ties are broken by the (truncated) errors
+                score = (len(inliers), -np.minimum(errors, self.reprojection_error).sum())
+                if best_score is None or score > best_score:
+                    best_score, best_pose = score, (rvecs, tvecs, inliers)
+                    
+        return best_pose
+    
+    
+    def calculate_extrinsic_matrix(self, camera):
+        start = time.perf_counter()
+        
+        # calibrate extrinsic matrix
+        rvecs, tvecs, inliers, consensus = self.solve_pose(camera)
 
-            # convert to meters
-            tvecs = tvecs.flatten() / 1000.
+        # make rotation matrix from vector
+        rotation_matrix, _ = cv2.Rodrigues(rvecs)
 
-            # build translation matrix
-            t_matrix = np.array([[1, 0, 0, tvecs[0]],
-                                [0, 1, 0, tvecs[1]],
-                                [0, 0, 1, tvecs[2]],
-                                [0, 0, 0, 1]])
+        # convert to meters
+        tvecs = tvecs.flatten() / 1000.
 
-            # combine rotation and translation
-            world_f_camera = np.dot(t_matrix, rotation_matrix)
+        # the solved pose maps world to camera coordinates, its inverse is the camera's pose in the world
+        extrinsic_matrix = rigid_inverse(rotation_matrix, tvecs)
+        
+        report = {
+            'points': len(self.world_points[camera]),
+            'inliers': len(inliers),
+            'outliers': sorted(set(range(len(self.world_points[camera]))) - set(inliers.tolist())),
+            'ransac': consensus,  # False: RANSAC found no consensus and the pose is solved from all points
+            'time_ms': 1000 * (time.perf_counter() - start)
+        }
+        
+        return extrinsic_matrix.tolist(), report
+    
+    
+    def calculate_extrinsic_matrices(self, cameras=None):
+        # OpenCV releases the GIL while solving, so threads are enough to solve the cameras at once - 
+        # all cameras with an intrinsic calibration by default
+        cameras = list(cameras or self.intrinsic_matrices.keys())
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self.calculate_extrinsic_matrix, cameras))
+            
+        # save to dictionary
+        for camera, (extrinsic_matrix, report) in zip(cameras, results):
+            self.extrinsic_matrices[camera] = extrinsic_matrix
+            self.reports[camera] = report
             
-            # invert
-            extrinsic_matrix = np.linalg.inv(world_f_camera)
             
-            # save to dictionary
-            self.extrinsic_matrices[camera] = extrinsic_matrix.tolist()
+    def print_report(self):
+        print(f'{"camera":>8}{"points":>8}{"inliers":>9}{"time ms":>9}  outliers')
+        for camera, report in self.reports.items():
+            fallback = '  (RANSAC failed, solved from all points)' if report['ransac'] is False else ''
+            print(f'{camera:>8}{report["points"]:>8}{report["inliers"]:>9}{report["time_ms"]:>9.2f}  {report["outliers"]}{fallback}')
         
     
     def save_matrices(self):
-        with open('results/extrinsic.json', 'w') as outfile: 
-            json.dump(self.extrinsic_matrices, outfile)
+        # written to the store and exported to results/extrinsic.json
+        self.store.update('extrinsic', self.extrinsic_matrices, replace=True)
+        self.store.save()
             
             
     def run(self):
         print("Start extrinsic calibration...")
         self.calculate_extrinsic_matrices()
         self.save_matrices()
+        self.print_report()
         print("...Done.")
             
             
             
 if __name__ == '__main__':
-    ec = ExtrinsicCalibration()
+    parser = argparse.ArgumentParser(description='Extrinsic calibration of the cameras from the court points.')
+    parser.add_argument('--ransac', action='store_true', help='ignore wrongly clicked points (RANSAC and refinement on the inliers)')
+    parser.add_argument('--reprojection-error', type=float, default=8.0, help='RANSAC inlier threshold in pixels')
+    parser.add_argument('--workers', type=int, default=1, help='cameras solved at once')
+    args = parser.parse_args()
+    
+    ec = ExtrinsicCalibration(ransac=args.ransac, workers=args.workers, reprojection_error=args.reprojection_error)
     ec.run()     
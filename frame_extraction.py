@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from image_store import ImageStore
+
+
+# time in the court video of every camera of the frame used for the extrinsic calibration
+CALIBRATION_TIMES = {
+    '1': '00:00:56',
+    '2': '00:01:49',
+    '3': '00:04:02',
+    '4': '00:05:08',
+    '5': '00:04:13',
+    '6': '00:04:06',
+    '7': '00:02:25',
+    '8': '00:04:41',
+    '12': '00:04:24',
+    '13': '00:04:23'
+}
+
+# sizes the homography tool shows the images at: grid tile and enlarged
+THUMBNAIL_SIZES = [(480, 270), (1920, 1080)]
+
+
+def parse_time(timestamp):
+    # 'hh:mm:ss' (or seconds) to seconds
+    seconds = 0.0
+    for part in str(timestamp).split(':'):
+        seconds = 60 * seconds + float(part)
+
+    return seconds
+
+
+
+class FrameExtraction:
+    def __init__(self, video_dir='input/videos', workers=4, thumbnail_sizes=THUMBNAIL_SIZES, images=None):
+        # single frames of the court videos: the decoder seeks to the keyframe before the requested time and
+        # only decodes from there on, the cameras are extracted in threads (OpenCV releases the GIL while decoding)
+        self.video_dir = video_dir
+        self.workers = workers
+        self.thumbnail_sizes = thumbnail_sizes
+        self.images = images or ImageStore()
+
+        self.timings = []  # per extracted frame: camera, requested and decoded time, durations in ms
+
+
+    def get_video_path(self, camera):
+        return f'{self.video_dir}/out{camera}.mp4'
+
+
+    def extract_camera(self, camera, timestamps, size=None):
+        # frames of one camera at the timestamps in seconds, None where the video ends or is missing - one
+        # capture for all of them, in order so later seeks only go forward - size: (width, height) the frames
+        # are downscaled to right after decoding, so many frames don't pile up at full resolution
+        start = time.perf_counter()
+        cap = cv2.VideoCapture(self.get_video_path(camera))
+        if not cap.isOpened():
+            print(f'Video of camera {camera} not found.')
+            for timestamp in sorted(timestamps):
+                self.timings.append({'camera': camera, 'requested_s': timestamp, 'decoded_s': None,
+                                     'open_ms': 1000 * (time.perf_counter() - start), 'decode_ms': 0.0})
+            return {timestamp: None for timestamp in timestamps}
+        open_time = 1000 * (time.perf_counter() - start)
+
+        frames = {}
+        for timestamp in sorted(timestamps):
+            start = time.perf_counter()
+            cap.set(cv2.CAP_PROP_POS_MSEC, timestamp * 1000)
+            ok, frame = cap.read()
+            decoded_time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if ok and size is not None:
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            frames[timestamp] = frame if ok else None
+
+            self.timings.append({'camera': camera, 'requested_s': timestamp, 'decoded_s': decoded_time if ok else None,
+                                 'open_ms': open_time, 'decode_ms': 1000 * (time.perf_counter() - start)})
+            open_time = 0.0
+
+        cap.release()
+        return frames
+
+
+    def extract(self, requests):
+        # requests: (camera, timestamp in seconds) - returns (camera, timestamp): frame
+        timestamps = {}
+        for camera, timestamp in requests:
+            timestamps.setdefault(camera, []).append(timestamp)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = dict(zip(timestamps.keys(), executor.map(self.extract_camera, timestamps.keys(), timestamps.values())))
+
+        return {(camera, timestamp): results[camera][timestamp] for camera, timestamp in requests}
+
+
+    def save_camera_image(self, camera, frame):
+        # image and thumbnails as read by the homography tool
+        start = time.perf_counter()
+        self.images.save(camera, frame, self.thumbnail_sizes)
+
+        return 1000 * (time.perf_counter() - start)
+
+
+    def extract_calibration_images(self, cameras=None, times=CALIBRATION_TIMES):
+        # one frame per camera for the extrinsic calibration, images/extrinsic_calibration_images/out{camera}.png
+        cameras = cameras or list(times.keys())
+        requests = [(camera, parse_time(times[camera])) for camera in cameras]
+        frames = self.extract(requests)
+
+        found = {camera: frames[request] for camera, request in zip(cameras, requests) if frames[request] is not None}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            save_times = dict(zip(found.keys(), executor.map(self.save_camera_image, found.keys(), found.values())))
+
+        for timing in self.timings:
+            timing['save_ms'] = save_times.get(timing['camera'])
+
+        return frames
+
+
+    def print_report(self):
+        print(f'{"camera":>8}{"requested s":>13}{"decoded s":>11}{"open ms":>9}{"decode ms":>11}{"save ms":>9}')
+        for timing in self.timings:
+            decoded = timing['decoded_s'] if timing['decoded_s'] is not None else np.nan
+            save = timing['save_ms'] if timing.get('save_ms') is not None else np.nan
+            print(f'{timing["camera"]:>8}{timing["requested_s"]:>13.2f}{decoded:>11.2f}{timing["open_ms"]:>9.1f}'
+                  f'{timing["decode_ms"]:>11.1f}{save:>9.1f}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the frames for the extrinsic calibration from the court videos.')
+    parser.add_argument('--cameras', nargs='+', default=None, help='cameras to extract (default: all)')
+    parser.add_argument('--time', nargs=2, action='append', default=[], metavar=('CAMERA', 'TIME'),
+                        help='extract the frame of a camera at this time (hh:mm:ss or seconds) instead of the default one')
+    parser.add_argument('--video-dir', default='input/videos', help='directory of the court videos out{camera}.mp4')
+    parser.add_argument('--workers', type=int, default=4, help='number of cameras extracted at once')
+    args = parser.parse_args()
+
+    times = {**CALIBRATION_TIMES, **dict(args.time)}
+    start = time.perf_counter()
+    fe = FrameExtraction(video_dir=args.video_dir, workers=args.workers)
+    fe.extract_calibration_images(args.cameras, times)
+    fe.print_report()
+    extracted = sum(timing['decoded_s'] is not None for timing in fe.timings)
+    print(f'Extracted {extracted} of {len(fe.timings)} frames in {time.perf_counter() - start:.2f} s')
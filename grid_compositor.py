@@ -0,0 +1,121 @@
+import numpy as np
+import cv2
+
+
+# position (column, row) and size (columns, rows) of every tile of the 4x4 grid
+GRID_LAYOUT = {
+    '1': (0, 0, 1, 1),
+    '2': (1, 0, 1, 1),
+    '3': (2, 0, 1, 1),
+    '4': (3, 0, 1, 1),
+    '5': (0, 1, 1, 1),
+    '6': (1, 1, 1, 1),
+    'court': (2, 1, 2, 2),
+    '7': (0, 2, 1, 1),
+    '8': (1, 2, 1, 1),
+    '12': (0, 3, 1, 1),
+    '13': (1, 3, 1, 1),
+    'usage': (2, 3, 2, 1)
+}
+
+# tiles showing a camera image
+CAMERA_TILES = ['1', '2', '3', '4', '5', '6', '7', '8', '12', '13']
+
+
+class GridCompositor:
+    def __init__(self, display_scale, layout=GRID_LAYOUT, grid_size=(4, 4)):
+        self.display_scale = display_scale
+        self.layout = layout
+        self.cell_scale = (display_scale[0] // grid_size[0], display_scale[1] // grid_size[1])
+
+        # tiles with their labels, and the displayed canvas with markers on top, both display-sized
+        self.base = np.zeros((display_scale[1], display_scale[0], 3), np.uint8)
+        self.canvas = self.base.copy()
+
+        self.markers = {}  # tile: list of (x, y) in grid pixels
+        self.dirty = set(layout.keys())  # tiles that have to be copied to the canvas again
+
+
+    def tile_rect(self, name):
+        # x, y, width, height in grid pixels
+        column, row, columns, rows = self.layout[name]
+        return (column * self.cell_scale[0], row * self.cell_scale[1],
+                columns * self.cell_scale[0], rows * self.cell_scale[1])
+
+
+    def tile_size(self, name):
+        return self.tile_rect(name)[2:]
+
+
+    def tile_at(self, point):
+        # name of the tile containing the grid pixel, None if there is none
+        for name in self.layout.keys():
+            x, y, width, height = self.tile_rect(name)
+            if x <= point[0] < x + width and y <= point[1] < y + height:
+                return name
+
+        return None
+
+
+    def image_to_grid(self, name, point, image_scale):
+        # position in the grid of a point of the image (of size image_scale) shown in the tile
+        x, y, width, height = self.tile_rect(name)
+        return np.array([x, y]) + np.asarray(point, dtype=float) * np.array([width / image_scale[0], height / image_scale[1]])
+
+
+    def grid_to_image(self, name, point, image_scale):
+        # inverse of image_to_grid
+        x, y, width, height = self.tile_rect(name)
+        return (np.asarray(point, dtype=float) - np.array([x, y])) * np.array([image_scale[0] / width, image_scale[1] / height])
+
+
+    def set_tile(self, name, image, label=None):
+        # draw the (downscaled if necessary) image into its tile
+        x, y, width, height = self.tile_rect(name)
+        if image.shape[1] != width or image.shape[0] != height:
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        self.base[y:y + height, x:x + width] = image
+
+        if label is not None:
+            cv2.putText(self.base, label, (x + 10, y + 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+        self.dirty.add(name)
+
+
+    def set_text(self, name, lines):
+        # black tile with lines of text, e.g. the usage
+        x, y, width, height = self.tile_rect(name)
+        self.base[y:y + height, x:x + width] = 0
+
+        for i, line in enumerate(lines):
+            cv2.putText(self.base, line, (x + 10, y + 30 + 30 * i + (10 if i else 0)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+        self.dirty.add(name)
+
+
+    def set_markers(self, markers):
+        # markers: tile, list of grid positions - only tiles whose markers changed are redrawn
+        markers = {name: [tuple(np.asarray(point, dtype=float)) for point in points] for name, points in markers.items()}
+
+        for name in set(markers.keys()) | set(self.markers.keys()):
+            if markers.get(name) != self.markers.get(name):
+                self.dirty.add(name)
+
+        self.markers = markers
+
+
+    def render(self):
+        # copy the changed tiles from the base and draw their markers, clipped to the tile
+        for name in self.dirty:
+            x, y, width, height = self.tile_rect(name)
+            tile = self.canvas[y:y + height, x:x + width]
+            tile[:] = self.base[y:y + height, x:x + width]
+
+            for point in self.markers.get(name, []):
+                center = (int(round(point[0])) - x, int(round(point[1])) - y)
+                cv2.circle(tile, center, 10, (0, 0, 255), 3)
+
+        self.dirty.clear()
+
+        return self.canvas
@@ -1,12 +1,18 @@
 #!/usr/bin/python3
 
-import numpy as np
 import cv2
-import json
+import argparse
+
+from undistortion import Undistortion
+from calibration_store import CalibrationStore
 
 
 class HomographyCalibration:
-    def __init__(self):
+    def __init__(self, undistort=False):
+        # fit the homographies on undistorted image points instead of the raw pixels
+        self.undistortion = Undistortion() if undistort else None
+        self.store = CalibrationStore()
+        
         # points used for calibration
         self.image_points = {}
         self.world_points = {}
@@ -19,32 +25,39 @@ class HomographyCalibration:
         
     
     def load_image_points(self):
-        with open('results/extrinsic_image_points.json') as f:
-            self.image_points = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.image_points.keys():
-            self.image_points[k] = np.array(self.image_points[k])
+        self.image_points = self.store.section('image_points')
         
         
     def load_world_points(self):
-        with open('results/extrinsic_world_points.json') as f:
-            self.world_points = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.world_points.keys():
-            self.world_points[k] = np.array(self.world_points[k])
+        self.world_points = self.store.section('world_points')
+            
+    
+    def calculate_homography_matrix(self, camera):
+        image_points = self.image_points[camera]
+        if self.undistortion is not None:
+            image_points = self.undistortion.undistort_points(camera, image_points)
             
+        homography, _ = cv2.findHomography(image_points, self.world_points[camera])
+        return homography.tolist()
+    
     
-    def calculate_homography_matrices(self):
-        for camera in self.image_points.keys():
-            homography, _ = cv2.findHomography(self.image_points[camera], self.world_points[camera])
-            self.homographies[camera] = homography.tolist()
+    def calculate_homography_matrices(self, cameras=None):
+        # all cameras with image points by default
+        for camera in cameras or self.image_points.keys():
+            self.homographies[camera] = self.calculate_homography_matrix(camera)
             
     
+    def get_output_section(self):
+        # homographies of undistorted points only apply to undistorted points, keep them apart
+        if self.undistortion is not None:
+            return 'homography_undistorted'
+        return 'homography'
+    
+    
     def save_matrices(self):
-        with open('results/homography.json', 'w') as outfile: 
-            json.dump(self.homographies, outfile)
+        # written to the store and exported to results/homography.json (or homography_undistorted.json)
+        self.store.update(self.get_output_section(), self.homographies, replace=True)
+        self.store.save()
     
     
     def run(self):
@@ -56,5 +69,10 @@ class HomographyCalibration:
 
 
 if __name__ == '__main__':
-    hc = HomographyCalibration()
+    parser = argparse.ArgumentParser(description='Homographies between the camera images and the court plane.')
+    parser.add_argument('--undistort', action='store_true', 
+                        help='fit on undistorted image points, saved to results/homography_undistorted.json')
+    args = parser.parse_args()
+    
+    hc = HomographyCalibration(undistort=args.undistort)
     hc.run()
@@ -2,323 +2,285 @@
 
 import numpy as np
 import cv2 
-import matplotlib.pyplot as plt
-import json
+import argparse
+import time
+
+from image_store import ImageStore
+from grid_compositor import GridCompositor, CAMERA_TILES
+from court_renderer import CourtRenderer
+from projection import HomographyProjection
+from undistortion import Undistortion
+from video_stream import MultiCameraStream
 
 
 class HomographyTool:
-    def __init__(self):
+    def __init__(self, undistort=False):
+        # project through the homographies of undistorted points and the lens distortion of the cameras
+        self.undistort = undistort
+        
         self.original_scale = (3840, 2160)
         self.display_scale = (1920, 1080)
         self.scale_ratio = self.original_scale[0] / self.display_scale[0]
         
+        # display-sized grid of the camera images and the court, only changed tiles are redrawn
+        self.compositor = GridCompositor(self.display_scale)
+        
+        # top view of the court, drawn directly at the size of its tile
+        self.court = CourtRenderer(self.compositor.tile_size('court'))
+        self.court_image = None
+        
+        # camera images, decoded on first use and kept at display resolution
+        self.images = ImageStore()
+        
         self.grid = None
         self.image = None
-        self.clicked_point_in_grid = None
         self.clicked_point_in_image = None
         self.world_point = None
         
+        # interactive mode: camera shown enlarged (None for the grid), mouse events waiting to be handled 
+        # (event, x, y, time) and the time from each click until its result was shown in ms
+        self.enlarged_camera = None
+        self.events = []
+        self.latencies = []
+        
     
     def import_images(self):
-        self.img1 = cv2.imread(f'images/extrinsic_calibration_images/out1.png')
-        self.img2 = cv2.imread(f'images/extrinsic_calibration_images/out2.png')
-        self.img3 = cv2.imread(f'images/extrinsic_calibration_images/out3.png')
-        self.img4 = cv2.imread(f'images/extrinsic_calibration_images/out4.png')
-        self.img5 = cv2.imread(f'images/extrinsic_calibration_images/out5.png')
-        self.img6 = cv2.imread(f'images/extrinsic_calibration_images/out6.png')
-        self.img7 = cv2.imread(f'images/extrinsic_calibration_images/out7.png')
-        self.img8 = cv2.imread(f'images/extrinsic_calibration_images/out8.png')
-        self.img12 = cv2.imread(f'images/extrinsic_calibration_images/out12.png')
-        self.img13 = cv2.imread(f'images/extrinsic_calibration_images/out13.png')
+        # the tiles come from the pre-downscaled thumbnails, full resolution images are only decoded 
+        # if no up to date thumbnail exists
+        for camera in CAMERA_TILES:
+            self.compositor.set_tile(camera, self.images.get_scaled(camera, self.compositor.tile_size(camera)), label=camera)
+            
+        self.compositor.set_text('usage', ['USAGE',
+                                           '- Left click on a point in one of the images',
+                                           '- The point will be shown in all images and on the court',
+                                           '- Right click on an image to enlarge it for',
+                                           '  a precise click, right click again to go back',
+                                           '- Press c to clear the point',
+                                           '- Press q to exit'])
         
         
     def build_grid(self, court):
-        # import court
-        court_rs = cv2.resize(court, (int(self.original_scale[0]*2), int(self.original_scale[1]*2)))
-        
-        # generate black tile
-        black = np.zeros_like(self.img1)
-        
-        # concatenate images 
-        row_1 = np.concatenate((self.img1, self.img2, self.img3, self.img4), axis=1)
-        row_2_left = np.concatenate((self.img5, self.img6), axis=1)
-        row_3_left = np.concatenate((self.img7, self.img8), axis=1)
-        
-        left = np.concatenate((row_2_left, row_3_left), axis=0)
+        # only the court tile changes, the camera tiles are already in place
+        self.compositor.set_tile('court', court)
+        self.grid = self.compositor.render()
         
-        rows_2_3 = np.concatenate((left, court_rs), axis=1)
         
-        row4 = np.concatenate((self.img12, self.img13, black, black), axis=1)
-        
-        # build grid
-        self.grid = np.concatenate((row_1, rows_2_3, row4), axis=0)
-     
-        
-    def annotate_grid(self, image):
-        x_step = int(self.display_scale[0] / 4)
-        y_step = int(self.display_scale[1] / 4)
-        
-        font = cv2.FONT_HERSHEY_SIMPLEX 
-        cv2.putText(image, '1', (10, 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '2', (x_step + 10, 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '3', (2 * x_step + 10, 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '4', (3 * x_step +10, 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '5', (10, y_step + 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '6', (x_step + 10, y_step + 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '7', (10, 2 * y_step + 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '8', (x_step + 10, 2 * y_step + 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '12', (10, 3 * y_step + 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '13', (x_step + 10, 3 * y_step + 30), font, 1, (255, 255, 255), 2)
-        
-        cv2.putText(image, 'USAGE', (2 * x_step + 10, 3 * y_step + 30), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '- Click on one of the images to select a camera', (2 * x_step + 10, 3 * y_step + 70), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '- Press any key to continue', (2 * x_step + 10, 3 * y_step + 100), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '- Click on a point in the image', (2 * x_step + 10, 3 * y_step + 130), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '- Press any key to continue', (2 * x_step + 10, 3 * y_step + 160), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '- The point will be shown in all images and on the court', (2 * x_step + 10, 3 * y_step + 190), font, 1, (255, 255, 255), 2)
-        cv2.putText(image, '- Press any key to exit', (2 * x_step + 10, 3 * y_step + 220), font, 1, (255, 255, 255), 2)
-    
-        return image
-        
-        
-    def display_grid(self):
-        court = cv2.imread('images/court.png')
-        
-        self.build_grid(court)
-
-        # display
-        cv2.namedWindow('cluster', cv2.WINDOW_NORMAL)
-        cv2.setWindowProperty('cluster', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+    def display_enlarged_image(self, camera):
+        # the image of a camera at display size, with the current point if it is visible
+        self.image = self.images.get_scaled(camera, self.display_scale).copy()
+        
+        if self.world_point is not None:
+            image_points, visible = self.projection.world_to_image(self.world_point, [camera])
+            if visible[0, 0]:
+                # displaying the coordinates on the image
+                x, y = (image_points[0, 0] / self.scale_ratio).astype(int)
+                cv2.circle(self.image, (x, y), 3, (255, 0, 0), 4)
+                cv2.putText(self.image, f'{int(image_points[0, 0, 0])}, {int(image_points[0, 0, 1])}', (x, y), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2)
+                
+        cv2.putText(self.image, camera, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
         
-        grid_rs = cv2.resize(self.grid, self.display_scale)
-        grid_rs = self.annotate_grid(grid_rs)
-        cv2.imshow('cluster', grid_rs) 
     
-
-    def click_grid(self, event, x, y, flags, params): 
-        # checking for left mouse clicks 
-        if event == cv2.EVENT_LBUTTONDOWN: 
-            # displaying the coordinates on the shell 
-            self.clicked_point_in_grid = np.array([x, y])
-            print(f'Clicked Point in Grid: {self.clicked_point_in_grid}')
-        
-        
-    def select_camera(self):
-        # size of one image in grid
-        tile_width = self.display_scale[0] / 4
-        tile_height = self.display_scale[1] / 4
-        
-        # position of clicked point
-        x = self.clicked_point_in_grid[0]
-        y = self.clicked_point_in_grid[1]
+    def click_event(self, event, x, y, flags, params): 
+        # only queue the clicks, they are handled in the event loop
+        if event in (cv2.EVENT_LBUTTONDOWN, cv2.EVENT_RBUTTONDOWN): 
+            self.events.append((event, x, y, time.perf_counter()))
+            
+            
+    def handle_event(self, event, x, y):
+        # left click: select the point, right click: enlarge a camera or go back to the grid
+        if self.enlarged_camera is not None:
+            if event == cv2.EVENT_LBUTTONDOWN:
+                self.query_point(self.enlarged_camera, np.array([x, y]) * self.scale_ratio)
+            else:
+                self.enlarged_camera = None
+            return
         
         # find out in which camera's tile the click was
-        if x < tile_width:
-            # 1, 5, 7, 12 - first column
-            if y < tile_height:
-                return '1'
-            elif y < 2 * tile_height:
-                return '5'
-            elif y < 3 * tile_height:
-                return '7'
-            else:
-                return '12'
-        elif x < 2 * tile_width:
-            # 2, 6, 8, 13 - second column
-            if y < tile_height:
-                return '2'
-            elif y < 2 * tile_height:
-                return '6'
-            elif y < 3 * tile_height:
-                return '8'
-            else:
-                return '13'
-        elif x < 3 * tile_width:
-            # 3 - third column
-            if y < tile_height:
-                return '3'
+        camera = self.compositor.tile_at((x, y))
+        if camera not in CAMERA_TILES:
+            return
+        
+        if event == cv2.EVENT_LBUTTONDOWN:
+            self.query_point(camera, self.compositor.grid_to_image(camera, (x, y), self.original_scale))
         else:
-            # 4 - fourth column
-            if y < tile_height:
-                return '4'
+            self.enlarged_camera = camera
+            
+            
+    def query_point(self, camera, image_point):
+        # world position of a point in a camera's image (original resolution) and its position in all cameras
+        self.clicked_point_in_image = np.asarray(image_point, dtype=float)
+        print(f'Clicked Point in Image of Camera {camera}: {self.clicked_point_in_image.astype(int)}')
+        self.get_world_point(camera)
         
-
-    def display_enlarged_image(self, camera):
-        # display the image of the selected camera in fullscreen
-        cv2.namedWindow('image', cv2.WINDOW_NORMAL)
-        cv2.setWindowProperty('image', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-        self.image = cv2.imread(f'images/extrinsic_calibration_images/out{camera}.png')
-        image_rs = cv2.resize(self.image, self.display_scale) 
-        cv2.imshow('image', image_rs)
+        self.compositor.set_markers({camera: [point] for camera, point in self.calculate_image_positions().items()})
+        self.plot_world_point_on_court()
         
-    
-    def click_event(self, event, x, y, flags, params): 
-        # checking for left mouse clicks 
-        if event == cv2.EVENT_LBUTTONDOWN: 
-            # get clicked point 
-            self.clicked_point_in_image = np.array([int(self.scale_ratio * x), int(self.scale_ratio * y), 1])
-            print(f'Clicked Point in Image: {self.clicked_point_in_image}') 
-    
-            # displaying the coordinates on the image window 
-            font = cv2.FONT_HERSHEY_SIMPLEX 
-            image_rs = cv2.resize(self.image, self.display_scale)
-            cv2.circle(image_rs, (x, y), 3, (255, 0, 0), 4)
-            cv2.putText(image_rs, f'{self.clicked_point_in_image[0]}, {self.clicked_point_in_image[1]}', (x,y), 
-                        font, 1, (255, 0, 0), 2)
-            cv2.imshow('image', image_rs) 
+        
+    def clear_point(self):
+        self.world_point = None
+        self.compositor.set_markers({})
+        self.plot_unmarked_court()
             
             
     def get_world_point(self, camera):
-        # use homography matrix of selected point to transform from image to world coordinates
-        homography_matrix = self.homographies[camera]
-        world_point = np.dot(homography_matrix, self.clicked_point_in_image)
-        self.world_point = world_point / world_point[2] / 1000
+        # use homography matrix of selected point to transform from image to world coordinates (meters)
+        world_points, _ = self.projection.image_to_world(camera, self.clicked_point_in_image[:2])
+        self.world_point = world_points[0]
         print(f'World Point: {self.world_point}')
         
     
     def import_homographies(self):
-        with open('results/homography.json') as f:
-            self.homographies = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.homographies.keys():
-            self.homographies[k] = np.array(self.homographies[k])
+        # forward and inverse homographies of all cameras, computed once
+        undistortion = Undistortion(image_scale=self.original_scale) if self.undistort else None
+        self.projection = HomographyProjection(image_scale=self.original_scale, undistortion=undistortion)
         
         
     def calculate_image_positions(self):
-        # get position in every image using the homography matrices
+        # get position in every image using the homography matrices, all cameras at once
+        image_points, visible = self.projection.world_to_image(self.world_point)
+        
         markers = {}
-        for camera in self.homographies.keys():
-            image_point = np.dot(np.linalg.inv(self.homographies[camera]), self.world_point)
-            image_point = (image_point / image_point[2])[:2]
-            
+        for camera, image_point, is_visible in zip(self.projection.cameras, image_points[:, 0], visible[:, 0]):
             # check if the point is visible in the camera's image
-            if 0 < image_point[0] < self.original_scale[0] and 0 < image_point[1] < self.original_scale[1]:
-                markers[camera] = image_point / self.scale_ratio / 4  # because grid is 4x4 -> scale to one tile
-                
-        # distribute over grid
-        scale_x = self.display_scale[0] / 4
-        scale_y = self.display_scale[1] / 4
-        
-        for marker in markers.keys():
-            if marker in ['1', '5', '7', '12']:  # first column
-                if marker == '5':
-                    markers[marker] += np.array([0, scale_y])
-                elif marker == '7':
-                    markers[marker] += np.array([0, 2 * scale_y])
-                elif marker == '12':
-                    markers[marker] += np.array([0, 3 * scale_y])
-            elif marker in ['2', '6', '8', '13']:  # second column
-                if marker == '2':
-                    markers[marker] += np.array([scale_x, 0])
-                elif marker == '6':
-                    markers[marker] += np.array([scale_x, scale_y])
-                elif marker == '8':
-                    markers[marker] += np.array([scale_x, 2 * scale_y])
-                elif marker == '13':
-                    markers[marker] += np.array([scale_x, 3 * scale_y])
-            elif marker == '3':  # third column
-                markers[marker] += np.array([2 * scale_x, 0])
-            elif marker == '4':  # fourth column
-                markers[marker] += np.array([3 * scale_x, 0])
+            if is_visible:
+                # position in the camera's tile of the grid
+                markers[camera] = self.compositor.image_to_grid(camera, image_point, self.original_scale)
                 
         return markers
     
     
-    def plot_court(self):
-        # plot the court
-        plt.scatter([0, 0, 6, 6, 9, 9, 12, 12, 18, 18], [0, 9, 0, 9, 0, 9, 0, 9, 0, 9], color='blue')
-        plt.plot([0, 0], [0, 9], 'blue')
-        plt.plot([6, 6], [0, 9], 'blue')
-        plt.plot([9, 9], [0, 9], 'blue')
-        plt.plot([12, 12], [0, 9], 'blue')
-        plt.plot([18, 18], [0, 9], 'blue')
-        plt.plot([0, 18], [0, 0], 'blue')
-        plt.plot([0, 18], [9, 9], 'blue')
-
-        # set axis limits
-        plt.xlim((-5, 23))
-        plt.ylim((-5, 14))
-
-        # invert the y axis so origin is in top left corner
-        plt.gca().invert_yaxis()
-
-        
     def plot_unmarked_court(self):
-        self.plot_court()
-        
-        # save
-        plt.savefig('images/court.png', dpi=600)
+        # the court is drawn once by the renderer and reused
+        self.court_image = self.court.base
         
      
     def plot_world_point_on_court(self):
-        self.plot_court()
-        
-        # plot the point
-        plt.scatter(self.world_point[0], self.world_point[1], color='red')
-
-        # save
-        plt.savefig('images/marked_court.png', dpi=600)
+        # copy of the cached court with the point drawn on top
+        self.court_image = self.court.render([self.world_point])
         
     
-    def display_marked_grid(self, markers):    
-        # generate new grid using the court plot with the world position    
-        marked_court = cv2.imread('images/marked_court.png')
-        marked_court_rs = cv2.resize(marked_court, (int(self.original_scale[0]*2), int(self.original_scale[1]*2)))
-        
-        self.build_grid(marked_court_rs)
-        
-        # new window
-        cv2.namedWindow('marked_cluster', cv2.WINDOW_NORMAL)
-        cv2.setWindowProperty('marked_cluster', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
-        
-        grid_rs = cv2.resize(self.grid, self.display_scale)
-        
-        grid_rs = self.annotate_grid(grid_rs)
-        
-        # create circles around positions in the camera tiles
-        for point in markers.values(): 
-            cv2.circle(grid_rs, point.astype(int), 10, (0, 0, 255), 3)
+    def display(self):
+        # the grid (only the changed tiles are redrawn) or the enlarged camera
+        if self.enlarged_camera is None:
+            self.build_grid(self.court_image)
+            cv2.imshow('cluster', self.grid)
+        else:
+            self.display_enlarged_image(self.enlarged_camera)
+            cv2.imshow('cluster', self.image)
+            
             
-        cv2.imshow('marked_cluster', grid_rs) 
+    def report_latencies(self):
+        if not self.latencies:
+            return
+        
+        latencies = np.array(self.latencies)
+        print(f'Interactions: {len(latencies)}, latency from click to display: mean {latencies.mean():.1f} ms, '
+              f'p95 {np.percentile(latencies, 95):.1f} ms, max {latencies.max():.1f} ms')
         
     
     def run(self):
         print('HOMOGRAPHY TOOL')
         print('Usage:')
-        print('\t-A grid of images is displayed. Click on one of the images using the left mouse key, then press q.')
-        print('\t-A single image is displayed. Click on a point, then press q.')
-        print('\t-A grid of images is displayed. The clicked point from the single camera is visualized in all other cameras and on the court. Press q to exit.\n')
+        print('\t-A grid of images is displayed. Left click on a point in one of the images.')
+        print('\t-The point is visualized in all other cameras and on the court. Click again for the next point.')
+        print('\t-Right click on an image to enlarge it for a precise click, right click again to return to the grid.')
+        print('\t-Press c to clear the point, q to exit.\n')
         
-        # display grid and wait until a camera is picked
+        # images and homographies are loaded once, every click afterwards only redraws what changed
         self.import_images()
+        self.import_homographies()
         self.plot_unmarked_court()
-        self.display_grid()
-        cv2.setMouseCallback('cluster', self.click_grid) 
-        cv2.waitKey(0)
         
-        camera = self.select_camera()
-        print(f'Selected camera: {camera}')
-        
-        # display the camera's image in fullscreen and wait until a point is picked
-        self.display_enlarged_image(camera)
-        cv2.setMouseCallback('image', self.click_event) 
-        cv2.waitKey(0)
+        cv2.namedWindow('cluster', cv2.WINDOW_NORMAL)
+        cv2.setWindowProperty('cluster', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        cv2.setMouseCallback('cluster', self.click_event) 
+        self.display()
+        
+        try:
+            while True:
+                key = cv2.waitKey(1) & 0xFF
+                if key in (ord('q'), 27):
+                    break
+                
+                if key == ord('c'):
+                    self.clear_point()
+                    self.display()
+                
+                if self.events:
+                    events, self.events = self.events, []
+                    for event, x, y, _ in events:
+                        self.handle_event(event, x, y)
+                    self.display()
+                    
+                    now = time.perf_counter()
+                    self.latencies.extend(1000 * (now - clicked) for _, _, _, clicked in events)
+        finally:
+            cv2.destroyAllWindows() 
+            self.report_latencies()
+        
+        
+    def click_live(self, event, x, y, flags, params):
+        # a click on a camera tile of the live grid selects the point in that camera's image
+        if event == cv2.EVENT_LBUTTONDOWN:
+            camera = self.compositor.tile_at((x, y))
+            if camera in CAMERA_TILES:
+                self.query_point(camera, self.compositor.grid_to_image(camera, (x, y), self.original_scale))
+                self.compositor.set_tile('court', self.court_image)
+                
         
-        # calculate the world position and the image position in all other cameras
+    def run_live(self, video_dir='input/videos', fps=25, start_time=0.0):
+        # play the videos of all cameras in the grid, the clicked point stays marked in all of them
         self.import_homographies()
-        self.get_world_point(camera)
-        markers = self.calculate_image_positions()
-        self.plot_world_point_on_court()
-        
-        # show the selected point in all cameras and on the court
-        self.display_marked_grid(markers)
-        cv2.waitKey(0)
-        
-        cv2.destroyAllWindows() 
+        self.plot_unmarked_court()
+        self.compositor.set_tile('court', self.court_image)
+        self.compositor.set_text('usage', ['USAGE',
+                                           '- Click on a point in one of the videos',
+                                           '- The point will be shown in all videos and on the court',
+                                           '- Press q to exit'])
+        
+        # frames are downscaled to the tile size in the reader threads already
+        stream = MultiCameraStream(CAMERA_TILES, video_dir=video_dir, frame_size=self.compositor.tile_size(CAMERA_TILES[0]),
+                                   start_time=start_time)
+        
+        cv2.namedWindow('live', cv2.WINDOW_NORMAL)
+        cv2.setWindowProperty('live', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        cv2.setMouseCallback('live', self.click_live)
+        
+        stream.start()
+        frame_time = 1 / fps
+        try:
+            while not stream.finished():
+                start = time.perf_counter()
+                
+                # only cameras with a new frame get their tile replaced
+                for camera, frame in stream.read().items():
+                    self.compositor.set_tile(camera, frame, label=camera)
+                self.grid = self.compositor.render()
+                cv2.imshow('live', self.grid)
+                
+                # wait for the rest of the frame time, but at least 1 ms for the window events
+                remaining = frame_time - (time.perf_counter() - start)
+                if cv2.waitKey(max(1, int(1000 * remaining))) & 0xFF in (ord('q'), 27):
+                    break
+        finally:
+            stream.stop()
+            cv2.destroyAllWindows()
+            stream.report()
         
     
 
 if __name__ == '__main__':
-     ht = HomographyTool()
-     ht.run()
+     parser = argparse.ArgumentParser(description='Show a clicked point in all cameras and on the court.')
+     parser.add_argument('--undistort', action='store_true', 
+                         help='use results/homography_undistorted.json and the distortion of the cameras')
+     parser.add_argument('--live', action='store_true', help='play the videos in input/videos instead of the still images')
+     parser.add_argument('--fps', type=float, default=25, help='display rate of the live mode')
+     parser.add_argument('--start', type=float, default=0, help='start time of the live mode in seconds')
+     args = parser.parse_args()
+     
+     ht = HomographyTool(undistort=args.undistort)
+     if args.live:
+         ht.run_live(fps=args.fps, start_time=args.start)
+     else:
+         ht.run()
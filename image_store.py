@@ -0,0 +1,93 @@
+import numpy as np
+import cv2
+import os
+from collections import OrderedDict
+
+
+class ImageStore:
+    def __init__(self, image_dir='images/extrinsic_calibration_images', thumbnail_dir='images/thumbnails', cache_size=32):
+        self.image_dir = image_dir
+        self.thumbnail_dir = thumbnail_dir
+
+        # downscaled images in least recently used order: (camera, (width, height)), image
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+
+    def image_path(self, camera):
+        return f'{self.image_dir}/out{camera}.png'
+
+
+    def thumbnail_path(self, camera, size):
+        return f'{self.thumbnail_dir}/out{camera}_{size[0]}x{size[1]}.npy'
+
+
+    def get(self, camera):
+        # full resolution image, decoded from disk every time
+        return cv2.imread(self.image_path(camera))
+
+
+    def get_scaled(self, camera, size):
+        # image scaled to size (width, height), from memory, else from the thumbnail on disk, else
+        # decoded from the full resolution image
+        key = (camera, tuple(size))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        image = self.load_thumbnail(camera, size)
+        if image is None:
+            image = self.create_thumbnail(camera, size)
+
+        self.cache[key] = image
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return image
+
+
+    def load_thumbnail(self, camera, size):
+        # stored thumbnails are raw arrays, loading them needs no decoding - they are only used as long
+        # as they are newer than the image
+        path = self.thumbnail_path(camera, size)
+        if not os.path.exists(path):
+            return None
+        if os.path.exists(self.image_path(camera)) and os.path.getmtime(path) < os.path.getmtime(self.image_path(camera)):
+            return None
+
+        return np.load(path)
+
+
+    def create_thumbnail(self, camera, size):
+        image = self.get(camera)
+        if image is None:
+            # no image for this camera, show a black tile
+            print(f'Image of camera {camera} not found.')
+            return np.zeros((size[1], size[0], 3), np.uint8)
+
+        return self.save_thumbnail(camera, image, size)
+
+
+    def save_thumbnail(self, camera, image, size):
+        thumbnail = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        path = self.thumbnail_path(camera, size)
+        np.save(f'{path}.tmp.npy', thumbnail)
+        os.replace(f'{path}.tmp.npy', path)
+
+        return thumbnail
+
+
+    def save(self, camera, image, sizes=()):
+        # full resolution image and its thumbnails, the thumbnails are scaled from the given image instead
+        # of decoding the written file again - written after the image, so they count as up to date
+        os.makedirs(self.image_dir, exist_ok=True)
+        path = self.image_path(camera)
+        cv2.imwrite(f'{path}.tmp.png', image)
+        os.replace(f'{path}.tmp.png', path)
+
+        for key in [key for key in self.cache.keys() if key[0] == camera]:
+            del self.cache[key]
+        for size in sizes:
+            self.save_thumbnail(camera, image, size)
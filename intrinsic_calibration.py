@@ -2,102 +2,271 @@
 
 import cv2
 import numpy as np
-import json
+import os
+import sys
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
+from corner_cache import CornerCache
+from view_selection import ViewSelection
+from calibration_store import CalibrationStore
+from frame_extraction import FrameExtraction
+
+
+# all cameras of the setup
+CAMERAS = ['1', '2', '3', '4', '5', '6', '7', '8', '12', '13']
+
+
+def get_chessboard_size(camera):
+    # (columns, rows) of inner corners of the chessboard used for the camera
+    if camera in ['5', '6', '8']:
+        return 9, 6
+    else:
+        return 7, 5
+
+
+def find_chessboard_corners(gray_frame, pattern_size, criteria, detection_scale=None, fast_check=False):
+    # look for the chessboard on a downscaled copy of the frame (detection_scale, None = full resolution), 
+    # most frames contain no board and are rejected there cheaply
+    flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE
+    if fast_check:
+        flags += cv2.CALIB_CB_FAST_CHECK
+    
+    if detection_scale is None or detection_scale >= 1:
+        ret, corners = cv2.findChessboardCorners(gray_frame, pattern_size, flags=flags)
+    else:
+        small_frame = cv2.resize(gray_frame, None, fx=detection_scale, fy=detection_scale, interpolation=cv2.INTER_AREA)
+        ret, corners = cv2.findChessboardCorners(small_frame, pattern_size, flags=flags)
+        
+        if ret:
+            # scale the coarse corners back to full resolution (pixel centers are at integer coordinates)
+            corners = (corners + 0.5) / detection_scale - 0.5
+    
+    if not ret:
+        return None
+    
+    # refine them (in place) on the full resolution frame
+    return cv2.cornerSubPix(gray_frame, corners, (11,11), (-1,-1), criteria)  # todo: choose better params
+
+
+def find_chessboard_corners_in_shared_memory(shm_name, shape, pattern_size, criteria, detection_scale, fast_check):
+    # attach to the frame buffer written by the main process instead of receiving a pickled copy
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        gray_frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        result = find_chessboard_corners(gray_frame, pattern_size, criteria, detection_scale, fast_check)
+        del gray_frame  # release the buffer before closing
+        return result
+    finally:
+        shm.close()
+
+
+def calibrate_camera_process(camera, options):
+    # calibrate a single camera in a worker process of the multi-camera scheduler
+    ic = IntrinsicCalibration(cameras=[camera], **options)
+    return ic.calibrate_single_camera(camera)
 
 
 class IntrinsicCalibration:
-    def __init__(self, cameras):
+    def __init__(self, cameras, detection_workers=1, detection_scale=None, fast_check=False, detection_skip=5, 
+                 max_views=None):
         self.cameras = cameras
         
+        # settings, passed on to the worker processes of the multi-camera scheduler
+        self.options = {
+            'detection_workers': detection_workers,
+            'detection_scale': detection_scale,
+            'fast_check': fast_check,
+            'detection_skip': detection_skip,
+            'max_views': max_views
+        }
+        
+        # number of processes used for chessboard detection, 1 = detect in this process
+        self.detection_workers = detection_workers
+        
+        # coarse search for the chessboard on frames downscaled by this factor (None = full resolution)
+        self.detection_scale = detection_scale
+        self.fast_check = fast_check
+        
+        # search every detection_skip-th sampled frame for a chessboard
+        self.detection_skip = detection_skip
+        
+        # calibrate with at most this many views, selected for diverse poses and image coverage (None = all)
+        self.max_views = max_views
+        
         self.intrinsic_matrices = {}
         self.intrinsic_matrices_refined = {}
         self.distortions = {}
+        self.failed = {}  # camera: why it could not be calibrated
         
         
-    def get_frames(self, camera):
-        # import video 
-        cap = cv2.VideoCapture(f'input/chessboard_videos/out{camera}F.mp4')
-
-        # get number of frames
+    def get_video_path(self, camera):
+        return f'input/chessboard_videos/out{camera}F.mp4'
+    
+    
+    def get_video_info(self, camera):
+        # number of frames and (height, width) from the container, nothing is decoded
+        cap = cv2.VideoCapture(self.get_video_path(camera))
         amount_of_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        start_frame = 1000
-
-        # Set the frame skip interval
-        frame_skip = 15
-
-        # save frames to array 
-        frames = []
-        gray_frames = []
-        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        image_shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        cap.release()
         
-        for i in range(start_frame, amount_of_frames):  
-            ret, frame = cap.read()
-            if i % frame_skip == 0:        
-                if not ret:
+        return amount_of_frames, image_shape
+    
+    
+    def get_frame_ids(self, amount_of_frames, start_frame=1000, frame_skip=15, detection_skip=5):
+        # every frame_skip-th frame is sampled and of those only every detection_skip-th one
+        # is searched for a chessboard
+        first_frame = start_frame + (-start_frame % frame_skip)
+        
+        return list(range(first_frame, amount_of_frames, frame_skip * detection_skip))
+    
+    
+    def get_frames(self, camera, frame_ids):
+        # import video 
+        cap = cv2.VideoCapture(self.get_video_path(camera))
+        
+        # decode only the requested frames and grab (no decoding) the ones in between
+        frame_ids = sorted(frame_ids)
+        if not frame_ids:
+            return
+        
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_ids[0])
+        wanted = set(frame_ids)
+        
+        try:
+            for i in range(frame_ids[0], frame_ids[-1] + 1):
+                if not cap.grab():
                     print("Can't receive frame (stream end?). Exiting ...")
                     break
                 
-                # convert frame to grayscale
-                gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                if i not in wanted:
+                    continue
                 
-                frames.append(frame)
-                gray_frames.append(gray_frame)
-
-        cap.release()
-        cv2.destroyAllWindows() # destroy all opened windows
-        
-        return frames, gray_frames
+                ret, frame = cap.retrieve()
+                if not ret:
+                    print("Can't receive frame (stream end?). Exiting ...")
+                    break
+                
+                # convert frame to grayscale and hand it on right away
+                yield i, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        finally:
+            cap.release()
         
         
     def detect_chessboards(self, camera, gray_frames):
         # go through the frames and try to detect a checkerboard in them
-        corners_detected = {}  # frame_id, corners
+        corners_detected = {}  # frame_id, corners (None if there is no chessboard)
         
         # termination criteria
         criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)  # todo: choose better params
 
-        if camera in ['5', '6', '8']:
-            chessboard_width = 6
-            chessboard_height = 9
+        pattern_size = get_chessboard_size(camera)
+        
+        if self.detection_workers > 1:
+            detections = self.detect_chessboards_parallel(gray_frames, pattern_size, criteria)
         else:
-            chessboard_width = 5
-            chessboard_height = 7
+            detections = self.detect_chessboards_serial(gray_frames, pattern_size, criteria)
+        
+        for i, _, corners in detections:
+            corners_detected[i] = corners
+
+        print(f'Number of frames where corners were detected: {sum(c is not None for c in corners_detected.values())}')   
+        
+        return corners_detected
+    
+    
+    def get_corners(self, camera):
+        # detected corners of every searched frame, read from the corner cache where possible so 
+        # only frames that are not cached yet are decoded
+        cache = CornerCache(camera, self.get_video_path(camera), get_chessboard_size(camera), 
+                            self.detection_scale, self.fast_check)
+        
+        if cache.frame_count is None:
+            cache.set_video_info(*self.get_video_info(camera))
+        
+        frame_ids = self.get_frame_ids(cache.frame_count, detection_skip=self.detection_skip)
+        missing = cache.missing(frame_ids)
+        print(f'Corners of {len(frame_ids) - len(missing)} of {len(frame_ids)} frames found in the cache.')
+        
+        if missing:
+            for i, corners in self.detect_chessboards(camera, self.get_frames(camera, missing)).items():
+                cache.add(i, corners)
+            cache.save()
+        
+        return {i: cache.corners[i] for i in frame_ids if i in cache.corners}, cache.image_shape
+    
+    
+    def get_calibration_points(self, camera, corners_detected):
+        chessboard_height, chessboard_width = get_chessboard_size(camera)
 
         # prepare object points
         object_points = np.zeros((chessboard_width * chessboard_height, 3), np.float32)
         object_points[:,:2] = np.mgrid[0:chessboard_height, 0:chessboard_width].T.reshape(-1,2) 
 
- 
         # Arrays to store object points and image points from all the images.
         obj_points = [] # 3d point in real world space
         img_points = [] # 2d points in image plane.
-
-        i = 0
-        while i < len(gray_frames):
-            # Find the chess board corners
-            ret, corners = cv2.findChessboardCorners(gray_frames[i], (chessboard_height, chessboard_width), None)
-            
-            if ret:
-                # If found, add object points, image points (after refining them)
+        
+        for i in sorted(corners_detected.keys()):
+            if corners_detected[i] is not None:
                 obj_points.append(object_points)
+                img_points.append(corners_detected[i])
                 
-                corners_refined = cv2.cornerSubPix(gray_frames[i], corners, (11,11), (-1,-1), criteria)  # todo: choose better params
-                corners_detected[i] = corners_refined
-                
-                img_points.append(corners)
-                
-                i += 5
-            else:
-                i += 5  # skip the next five frames
-
-        print(f'Number of frames where corners were detected: {len(corners_detected)}')   
+        return obj_points, img_points
+    
+    
+    def detect_chessboards_serial(self, gray_frames, pattern_size, criteria):
+        # frames arrive one by one from the sampler, so only one is held in memory at a time
+        for i, gray_frame in gray_frames:
+            corners = find_chessboard_corners(gray_frame, pattern_size, criteria, self.detection_scale, self.fast_check)
+            yield i, gray_frame.shape[:2], corners
+            
+    
+    def detect_chessboards_parallel(self, gray_frames, pattern_size, criteria):
+        # frames are copied into a fixed ring of shared memory slots, two per worker, so the workers
+        # read them without pickling and at most that many frames are held in memory at once
+        slots = []
+        free_slots = []
+        pending = deque()  # frame_id, shape, slot, future - in submission order
         
-        return obj_points , img_points
+        try:
+            with ProcessPoolExecutor(max_workers=self.detection_workers) as executor:
+                for i, gray_frame in gray_frames:
+                    if not slots:
+                        slots = [shared_memory.SharedMemory(create=True, size=gray_frame.nbytes) 
+                                 for _ in range(2 * self.detection_workers)]
+                        free_slots = list(slots)
+                    
+                    # wait for the oldest frame if all slots are in use
+                    if not free_slots:
+                        frame_id, shape, slot, future = pending.popleft()
+                        free_slots.append(slot)
+                        yield frame_id, shape, future.result()
+                    
+                    slot = free_slots.pop()
+                    np.ndarray(gray_frame.shape, dtype=np.uint8, buffer=slot.buf)[:] = gray_frame
+                    future = executor.submit(find_chessboard_corners_in_shared_memory, 
+                                             slot.name, gray_frame.shape, pattern_size, criteria, 
+                                             self.detection_scale, self.fast_check)
+                    pending.append((i, gray_frame.shape[:2], slot, future))
+                
+                # results are collected in submission order, so the ordering matches the serial path
+                while pending:
+                    frame_id, shape, slot, future = pending.popleft()
+                    yield frame_id, shape, future.result()
+        finally:
+            for slot in slots:
+                slot.close()
+                slot.unlink()
         
         
     def calibrate_camera(self, obj_points, img_points, frame_shape, img_shape):
         # calibrate camera
-        ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(obj_points, img_points, frame_shape, None, None)
+        rms, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(obj_points, img_points, frame_shape, None, None)
+        print(f'RMS reprojection error: {rms}')
         print(f'Camera Matrix: {mtx}')
         print(f'Distortion: {dist}')
         
@@ -107,67 +276,194 @@ class IntrinsicCalibration:
         newcameramtx, roi = cv2.getOptimalNewCameraMatrix(mtx, dist, (w,h), 1, (w,h))
         print(f'Refined camera matrix: {newcameramtx}')
         
-        return mtx, dist, newcameramtx
+        # the poses of the views are kept for the evaluation of the reprojection errors
+        return mtx, dist, newcameramtx, rms, rvecs, tvecs
 
 
     def save_matrices(self):
-        with open('results/intrinsic.json', 'w') as outfile: 
-            json.dump(self.intrinsic_matrices, outfile)
+        # merge the calibrated cameras into the existing results, so calibrating a subset of the cameras 
+        # does not drop the others - the store writes all files at once, exported to the JSON files as well
+        store = CalibrationStore()
+        store.update('intrinsic', self.intrinsic_matrices)
+        store.update('distortions', self.distortions)
+        store.update('intrinsic_refined', self.intrinsic_matrices_refined)
+        store.save()
+            
+            
+    def save_views(self, camera, views):
+        # views used for the calibration with their poses, read by evaluation.py
+        os.makedirs('results/intrinsic_views', exist_ok=True)
+        path = f'results/intrinsic_views/out{camera}.npz'
+        
+        with open(f'{path}.tmp', 'wb') as outfile:
+            np.savez(outfile, **views)
+        os.replace(f'{path}.tmp', path)
+    
+    
+    def calibrate_single_camera(self, camera):
+        print(f'Calibrating camera {camera}...')
+        corners_detected, image_shape = self.get_corners(camera)
+        object_points, image_points = self.get_calibration_points(camera, corners_detected)
+        frame_ids = [i for i in sorted(corners_detected.keys()) if corners_detected[i] is not None]
+        if not image_points:
+            reason = 'video not found' if not os.path.exists(self.get_video_path(camera)) else 'no chessboard detected'
+            raise ValueError(f'{reason} for camera {camera}')
+        
+        if self.max_views is not None and len(image_points) > self.max_views:
+            views = ViewSelection(image_shape).select(object_points, image_points, self.max_views)
+            print(f'Selected {len(views)} of {len(image_points)} views.')
+            object_points = [object_points[i] for i in views]
+            image_points = [image_points[i] for i in views]
+            frame_ids = [frame_ids[i] for i in views]
         
-        with open('results/distortions.json', 'w') as outfile: 
-            json.dump(self.distortions, outfile)
+        intrinsic_matrix, distortion, intrinsic_refined, rms, rvecs, tvecs = self.calibrate_camera(object_points, 
+                                                                                                   image_points, 
+                                                                                                   image_shape[::-1], 
+                                                                                                   image_shape)
+        print(f'...Done with camera {camera}.')
         
-        with open('results/intrinsic_refined.json', 'w') as outfile: 
-            json.dump(self.intrinsic_matrices_refined, outfile)
+        views = {
+            'frame_ids': np.array(frame_ids),
+            'object_points': np.array(object_points, dtype=np.float32),
+            'image_points': np.array(image_points, dtype=np.float32).reshape(len(image_points), -1, 2),
+            'rvecs': np.array(rvecs).reshape(-1, 3),
+            'tvecs': np.array(tvecs).reshape(-1, 3),
+            'rms': np.array(rms)
+        }
+        
+        return intrinsic_matrix.tolist(), distortion.tolist(), intrinsic_refined.tolist(), views
+    
+    
+    def view_report(self, camera, sizes=(10, 20, 40, 60, 100)):
+        # trade-off between solve time and reprojection error for different numbers of selected views
+        print(f'Views of camera {camera}:')
+        corners_detected, image_shape = self.get_corners(camera)
+        object_points, image_points = self.get_calibration_points(camera, corners_detected)
+        
+        return ViewSelection(image_shape).report(object_points, image_points, sizes)
+    
+    
+    def estimate_memory(self, camera):
+        # rough peak memory of one camera's pipeline in bytes: the decoder's frame buffers, 
+        # the current BGR and grayscale frame and the shared memory slots of the detection
+        _, (height, width) = self.get_video_info(camera)
+        
+        decoder_frames = 8
+        gray_frames = 1 + (2 * self.detection_workers if self.detection_workers > 1 else 0)
+        
+        return width * height * (3 * (decoder_frames + 1) + gray_frames)
     
     
-    def calibrate(self):
+    def calibrate(self, workers=1, memory_budget=None):
+        # calibrate up to `workers` cameras at once while their estimated memory stays within 
+        # memory_budget (bytes, None = unlimited) - cameras without video or chessboard views are skipped, 
+        # the others are saved all the same, returns the skipped cameras
+        if workers <= 1:
+            results = {}
+            for camera in self.cameras:
+                try:
+                    results[camera] = self.calibrate_single_camera(camera)
+                except (ValueError, cv2.error) as error:
+                    self.fail(camera, error)
+        else:
+            results = self.calibrate_concurrently(workers, memory_budget)
+            
         for camera in self.cameras:
-            print(f'Calibrating camera {camera}...')
-            frames, gray_frames = self.get_frames(camera)
-            object_points, image_points = self.detect_chessboards(camera, gray_frames)
+            if camera not in results:
+                continue
+            intrinsic_matrix, distortion, intrinsic_refined, views = results[camera]
+            self.intrinsic_matrices[camera] = intrinsic_matrix
+            self.distortions[camera] = distortion
+            self.intrinsic_matrices_refined[camera] = intrinsic_refined
+            self.save_views(camera, views)
+    
+        if results:
+            self.save_matrices()
+        if self.failed:
+            print(f'Skipped camera(s) {", ".join(self.failed.keys())}: {"; ".join(self.failed.values())}')
             
-            intrinsic_matrix, distortion, intrinsic_refined = self.calibrate_camera(object_points, 
-                                                                                    image_points, 
-                                                                                    gray_frames[0].shape[::-1], 
-                                                                                    frames[0].shape[:2])
-
-            self.intrinsic_matrices[camera] = intrinsic_matrix.tolist()
-            self.distortions[camera] = distortion.tolist()
-            self.intrinsic_matrices_refined[camera] = intrinsic_refined.tolist()
-            print('...Done.')
+        return list(self.failed.keys())
     
-        self.save_matrices()
     
+    def fail(self, camera, error):
+        print(f'Could not calibrate camera {camera}: {error}')
+        self.failed[camera] = str(error)
+        
     
-    def extract_extrinsic_calibration_images(self):
-        import moviepy.editor as mpy
-        
-        # specify times
-        times = {
-            '1': '00:00:56',
-            '2': '00:01:49',
-            '3': '00:04:02',
-            '4': '00:05:08',
-            '5': '00:04:13',
-            '6': '00:04:06',
-            '7': '00:02:25',
-            '8': '00:04:41',
-            '12': '00:04:24',
-            '13': '00:04:23'
-        }
+    def calibrate_concurrently(self, workers, memory_budget):
+        queue = deque((camera, self.estimate_memory(camera)) for camera in self.cameras)
+        running = {}  # future: (camera, estimated memory)
+        results = {}
         
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while queue or running:
+                # start as many cameras as the worker count and the memory budget allow, 
+                # always at least one so a single camera exceeding the budget still runs
+                used_memory = sum(memory for _, memory in running.values())
+                while queue and len(running) < workers:
+                    camera, memory = queue[0]
+                    if running and memory_budget is not None and used_memory + memory > memory_budget:
+                        break
+                    
+                    queue.popleft()
+                    future = executor.submit(calibrate_camera_process, camera, self.options)
+                    running[future] = (camera, memory)
+                    used_memory += memory
+                
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    camera, _ = running.pop(future)
+                    try:
+                        results[camera] = future.result()
+                    except (ValueError, cv2.error) as error:
+                        self.fail(camera, error)
         
-        # cut out single frame for extrinsic calibration
-        for camera in self.cameras:
-            maskclip = mpy.VideoFileClip(f'input/videos/out{camera}.mp4')
-            maskclip.save_frame(f'images/extrinsic_calibration_images/out{camera}.png', t=times[camera])
+        return results
+    
+    
+    def extract_extrinsic_calibration_images(self):
+        # cut out single frame for extrinsic calibration, all cameras at once
+        fe = FrameExtraction()
+        fe.extract_calibration_images(self.cameras)
+        fe.print_report()
             
             
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Intrinsic calibration of the cameras from the chessboard videos.')
+    parser.add_argument('--cameras', nargs='+', default=CAMERAS, help='cameras to calibrate (default: all)')
+    parser.add_argument('--workers', type=int, default=1, help='number of cameras calibrated at once')
+    parser.add_argument('--detection-workers', type=int, default=None, 
+                        help='processes for the chessboard detection per camera (default: CPU cores / workers)')
+    parser.add_argument('--detection-scale', type=float, default=0.25, 
+                        help='search the chessboard on frames downscaled by this factor first (1 = full resolution)')
+    parser.add_argument('--fast-check', action='store_true', 
+                        help='quickly reject frames without a chessboard in the coarse search')
+    parser.add_argument('--detection-skip', type=int, default=5, 
+                        help='search every n-th sampled frame (every 15th video frame) for a chessboard')
+    parser.add_argument('--max-views', type=int, default=60, 
+                        help='calibrate with at most this many views, selected for diverse board poses (0 = all)')
+    parser.add_argument('--view-report', action='store_true', 
+                        help='only print solve time and reprojection error for different numbers of views')
+    parser.add_argument('--memory-budget', type=float, default=None, 
+                        help='memory in GB that the concurrently calibrated cameras may use')
+    parser.add_argument('--skip-extraction', action='store_true', 
+                        help='do not extract the frames for the extrinsic calibration')
+    args = parser.parse_args()
+    
+    detection_workers = args.detection_workers or max(1, os.cpu_count() // args.workers)
+    memory_budget = args.memory_budget * 1e9 if args.memory_budget is not None else None
+    
     print("Please remember to place the videos in the input/ folders. Thank you!")
-    cameras = ['1', '2']
-    ic = IntrinsicCalibration(cameras=cameras)
-    ic.extract_extrinsic_calibration_images()
-    ic.calibrate()
+    ic = IntrinsicCalibration(cameras=args.cameras, detection_workers=detection_workers, 
+                              detection_scale=args.detection_scale, fast_check=args.fast_check, 
+                              detection_skip=args.detection_skip, max_views=args.max_views or None)
+    
+    if args.view_report:
+        for camera in args.cameras:
+            ic.view_report(camera)
+    else:
+        if not args.skip_extraction:
+            ic.extract_extrinsic_calibration_images()
+        if ic.calibrate(workers=args.workers, memory_budget=memory_budget):
+            sys.exit(1)
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+import numpy as np
+import hashlib
+import json
+import os
+import time
+import argparse
+
+from calibration_store import CalibrationStore
+from intrinsic_calibration import IntrinsicCalibration, CAMERAS
+from extrinsic_calibration import ExtrinsicCalibration
+from homography_calibration import HomographyCalibration
+
+
+# stage: sections of the store read and written per camera, in the order the stages run
+STAGES = {
+    'intrinsic': ([], ['intrinsic', 'distortions', 'intrinsic_refined']),
+    'extrinsic': (['intrinsic', 'distortions', 'image_points', 'world_points'], ['extrinsic']),
+    'homography': (['image_points', 'world_points'], ['homography'])
+}
+
+
+def hash_arrays(*arrays):
+    # None stands for a missing array
+    h = hashlib.sha1()
+    for array in arrays:
+        if array is None:
+            h.update(b'missing')
+            continue
+        array = np.ascontiguousarray(array, dtype=float)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+
+    return h.hexdigest()
+
+
+
+class Pipeline:
+    def __init__(self, cameras=CAMERAS, workers=1, undistort=False, ransac=False, reprojection_error=8.0,
+                 intrinsic_options=None, state_path='results/pipeline_state.json'):
+        # the stages and cameras whose inputs, settings or outputs changed since their last run are run again,
+        # the hashes of the last run of every stage and camera are kept in state_path
+        self.cameras = cameras
+        self.workers = workers
+        self.undistort = undistort
+        self.state_path = state_path
+
+        # settings of the stages, a change reruns all cameras of the stage
+        self.settings = {
+            'intrinsic': intrinsic_options or {},
+            'extrinsic': {'ransac': ransac, 'reprojection_error': reprojection_error},
+            'homography': {'undistort': undistort}
+        }
+
+        self.stages = dict(STAGES)
+        if undistort:
+            # the undistorted homographies depend on the intrinsic calibration as well
+            self.stages['homography'] = (['image_points', 'world_points', 'intrinsic', 'distortions', 'intrinsic_refined'],
+                                         ['homography_undistorted'])
+
+        self.state = self.load_state()
+        self.store = CalibrationStore()
+
+
+    def load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+
+        with open(self.state_path) as f:
+            return json.load(f)
+
+
+    def save_state(self):
+        with open(f'{self.state_path}.tmp', 'w') as outfile:
+            json.dump(self.state, outfile, indent=4)
+        os.replace(f'{self.state_path}.tmp', self.state_path)
+
+
+    def get_video_fingerprint(self, camera):
+        # the chessboard videos are far too large to hash on every run, their size and modification time stand in
+        path = IntrinsicCalibration([camera]).get_video_path(camera)
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(path)
+        return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+    def get_stage_cameras(self, stage):
+        # cameras the stage can run for
+        if stage == 'intrinsic':
+            return list(self.cameras)
+
+        inputs, _ = self.stages[stage]
+        return [camera for camera in self.cameras
+                if all(camera in self.store.cameras.get(section, []) for section in inputs)]
+
+
+    def get_input_hash(self, stage, camera):
+        inputs, _ = self.stages[stage]
+        h = hashlib.sha1(json.dumps(self.settings[stage], sort_keys=True).encode())
+        h.update(hash_arrays(*[self.store.get(section, camera) for section in inputs]).encode())
+        if stage == 'intrinsic':
+            h.update(str(self.get_video_fingerprint(camera)).encode())
+
+        return h.hexdigest()
+
+
+    def get_output_hash(self, stage, camera):
+        _, outputs = self.stages[stage]
+        return hash_arrays(*[self.store.get(section, camera) if camera in self.store.cameras.get(section, []) else None
+                             for section in outputs])
+
+
+    def get_stale_cameras(self, stage):
+        # cameras whose inputs changed since the last run, or whose outputs were changed or removed since
+        stale = []
+        for camera in self.get_stage_cameras(stage):
+            last = self.state.get(stage, {}).get(camera)
+            if last is None or last['inputs'] != self.get_input_hash(stage, camera) \
+                    or last['outputs'] != self.get_output_hash(stage, camera):
+                stale.append(camera)
+
+        if stage == 'intrinsic':
+            # without its video a camera can't be calibrated again, existing results are kept
+            missing = [camera for camera in stale if self.get_video_fingerprint(camera) is None]
+            if missing:
+                print(f'No chessboard video for camera(s) {", ".join(missing)}, keeping their intrinsic calibration.')
+            stale = [camera for camera in stale if camera not in missing]
+
+        return stale
+
+
+    def run_intrinsic(self, cameras):
+        # the cameras are calibrated in worker processes, the results are merged into the store
+        ic = IntrinsicCalibration(cameras, **self.settings['intrinsic'])
+        ic.calibrate(workers=self.workers)
+
+        return {camera: {'intrinsic': ic.intrinsic_matrices[camera], 'distortions': ic.distortions[camera],
+                         'intrinsic_refined': ic.intrinsic_matrices_refined[camera]} for camera in cameras
+                if camera not in ic.failed}
+
+
+    def run_extrinsic(self, cameras):
+        ec = ExtrinsicCalibration(workers=self.workers, **self.settings['extrinsic'])
+        ec.calculate_extrinsic_matrices(cameras)
+        ec.print_report()
+
+        return {camera: {'extrinsic': ec.extrinsic_matrices[camera]} for camera in cameras}
+
+
+    def run_homography(self, cameras):
+        hc = HomographyCalibration(**self.settings['homography'])
+        hc.calculate_homography_matrices(cameras)
+
+        return {camera: {hc.get_output_section(): hc.homographies[camera]} for camera in cameras}
+
+
+    def run_stage(self, stage, force=False):
+        cameras = self.get_stage_cameras(stage) if force else self.get_stale_cameras(stage)
+        if not cameras:
+            print(f'{stage}: up to date')
+            return []
+
+        start = time.perf_counter()
+        results = getattr(self, f'run_{stage}')(cameras)
+
+        # cameras that could not be processed keep their old results and stay stale
+        cameras = [camera for camera in cameras if camera in results]
+
+        # only the cameras that ran are replaced, the other cameras of the sections stay as they are
+        for section in self.stages[stage][1]:
+            self.store.update(section, {camera: results[camera][section] for camera in cameras})
+        self.store.save()
+
+        stage_state = self.state.setdefault(stage, {})
+        for camera in cameras:
+            stage_state[camera] = {'inputs': self.get_input_hash(stage, camera),
+                                   'outputs': self.get_output_hash(stage, camera)}
+        self.save_state()
+
+        print(f'{stage}: ran camera(s) {", ".join(cameras)} in {1000 * (time.perf_counter() - start):.1f} ms')
+        return cameras
+
+
+    def run(self, stages=None, force=False):
+        # the stages run in order, so the cameras a stage recomputed are stale in the stages depending on it
+        start = time.perf_counter()
+        ran = {stage: self.run_stage(stage, force) for stage in stages or self.stages.keys()}
+        print(f'Pipeline done in {1000 * (time.perf_counter() - start):.1f} ms')
+
+        return ran
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the calibration stages for the cameras whose inputs changed.')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES.keys()), default=None,
+                        help='stages to consider (default: all, in order)')
+    parser.add_argument('--cameras', nargs='+', default=CAMERAS, help='cameras to consider (default: all)')
+    parser.add_argument('--force', action='store_true', help='run the stages for all cameras, stale or not')
+    parser.add_argument('--workers', type=int, default=1, help='number of cameras processed at once')
+    parser.add_argument('--undistort', action='store_true', help='fit the homographies on undistorted image points')
+    parser.add_argument('--ransac', action='store_true', help='robust extrinsic calibration, see extrinsic_calibration.py')
+    parser.add_argument('--reprojection-error', type=float, default=8.0, help='inlier threshold in pixels for --ransac')
+    parser.add_argument('--max-views', type=int, default=60,
+                        help='calibrate the intrinsics with at most this many views (0 = all)')
+    args = parser.parse_args()
+
+    pipeline = Pipeline(cameras=args.cameras, workers=args.workers, undistort=args.undistort, ransac=args.ransac,
+                        reprojection_error=args.reprojection_error,
+                        intrinsic_options={'detection_workers': max(1, os.cpu_count() // args.workers), 'detection_scale': 0.25,
+                                           'max_views': args.max_views or None})
+    pipeline.run(args.stages, args.force)
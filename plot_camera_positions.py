@@ -1,37 +1,31 @@
 #!/usr/bin/python3
 
 import numpy as np
-import matplotlib.pyplot as plt
-import json
+
+from calibration_store import CalibrationStore
 
 class PlotCameraPositions:
     def __init__(self):
         self.extrinsic_matrices = {}
         self.ground_truth_cameras = {}
+        self.store = CalibrationStore()
         
         self.load_extrinsic_matrices()
         self.load_ground_truth()
         
         
     def load_extrinsic_matrices(self):
-        with open('results/extrinsic.json') as f:
-            self.extrinsic_matrices = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.extrinsic_matrices.keys():
-            self.extrinsic_matrices[k] = np.array(self.extrinsic_matrices[k])
+        self.extrinsic_matrices = self.store.section('extrinsic')
             
     
     def load_ground_truth(self):
-        with open('results/ground_truth_cameras.json') as f:
-            self.ground_truth_cameras = json.load(f)
-        
-        # convert dictionary entries to numpy arrays
-        for k in self.ground_truth_cameras.keys():
-            self.ground_truth_cameras[k] = np.array(self.ground_truth_cameras[k])
+        self.ground_truth_cameras = self.store.section('ground_truth')
             
             
     def twoD_plot(self):
+        # matplotlib takes longer to import than everything else, only the plots need it
+        import matplotlib.pyplot as plt
+        
         # plot the court
         plt.scatter([0, 0, 6, 6, 9, 9, 12, 12, 18, 18], [0, 9, 0, 9, 0, 9, 0, 9, 0, 9], color='blue')
         plt.plot([0, 0], [0, 9], 'blue')
@@ -72,6 +66,8 @@ class PlotCameraPositions:
         
     
     def threeD_plot(self):
+        import matplotlib.pyplot as plt
+        
         fig = plt.figure()
         ax = fig.add_subplot(projection='3d')
 
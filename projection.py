@@ -0,0 +1,86 @@
+import numpy as np
+
+from calibration_store import CalibrationStore
+
+
+class HomographyProjection:
+    def __init__(self, homographies=None, image_scale=(3840, 2160), undistortion=None):
+        # homographies: camera, matrix from image pixels to world millimeters (as in homography.json)
+        # undistortion: if given, the homographies map undistorted pixels (homography_undistorted.json) and
+        # image points are undistorted before and distorted after applying them
+        self.undistortion = undistortion
+        if homographies is None:
+            homographies = self.load_homographies()
+        self.image_scale = image_scale
+
+        self.cameras = list(homographies.keys())
+
+        # image pixels to world meters and back, stacked over the cameras: (cameras, 3, 3)
+        to_meters = np.diag([1 / 1000, 1 / 1000, 1])
+        self.world_from_image = np.array([to_meters @ np.asarray(homographies[camera], dtype=float) for camera in self.cameras])
+        self.image_from_world = np.linalg.inv(self.world_from_image)
+
+        # a homography also maps points from behind the camera (above the horizon) into the image, they
+        # come out with the opposite sign of the homogeneous coordinate than the ground in front of the camera,
+        # take the bottom center of the image as seeing the ground
+        reference = np.array([image_scale[0] / 2, image_scale[1] - 1])
+        references = self.to_homogeneous([reference if undistortion is None else undistortion.undistort_points(camera, reference)
+                                          for camera in self.cameras])
+        self.front_sign = np.sign(np.einsum('ci,ci->c', self.world_from_image[:, 2], references))
+
+        self.index = {camera: i for i, camera in enumerate(self.cameras)}
+
+
+    def load_homographies(self):
+        section = 'homography' if self.undistortion is None else 'homography_undistorted'
+        return CalibrationStore().section(section)
+
+
+    def to_homogeneous(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        return np.column_stack((points, np.ones(len(points))))
+
+
+    def image_to_world(self, camera, points):
+        # image points (N, 2) of a camera to world points (N, 2) in meters, together with a mask of the
+        # points that lie on the ground in front of the camera
+        i = self.index[camera]
+        if self.undistortion is not None:
+            points = self.undistortion.undistort_points(camera, points)
+        world = self.to_homogeneous(points) @ self.world_from_image[i].T
+
+        valid = np.sign(world[:, 2]) == self.front_sign[i]
+        return world[:, :2] / world[:, 2:], valid
+
+
+    def world_to_image(self, points, cameras=None):
+        # world points (N, 2) in meters to the images of all (or the given) cameras in one go: image points
+        # (cameras, N, 2) and a mask (cameras, N) of the points visible in each image
+        cameras = self.cameras if cameras is None else cameras
+        indices = [self.index[camera] for camera in cameras]
+        image = np.einsum('cij,nj->cni', self.image_from_world[indices], self.to_homogeneous(points))
+
+        in_front = np.sign(image[:, :, 2]) == self.front_sign[indices, None]
+        image = image[:, :, :2] / image[:, :, 2:]
+        visible = in_front & self.in_image(image)
+        if self.undistortion is not None:
+            # the refined camera matrices keep the whole image, so points outside the undistorted image are
+            # not seen either, far outside the distortion model folds back and has to be cut off before
+            image = np.array([self.undistortion.distort_points(camera, camera_image)
+                              for camera, camera_image in zip(cameras, image)])
+            visible &= self.in_image(image)
+
+        return image, visible
+
+
+    def in_image(self, image):
+        return ((image[..., 0] > 0) & (image[..., 0] < self.image_scale[0])
+                & (image[..., 1] > 0) & (image[..., 1] < self.image_scale[1]))
+
+
+    def image_to_cameras(self, camera, points, cameras=None):
+        # image points (N, 2) of one camera to the world and to all (or the given) other cameras
+        world, valid = self.image_to_world(camera, points)
+        image, visible = self.world_to_image(world, cameras)
+
+        return world, image, visible & valid
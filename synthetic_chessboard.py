@@ -0,0 +1,151 @@
+import numpy as np
+import cv2
+
+
+class SyntheticChessboard:
+    def __init__(self, image_size, pattern_size, camera_matrix=None, distortion=None, square_pixels=40, seed=0):
+        # image_size: (width, height), pattern_size: (columns, rows) of inner corners like findChessboardCorners
+        self.image_size = image_size
+        self.pattern_size = pattern_size
+
+        # default camera: focal length of about one image width, principal point in the center
+        width, height = image_size
+        if camera_matrix is None:
+            camera_matrix = np.array([[width, 0, (width - 1) / 2],
+                                      [0, width, (height - 1) / 2],
+                                      [0, 0, 1]])
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.distortion = np.zeros(5) if distortion is None else np.asarray(distortion, dtype=np.float64).flatten()
+
+        self.rng = np.random.default_rng(seed)
+
+        # object points in units of squares, the same layout as in IntrinsicCalibration.detect_chessboards
+        columns, rows = pattern_size
+        self.object_points = np.zeros((columns * rows, 3), np.float32)
+        self.object_points[:, :2] = np.mgrid[0:columns, 0:rows].T.reshape(-1, 2)
+
+        self.square_pixels = square_pixels
+        self.texture = self.build_texture()
+
+        # undistorted pixel position of every (distorted) image pixel, only needed with distortion
+        self.undistortion_map = self.build_undistortion_map() if np.any(self.distortion) else None
+
+
+    def build_texture(self):
+        # chessboard with a white margin of one square, square (1, 1) is black
+        columns, rows = self.pattern_size
+        p = self.square_pixels
+
+        squares = (np.indices((rows + 3, columns + 3)).sum(axis=0) % 2 == 1).astype(np.uint8) * 255
+        squares[[0, -1], :] = 255
+        squares[:, [0, -1]] = 255
+
+        return np.kron(squares, np.ones((p, p), np.uint8))
+
+
+    def build_undistortion_map(self, step=8):
+        # undistort a coarse pixel grid and interpolate, the distortion is smooth enough for that
+        width, height = self.image_size
+        xs = np.arange(0, width + step, step, dtype=np.float32)
+        ys = np.arange(0, height + step, step, dtype=np.float32)
+        grid = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 1, 2)
+
+        undistorted = cv2.undistortPoints(grid, self.camera_matrix, self.distortion, P=self.camera_matrix)
+        undistorted = undistorted.reshape(len(ys), len(xs), 2)
+
+        # resize so that the grid nodes land on their pixels again
+        full = cv2.resize(undistorted, ((len(xs) - 1) * step + 1, (len(ys) - 1) * step + 1), interpolation=cv2.INTER_LINEAR)
+        return np.ascontiguousarray(full[:height, :width])
+
+
+    def texture_from_object(self):
+        # homography from object coordinates (squares) to texture pixels, inner corner (0, 0) lies
+        # between the squares (1, 1) and (2, 2)
+        p = self.square_pixels
+        return np.array([[p, 0, 2 * p - 0.5],
+                         [0, p, 2 * p - 0.5],
+                         [0, 0, 1]])
+
+
+    def render_background(self):
+        # smooth random gray values, the sensor noise is added afterwards
+        width, height = self.image_size
+        coarse = self.rng.uniform(40, 200, size=(9, 16)).astype(np.float32)
+        background = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+
+        return np.clip(background, 0, 255).astype(np.uint8)
+
+
+    def random_pose(self, min_size=0.15, max_size=0.45, max_tilt=40):
+        # random board pose with all corners in the image, the board covers min_size to max_size
+        # of the image width
+        width, height = self.image_size
+        columns, rows = self.pattern_size
+        center = np.array([(columns - 1) / 2, (rows - 1) / 2, 0])
+
+        while True:
+            tilt = np.radians(self.rng.uniform(-max_tilt, max_tilt, size=2))
+            roll = np.radians(self.rng.uniform(-180, 180))
+            rotation_matrix = cv2.Rodrigues(np.array([tilt[0], tilt[1], 0.]))[0] @ cv2.Rodrigues(np.array([0, 0, roll]))[0]
+            rvec = cv2.Rodrigues(rotation_matrix)[0]
+
+            # distance from the apparent size of the board
+            size = self.rng.uniform(min_size, max_size)
+            depth = self.camera_matrix[0, 0] * (columns + 1) / (size * width)
+
+            pixel = np.array([self.rng.uniform(0.2, 0.8) * width, self.rng.uniform(0.2, 0.8) * height, 1])
+            tvec = depth * np.linalg.solve(self.camera_matrix, pixel) - rotation_matrix @ center
+
+            corners = self.project(rvec, tvec)
+            margin = 0.03 * width
+            if (corners.min(axis=0) > margin).all() and (corners.max(axis=0) < np.array(self.image_size) - margin).all():
+                return rvec, tvec.reshape(3, 1)
+
+
+    def project(self, rvec, tvec, points=None):
+        # true image position of the inner corners (or of other object points)
+        points = self.object_points if points is None else points
+        projected, _ = cv2.projectPoints(points, rvec, tvec, self.camera_matrix, self.distortion)
+        return projected.reshape(-1, 2)
+
+
+    def render(self, rvec=None, tvec=None, blur=1.0, noise=2.0):
+        # render the board in the given pose (a random one if none is given) over a random background,
+        # returns the grayscale image and the true corners shaped like findChessboardCorners' output
+        if rvec is None or tvec is None:
+            rvec, tvec = self.random_pose()
+
+        rotation_matrix = cv2.Rodrigues(rvec)[0]
+
+        # undistorted image from object plane, then from texture
+        image_from_object = self.camera_matrix @ np.column_stack((rotation_matrix[:, :2], np.ravel(tvec)))
+        texture_from_image = self.texture_from_object() @ np.linalg.inv(image_from_object)
+
+        if self.undistortion_map is None:
+            width, height = self.image_size
+            grid = np.stack(np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32)), axis=-1)
+        else:
+            grid = self.undistortion_map
+
+        # texture position of every image pixel
+        texture_map = cv2.perspectiveTransform(grid.reshape(-1, 1, 2), texture_from_image).reshape(grid.shape)
+
+        image = self.render_background()
+        cv2.remap(self.texture, texture_map, None, cv2.INTER_LINEAR, dst=image, borderMode=cv2.BORDER_TRANSPARENT)
+
+        return self.add_sensor_effects(image, blur, noise), self.project(rvec, tvec).reshape(-1, 1, 2).astype(np.float32)
+
+
+    def render_empty(self, blur=1.0, noise=2.0):
+        # a frame without a chessboard
+        return self.add_sensor_effects(self.render_background(), blur, noise)
+
+
+    def add_sensor_effects(self, image, blur, noise):
+        # slight defocus and sensor noise
+        if blur:
+            image = cv2.GaussianBlur(image, (0, 0), blur)
+        if noise:
+            image = np.clip(image + self.rng.normal(0, noise, size=image.shape), 0, 255).astype(np.uint8)
+
+        return image
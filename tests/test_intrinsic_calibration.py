@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from intrinsic_calibration import IntrinsicCalibration, get_chessboard_size
+from synthetic_chessboard import SyntheticChessboard
+
+
+IMAGE_SIZE = (640, 360)
+
+
+def synthetic_corners(camera, views=12):
+    # detected corners of a chessboard in random poses, as the corner cache returns them
+    board = SyntheticChessboard(IMAGE_SIZE, get_chessboard_size(camera))
+    corners = {}
+    for i in range(views):
+        rvec, tvec = board.random_pose()
+        corners[i] = board.project(rvec, tvec).reshape(-1, 1, 2).astype('float32')
+
+    return corners, IMAGE_SIZE[::-1]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_missing_camera_is_skipped_and_the_others_are_saved(tmp_path, monkeypatch, workers):
+    # camera 1 has chessboard views, camera 2 has neither a video nor cached corners
+    monkeypatch.chdir(tmp_path)
+    get_corners = IntrinsicCalibration.get_corners
+    monkeypatch.setattr(IntrinsicCalibration, 'get_corners',
+                        lambda self, camera: synthetic_corners(camera) if camera == '1' else get_corners(self, camera))
+
+    ic = IntrinsicCalibration(cameras=['1', '2'])
+    failed = ic.calibrate(workers=workers)
+
+    assert failed == ['2']
+    assert 'video not found' in ic.failed['2']
+    with open('results/intrinsic.json') as f:
+        assert list(json.load(f).keys()) == ['1']
+    assert (tmp_path / 'results/intrinsic_views/out1.npz').exists()
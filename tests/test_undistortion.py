@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from undistortion import Undistortion
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WIDTH, HEIGHT = 3840, 2160
+
+# the fitted distortion polynomials of these cameras turn over before the image corners, the corner pixels
+# have no undistorted position on their side of the image
+FOLDED = ['2', '6', '12', '13']
+
+
+@pytest.fixture(scope='module')
+def undistortion():
+    # the calibration results of the repository
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        yield Undistortion()
+    finally:
+        os.chdir(cwd)
+
+
+def border_points(count=9):
+    # image corners and points along the image border, where the distortion is strongest
+    xs, ys = np.linspace(0, WIDTH - 1, count), np.linspace(0, HEIGHT - 1, count)
+    points = np.array([(x, y) for x in xs for y in ys])
+    return points[(points[:, 0] == 0) | (points[:, 0] == WIDTH - 1) | (points[:, 1] == 0) | (points[:, 1] == HEIGHT - 1)]
+
+
+@pytest.mark.parametrize('camera', [pytest.param(camera, marks=pytest.mark.xfail(strict=True, reason='distortion model folds'))
+                                    if camera in FOLDED else camera
+                                    for camera in ['1', '2', '3', '4', '5', '6', '7', '8', '12', '13']])
+def test_round_trip_at_the_image_corners(undistortion, camera):
+    points = border_points()
+    round_trip = undistortion.distort_points(camera, undistortion.undistort_points(camera, points))
+
+    assert np.abs(round_trip - points).max() < 0.01
+
+
+@pytest.mark.parametrize('camera', ['1', '2', '3', '4', '5', '6', '7', '8', '12', '13'])
+def test_round_trip_in_the_image_center(undistortion, camera):
+    xs, ys = np.linspace(0.3 * WIDTH, 0.7 * WIDTH, 9), np.linspace(0.3 * HEIGHT, 0.7 * HEIGHT, 9)
+    points = np.array([(x, y) for x in xs for y in ys])
+    round_trip = undistortion.distort_points(camera, undistortion.undistort_points(camera, points))
+
+    assert np.abs(round_trip - points).max() < 0.01
@@ -0,0 +1,63 @@
+import time
+
+import cv2
+import numpy as np
+
+from video_stream import CameraReader
+
+
+FPS = 25
+FRAME_INTERVAL = 1000 / FPS
+
+
+class FakeCapture:
+    # video of 25 fps decoding instantly
+    def __init__(self, path, frames=200):
+        self.frames = frames
+        self.position = -1  # index of the last grabbed frame
+
+    def isOpened(self):
+        return True
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            self.position = int(round(value / FRAME_INTERVAL)) - 1
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return FPS
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.position * FRAME_INTERVAL
+        return 0
+
+    def grab(self):
+        self.position += 1
+        return self.position < self.frames
+
+    def retrieve(self):
+        return True, np.zeros((4, 4, 3), dtype=np.uint8)
+
+    def release(self):
+        pass
+
+
+def test_fast_decoder_drops_no_frames(monkeypatch):
+    # the consumer takes every frame when it is due, a decoder far faster than real time must not drop any
+    monkeypatch.setattr(cv2, 'VideoCapture', FakeCapture)
+    now = [0.0]
+    reader = CameraReader('1', 'fake.mp4', clock=lambda: now[0], queue_size=4)
+    reader.start()
+
+    shown = []
+    try:
+        for i in range(40):
+            now[0] = i * FRAME_INTERVAL
+            time.sleep(0.04)  # the reader fills the queue up to its look-ahead
+            item = reader.latest(now[0])
+            shown.append(None if item is None else item[0])
+    finally:
+        reader.stopped.set()
+        reader.join()
+
+    assert reader.dropped == 0
+    assert shown == [i * FRAME_INTERVAL for i in range(40)]
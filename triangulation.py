@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+
+import numpy as np
+import json
+import time
+import argparse
+
+from calibration_store import CalibrationStore
+from evaluation import project_points
+from undistortion import Undistortion, distort_normalized
+
+
+class Triangulation:
+    def __init__(self, cameras=None, undistort=True, image_scale=(3840, 2160)):
+        # 3D points (meters, z pointing down like the extrinsic calibration) from the pixel positions of the same
+        # point in several cameras, many points solved at once - undistort: the observations are raw pixels
+        # and are corrected for the lens distortion first, otherwise they are pixels of the undistorted images
+        self.undistort = undistort
+        self.image_scale = image_scale
+
+        store = CalibrationStore()
+        self.intrinsic_matrices = store.section('intrinsic')
+        self.refined_matrices = store.section('intrinsic_refined')
+        self.distortions = store.section('distortions')
+        self.extrinsic_matrices = store.section('extrinsic')
+        self.undistortion = Undistortion() if undistort else None
+
+        self.cameras = [camera for camera in (cameras or self.extrinsic_matrices.keys())
+                        if camera in self.intrinsic_matrices and camera in self.refined_matrices
+                        and camera in self.extrinsic_matrices]
+
+        # the extrinsic matrices are the camera poses in the world, their inverses map the world into the cameras
+        camera_f_world = np.linalg.inv(np.array([self.extrinsic_matrices[camera] for camera in self.cameras]))
+        self.rotations = camera_f_world[:, :3, :3]
+        self.translations = camera_f_world[:, :3, 3]
+        self.camera_matrices = np.array([self.intrinsic_matrices[camera] for camera in self.cameras])
+        self.distortion_coefficients = np.array([self.distortions[camera].ravel()[:5] for camera in self.cameras])
+
+        # the points are solved in the undistorted images, with the refined camera matrices like everywhere else:
+        # projection matrices P = K' [R | t] (cameras, 3, 4)
+        self.ideal_matrices = np.array([self.refined_matrices[camera] for camera in self.cameras])
+        self.projections = self.ideal_matrices @ camera_f_world[:, :3]
+
+
+    def undistort_observations(self, observations, mask):
+        # raw pixels (N, cameras, 2) to the pixels of the undistorted images
+        undistorted = observations.copy()
+        for c, camera in enumerate(self.cameras):
+            if mask[:, c].any():
+                undistorted[mask[:, c], c] = self.undistortion.undistort_points(camera, observations[mask[:, c], c])
+
+        return undistorted
+
+
+    def solve_dlt(self, observations, mask):
+        # linear triangulation of all points at once: every camera seeing a point adds the rows x P3 - P1 and
+        # y P3 - P2, the point is the null vector of the rows, the eigenvector of the smallest eigenvalue of the
+        # 4x4 normal matrix (twice as fast as a singular value decomposition of the rows) - (N, 3)
+        rows = np.concatenate((observations[..., 0, None] * self.projections[None, :, 2] - self.projections[None, :, 0],
+                               observations[..., 1, None] * self.projections[None, :, 2] - self.projections[None, :, 1]),
+                              axis=1)  # (N, 2 cameras, 4)
+        rows *= np.tile(mask, 2)[..., None]
+
+        # rows of equal weight condition the system, missing cameras stay zero rows
+        norms = np.linalg.norm(rows, axis=2, keepdims=True)
+        rows /= np.where(norms > 0, norms, 1)
+
+        _, vectors = np.linalg.eigh(rows.transpose(0, 2, 1) @ rows)
+        homogeneous = vectors[:, :, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return homogeneous[:, :3] / homogeneous[:, 3:]
+
+
+    def project(self, points):
+        # pixels in the undistorted images (N, cameras, 2) and depths (N, cameras) of world points (N, 3) in all cameras
+        camera_points = np.einsum('cij,nj->nci', self.rotations, points) + self.translations[None]
+        pixels = np.einsum('cij,ncj->nci', self.ideal_matrices, camera_points)
+
+        return pixels[..., :2] / pixels[..., 2:], camera_points[..., 2]
+
+
+    def refine(self, points, observations, mask, iterations=2):
+        # Gauss-Newton on the reprojection error of every point, all points in one batched 3x3 solve per iteration,
+        # starting at the DLT solution it converges after one or two
+        weights = mask[..., None].astype(float)
+        solvable = mask.sum(axis=1) >= 2
+        for _ in range(iterations):
+            # pixel u = P0 X / P2 X, its derivative by the point is (P0 - u P2) / P2 X, the same for v
+            homogeneous = np.einsum('cij,nj->nci', self.projections[:, :, :3], points) + self.projections[None, :, :, 3]
+            w = homogeneous[..., 2:]
+            pixels = homogeneous[..., :2] / w
+            residuals = (pixels - observations) * weights  # (N, cameras, 2)
+
+            jacobian_u = (self.projections[None, :, 0, :3] - pixels[..., :1] * self.projections[None, :, 2, :3]) / w * weights
+            jacobian_v = (self.projections[None, :, 1, :3] - pixels[..., 1:] * self.projections[None, :, 2, :3]) / w * weights
+            normal = jacobian_u.transpose(0, 2, 1) @ jacobian_u + jacobian_v.transpose(0, 2, 1) @ jacobian_v
+            gradient = np.einsum('nci,nc->ni', jacobian_u, residuals[..., 0]) + np.einsum('nci,nc->ni', jacobian_v, residuals[..., 1])
+
+            # points seen by less than two cameras have no unique solution, they stay as they are
+            step = np.zeros_like(points)
+            valid = solvable & (np.abs(np.linalg.det(normal)) > 1e-12)
+            step[valid] = np.linalg.solve(normal[valid], gradient[valid, :, None])[..., 0]
+            points = points - step
+
+        return points
+
+
+    def residuals(self, points, observations, mask):
+        # reprojection error in raw pixels (N, cameras) through the full camera model with distortion, NaN where
+        # a camera did not see the point
+        n, cameras = mask.shape
+        index, camera = np.nonzero(mask)
+
+        projected = project_points(points[index], self.rotations[camera], self.translations[camera],
+                                   self.camera_matrices[camera], self.distortion_coefficients[camera])
+        errors = np.full((n, cameras), np.nan)
+        errors[index, camera] = np.linalg.norm(projected - observations[index, camera], axis=1)
+
+        return errors
+
+
+    def triangulate(self, observations, mask=None, refine=True, iterations=2):
+        # observations: (N, cameras, 2) pixels in the order of self.cameras, NaN (or mask False) where a camera did
+        # not see the point - returns points (N, 3) in meters, NaN for less than two views, and the
+        # reprojection error of every observation in pixels (N, cameras)
+        observations = np.asarray(observations, dtype=float)
+        if mask is None:
+            mask = ~np.isnan(observations).any(axis=2)
+        mask = mask.copy()
+        observations = np.where(mask[..., None], observations, 0)
+
+        # points seen by less than two cameras are kept at the origin until the end
+        unseen = mask.sum(axis=1) < 2
+        ideal = self.undistort_observations(observations, mask) if self.undistort else observations
+        points = self.solve_dlt(ideal, mask)
+        points[unseen] = 0
+        if refine:
+            points = self.refine(points, ideal, mask, iterations)
+
+        errors = self.residuals(points, observations, mask) if self.undistort \
+            else np.where(mask, np.linalg.norm(self.project(points)[0] - observations, axis=2), np.nan)
+        points[unseen] = np.nan
+        errors[unseen] = np.nan
+
+        return points, errors
+
+
+    def observe(self, points, noise=0.0, seed=0):
+        # raw pixels (N, cameras, 2) of world points and the mask of the cameras seeing them (in front and in the
+        # image), with Gaussian pixel noise - for tests and the benchmark
+        rng = np.random.default_rng(seed)
+        n = len(points)
+        index, camera = np.repeat(np.arange(n), len(self.cameras)), np.tile(np.arange(len(self.cameras)), n)
+
+        ideal, depths = self.project(points)
+        projected = project_points(points[index], self.rotations[camera], self.translations[camera],
+                                   self.camera_matrices[camera], self.distortion_coefficients[camera])
+        projected = projected.reshape(n, len(self.cameras), 2) if self.undistort else ideal
+
+        mask = ((depths > 0) & (projected[..., 0] >= 0) & (projected[..., 0] < self.image_scale[0])
+                & (projected[..., 1] >= 0) & (projected[..., 1] < self.image_scale[1]))
+        if self.undistort:
+            # outside the calibrated area the distortion polynomial can fold back into the image, such points are
+            # ambiguous and no real camera would see them there - the model has to stay well conditioned from the
+            # image center to the point
+            camera_points = np.einsum('cij,nj->nci', self.rotations, points) + self.translations[None]
+            x, y = camera_points[..., 0] / camera_points[..., 2], camera_points[..., 1] / camera_points[..., 2]
+            for fraction in np.linspace(0.1, 1, 10):
+                _, _, (a, b, d) = distort_normalized(fraction * x, fraction * y, self.distortion_coefficients[None])
+                mask &= a * d - b * b > 0.25
+
+        observations = projected + rng.normal(0, noise, (n, len(self.cameras), 2))
+        return observations, mask
+
+
+    def benchmark(self, count=100000, noise=0.5, max_views=None, seed=0):
+        # throughput and accuracy on random points above the court (up to 5 m high, z points down)
+        rng = np.random.default_rng(seed)
+        points = rng.uniform([-2, -2, -5], [20, 11, 0], (count, 3))
+        observations, mask = self.observe(points, noise, seed)
+
+        if max_views is not None:
+            # keep a random subset of the views of every point, e.g. the ball seen by only a few cameras
+            order = np.argsort(rng.random(mask.shape) + ~mask, axis=1)
+            keep = np.zeros_like(mask)
+            np.put_along_axis(keep, order[:, :max_views], True, axis=1)
+            mask &= keep
+
+        results = {'points': count, 'noise_px': noise, 'mean_views': float(mask.sum(axis=1).mean())}
+        for refine in [False, True]:
+            start = time.perf_counter()
+            solved, errors = self.triangulate(observations, mask, refine=refine)
+            duration = time.perf_counter() - start
+
+            valid = ~np.isnan(solved[:, 0])
+            name = 'refined' if refine else 'dlt'
+            results[name] = {
+                'time_s': duration,
+                'points_per_s': count / duration,
+                'solved': int(valid.sum()),
+                'position_error_mm_median': float(1000 * np.median(np.linalg.norm(solved[valid] - points[valid], axis=1))),
+                'reprojection_rms_px': float(np.sqrt(np.nanmean(errors ** 2)))
+            }
+
+        return results
+
+
+    def print_benchmark(self, results):
+        print(f'{results["points"]} points, {results["mean_views"]:.1f} views per point on average, '
+              f'{results["noise_px"]} px noise')
+        print(f'{"":>8}{"points/s":>12}{"solved":>9}{"median error mm":>17}{"rms px":>9}')
+        for name in ['dlt', 'refined']:
+            r = results[name]
+            print(f'{name:>8}{r["points_per_s"]:>12.0f}{r["solved"]:>9}{r["position_error_mm_median"]:>17.1f}'
+                  f'{r["reprojection_rms_px"]:>9.2f}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Triangulate 3D points from their pixel positions in several cameras.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input', default=None,
+                        help='JSON file of camera: list of [x, y] pixels (null where the camera did not see the point)')
+    parser.add_argument('--output', default='results/triangulated_points.json', help='JSON file for the 3D points')
+    parser.add_argument('--no-refine', action='store_true', help='only the linear (DLT) solution')
+    parser.add_argument('--raw', action='store_true', help='the pixels are of the undistorted images')
+    source.add_argument('--benchmark', type=int, default=None, metavar='POINTS',
+                        help='measure throughput and accuracy on this many synthetic points instead')
+    parser.add_argument('--max-views', type=int, default=None, help='cameras per synthetic point in the benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        tr = Triangulation()
+        tr.print_benchmark(tr.benchmark(args.benchmark, max_views=args.max_views))
+    else:
+        with open(args.input) as f:
+            pixels = json.load(f)
+
+        tr = Triangulation(cameras=list(pixels.keys()), undistort=not args.raw)
+        count = max(len(points) for points in pixels.values())
+        observations = np.full((count, len(tr.cameras), 2), np.nan)
+        for c, camera in enumerate(tr.cameras):
+            for i, point in enumerate(pixels[camera]):
+                if point is not None:
+                    observations[i, c] = point
+
+        points, errors = tr.triangulate(observations, refine=not args.no_refine)
+        with open(args.output, 'w') as outfile:
+            json.dump({'cameras': tr.cameras,
+                       'points': [None if np.isnan(point[0]) else point.tolist() for point in points],
+                       'reprojection_errors_px': [[None if np.isnan(e) else float(e) for e in row] for row in errors]},
+                      outfile, indent=4)
+        print(f'Triangulated {int((~np.isnan(points[:, 0])).sum())} of {count} points, '
+              f'reprojection RMS {np.sqrt(np.nanmean(errors ** 2)):.2f} px')
@@ -0,0 +1,158 @@
+import numpy as np
+import cv2
+import hashlib
+import os
+
+from calibration_store import CalibrationStore
+
+
+# OpenCV's default stops the iterative undistortion after 5 steps, far from converged near the image corners
+UNDISTORT_CRITERIA = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 100, 1e-9)
+
+
+def distort_normalized(x, y, distortion):
+    # OpenCV distortion model (k1, k2, p1, p2, k3) of normalized coordinates and its 2x2 Jacobian [[a, b], [b, d]]
+    # by the undistorted coordinates - distortion (..., 5) broadcasts against the coordinates
+    k1, k2, p1, p2, k3 = np.moveaxis(np.asarray(distortion, dtype=float), -1, 0)
+    r2 = x * x + y * y
+    radial = 1 + k1 * r2 + k2 * r2 ** 2 + k3 * r2 ** 3
+    d_radial = 2 * (k1 + 2 * k2 * r2 + 3 * k3 * r2 ** 2)
+
+    xd = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x * x)
+    yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * x * y
+    a = radial + x * x * d_radial + 2 * p1 * y + 6 * p2 * x
+    b = x * y * d_radial + 2 * p1 * x + 2 * p2 * y
+    d = radial + y * y * d_radial + 6 * p1 * y + 2 * p2 * x
+
+    return xd, yd, (a, b, d)
+
+
+def undistort_normalized(points, camera_matrix, distortion, iterations=20, tolerance=1e-9):
+    # distorted pixels (N, 2) to normalized undistorted coordinates (N, 2) - where the fixed point iteration
+    # of OpenCV doesn't converge (strong distortion), Newton steps on the distortion model from the distorted
+    # position take over
+    points = np.asarray(points, dtype=float).reshape(-1, 1, 2)
+    distortion = np.zeros(5) if distortion is None else np.asarray(distortion, dtype=float).ravel()[:5]
+    if hasattr(cv2, 'undistortPointsIter'):
+        # OpenCV 4 only takes the criteria in a separate function
+        normalized = cv2.undistortPointsIter(points, camera_matrix, distortion, None, None, UNDISTORT_CRITERIA)
+    else:
+        normalized = cv2.undistortPoints(points, camera_matrix, distortion, criteria=UNDISTORT_CRITERIA)
+    x, y = normalized.reshape(-1, 2).T
+
+    yd = (points[:, 0, 1] - camera_matrix[1, 2]) / camera_matrix[1, 1]
+    xd = (points[:, 0, 0] - camera_matrix[0, 2] - camera_matrix[0, 1] * yd) / camera_matrix[0, 0]
+    ex, ey, _ = distort_normalized(x, y, distortion)
+    open_points = np.flatnonzero(np.abs(ex - xd) + np.abs(ey - yd) > tolerance)
+
+    nx, ny = xd[open_points], yd[open_points]
+    for _ in range(iterations if len(open_points) else 0):
+        ex, ey, (a, b, d) = distort_normalized(nx, ny, distortion)
+        ex, ey = ex - xd[open_points], ey - yd[open_points]
+        determinant = a * d - b * b
+        nx, ny = nx - (d * ex - b * ey) / determinant, ny - (a * ey - b * ex) / determinant
+    x[open_points], y[open_points] = nx, ny
+
+    return np.column_stack((x, y))
+
+
+class Undistortion:
+    def __init__(self, image_scale=(3840, 2160), cache_dir='results/undistortion_maps'):
+        # undistorted images and points use the refined camera matrices of the intrinsic calibration
+        self.image_scale = image_scale
+        self.cache_dir = cache_dir
+
+        self.intrinsic_matrices = {}
+        self.distortions = {}
+        self.refined_matrices = {}
+
+        self.store = CalibrationStore()
+        self.load_intrinsic_matrices()
+        self.load_distortions()
+        self.load_refined_matrices()
+
+        self.cameras = list(self.intrinsic_matrices.keys())
+
+        # camera: remap tables (memory-mapped from the cache files)
+        self.maps = {}
+
+
+    def load_intrinsic_matrices(self):
+        self.intrinsic_matrices = self.store.section('intrinsic')
+
+
+    def load_distortions(self):
+        self.distortions = self.store.section('distortions')
+
+
+    def load_refined_matrices(self):
+        self.refined_matrices = self.store.section('intrinsic_refined')
+
+
+    def parameter_hash(self, camera):
+        # everything the remap tables depend on, recalibrating a camera gives new cache files
+        sha = hashlib.sha1()
+        for array in [self.intrinsic_matrices[camera], self.distortions[camera], self.refined_matrices[camera],
+                      np.array(self.image_scale, dtype=float)]:
+            sha.update(np.ascontiguousarray(array, dtype=float).tobytes())
+
+        return sha.hexdigest()[:16]
+
+
+    def map_paths(self, camera):
+        prefix = f'{self.cache_dir}/out{camera}_{self.parameter_hash(camera)}'
+        return f'{prefix}_xy.npy', f'{prefix}_interpolation.npy'
+
+
+    def get_maps(self, camera):
+        # remap tables of a camera, built once and afterwards only memory-mapped from disk, so opening them
+        # costs nothing and only the touched pages are read
+        if camera in self.maps:
+            return self.maps[camera]
+
+        paths = self.map_paths(camera)
+        if not all(os.path.exists(path) for path in paths):
+            self.build_maps(camera, paths)
+
+        self.maps[camera] = tuple(np.load(path, mmap_mode='r') for path in paths)
+        return self.maps[camera]
+
+
+    def build_maps(self, camera, paths):
+        # fixed point tables (integer positions and interpolation weights) are half the size of float
+        # tables and remap faster
+        map_xy, map_interpolation = cv2.initUndistortRectifyMap(self.intrinsic_matrices[camera], self.distortions[camera],
+                                                                None, self.refined_matrices[camera],
+                                                                tuple(self.image_scale), cv2.CV_16SC2)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for path, table in zip(paths, [map_xy, map_interpolation]):
+            np.save(f'{path}.tmp.npy', table)
+            os.replace(f'{path}.tmp.npy', path)
+
+
+    def undistort_frame(self, camera, frame):
+        # whole frame with a single lookup in the cached tables
+        map_xy, map_interpolation = self.get_maps(camera)
+        return cv2.remap(frame, map_xy, map_interpolation, cv2.INTER_LINEAR)
+
+
+    def undistort_points(self, camera, points):
+        # image points (N, 2) of the distorted image to the undistorted image (refined camera matrix)
+        normalized = undistort_normalized(points, self.intrinsic_matrices[camera], self.distortions[camera])
+        refined = self.refined_matrices[camera]
+
+        return normalized @ refined[:2, :2].T + refined[:2, 2]
+
+
+    def distort_points(self, camera, points):
+        # inverse of undistort_points: back to normalized coordinates with the refined matrix, then
+        # through the distortion model of the camera
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        normalized = (points - self.refined_matrices[camera][:2, 2]) / np.diag(self.refined_matrices[camera])[:2]
+
+        rays = np.column_stack((normalized, np.ones(len(normalized))))
+        distorted, _ = cv2.projectPoints(rays, np.zeros(3), np.zeros(3), self.intrinsic_matrices[camera],
+                                         self.distortions[camera])
+
+        return distorted.reshape(-1, 2)
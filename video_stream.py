@@ -0,0 +1,188 @@
+import numpy as np
+import cv2
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty, Full
+
+
+class CameraReader(threading.Thread):
+    def __init__(self, camera, path, clock, queue_size=4, frame_size=None, start_time=0.0, resync=1.0):
+        # decodes one video into a bounded queue of (timestamp in ms, frame), never waits for the consumer
+        super().__init__(daemon=True)
+        self.camera = camera
+        self.path = path
+        self.clock = clock  # current playback time in ms
+        self.frame_size = frame_size  # (width, height) the frames are downscaled to in this thread
+        self.start_time = start_time
+        self.resync = resync  # seconds behind the clock after which the reader seeks instead of decoding on
+
+        self.frames = Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.finished = False
+
+        # statistics
+        self.decoded = 0
+        self.dropped = 0  # frames skipped or thrown away because decoding or displaying fell behind
+        self.latencies = deque(maxlen=1000)  # decode time per frame in ms
+
+
+    def run(self):
+        cap = cv2.VideoCapture(self.path)
+        if not cap.isOpened():
+            print(f'Video of camera {self.camera} not found.')
+            self.finished = True
+            return
+
+        cap.set(cv2.CAP_PROP_POS_MSEC, self.start_time * 1000)
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25
+        frame_interval = 1000 / fps
+
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            if not cap.grab():
+                break
+            timestamp = cap.get(cv2.CAP_PROP_POS_MSEC)
+
+            # grabbing decodes as well, so far behind the clock only seeking catches up
+            now = self.clock()
+            if timestamp < now - 1000 * self.resync:
+                cap.set(cv2.CAP_PROP_POS_MSEC, now)
+                self.dropped += int((now - timestamp) / frame_interval)
+                continue
+
+            # too late for the display already, skip the conversion of the frame - unless nothing is queued,
+            # then a late frame is still better than a frozen tile
+            if timestamp < now - frame_interval and not self.frames.empty():
+                self.dropped += 1
+                continue
+
+            ok, frame = cap.retrieve()
+            if not ok:
+                break
+            if self.frame_size is not None:
+                frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+            self.latencies.append(1000 * (time.perf_counter() - start))
+            self.decoded += 1
+
+            # don't decode too far ahead of the display - one place in the queue stays free for the frame that
+            # is due but not taken yet, otherwise putting a frame ahead would throw it away
+            while timestamp > self.clock() + (self.frames.maxsize - 1) * frame_interval and not self.stopped.is_set():
+                time.sleep(frame_interval / 2000)
+
+            self.put((timestamp, frame))
+
+        cap.release()
+        self.finished = True
+
+
+    def put(self, item):
+        # a full queue means the consumer is behind, the oldest frame gives way
+        while True:
+            try:
+                self.frames.put_nowait(item)
+                return
+            except Full:
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+
+    def latest(self, timestamp):
+        # newest queued frame not later than timestamp, older ones are thrown away - None if there is none
+        current = None
+        while True:
+            with self.frames.mutex:
+                if not self.frames.queue or self.frames.queue[0][0] > timestamp:
+                    break
+            item = self.frames.get_nowait()
+            if current is not None:
+                self.dropped += 1
+            current = item
+
+        return current
+
+
+    def statistics(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'decoded': self.decoded,
+            'dropped': self.dropped,
+            'decode_ms_mean': float(latencies.mean()),
+            'decode_ms_p95': float(np.percentile(latencies, 95)),
+            'queued': self.frames.qsize()
+        }
+
+
+
+class MultiCameraStream:
+    def __init__(self, cameras, video_dir='input/videos', queue_size=4, frame_size=None, start_time=0.0, resync=1.0):
+        # all cameras are played back on one clock, every reader decodes its own video
+        self.cameras = cameras
+        self.start_time = start_time
+        self.started = None
+
+        self.readers = {camera: CameraReader(camera, f'{video_dir}/out{camera}.mp4', self.clock, queue_size=queue_size,
+                                             frame_size=frame_size, start_time=start_time, resync=resync)
+                        for camera in cameras}
+
+        # camera: (timestamp, frame) currently shown
+        self.current = {}
+        self.spreads = deque(maxlen=1000)  # difference between the timestamps of the shown frames in ms
+
+
+    def clock(self):
+        # playback time in ms of the videos
+        if self.started is None:
+            return self.start_time * 1000
+        return self.start_time * 1000 + 1000 * (time.perf_counter() - self.started)
+
+
+    def start(self):
+        self.started = time.perf_counter()
+        for reader in self.readers.values():
+            reader.start()
+
+
+    def stop(self):
+        for reader in self.readers.values():
+            reader.stopped.set()
+        for reader in self.readers.values():
+            reader.join()
+
+
+    def finished(self):
+        return all(reader.finished and reader.frames.empty() for reader in self.readers.values())
+
+
+    def read(self):
+        # frames of the cameras that have a newer frame for the current playback time: camera, frame
+        now = self.clock()
+        updated = {}
+        for camera, reader in self.readers.items():
+            item = reader.latest(now)
+            if item is not None:
+                self.current[camera] = item
+                updated[camera] = item[1]
+
+        if len(self.current) > 1:
+            timestamps = [timestamp for timestamp, _ in self.current.values()]
+            self.spreads.append(max(timestamps) - min(timestamps))
+
+        return updated
+
+
+    def report(self):
+        print(f'{"camera":>8}{"decoded":>10}{"dropped":>10}{"decode ms":>12}{"p95 ms":>10}')
+        statistics = {}
+        for camera, reader in self.readers.items():
+            statistics[camera] = reader.statistics()
+            s = statistics[camera]
+            print(f'{camera:>8}{s["decoded"]:>10}{s["dropped"]:>10}{s["decode_ms_mean"]:>12.1f}{s["decode_ms_p95"]:>10.1f}')
+
+        if self.spreads:
+            print(f'Timestamp spread between the cameras: mean {np.mean(self.spreads):.1f} ms, max {np.max(self.spreads):.1f} ms')
+
+        return statistics
@@ -0,0 +1,119 @@
+import numpy as np
+import cv2
+import time
+
+
+class ViewSelection:
+    def __init__(self, image_shape, grid=(8, 6), coverage_weight=1.0):
+        # image_shape: (height, width), grid: cells (columns, rows) used to measure the image coverage
+        self.image_shape = image_shape
+        self.grid = grid
+        self.coverage_weight = coverage_weight
+
+        # rough pinhole camera, good enough to tell board orientations apart
+        height, width = image_shape
+        self.camera_matrix = np.array([[width, 0, width / 2],
+                                       [0, width, height / 2],
+                                       [0, 0, 1]])
+
+
+    def pose_features(self, obj_points, img_points):
+        # per view: board center, apparent size and board normal - views that are close in this space
+        # add little information to the calibration
+        height, width = self.image_shape
+        features = []
+
+        for object_points, image_points in zip(obj_points, img_points):
+            image_points = image_points.reshape(-1, 2)
+
+            center = image_points.mean(axis=0) / np.array([width, height])
+            size = np.sqrt(cv2.contourArea(cv2.convexHull(image_points.astype(np.float32)))) / np.hypot(width, height)
+
+            # board normal from the homography between board plane and image
+            homography, _ = cv2.findHomography(object_points[:, :2], image_points)
+            rotation = np.linalg.solve(self.camera_matrix, homography)
+            r1 = rotation[:, 0] / np.linalg.norm(rotation[:, 0])
+            r2 = rotation[:, 1] / np.linalg.norm(rotation[:, 1])
+            normal = np.cross(r1, r2)
+            normal *= np.sign(normal[2]) or 1  # the normal is only defined up to its sign
+
+            features.append(np.concatenate((center, [size], normal[:2])))
+
+        return np.array(features)
+
+
+    def coverage(self, img_points):
+        # grid cells that contain at least one corner, one boolean row per view
+        height, width = self.image_shape
+        columns, rows = self.grid
+        cells = np.zeros((len(img_points), columns * rows), dtype=bool)
+
+        for i, image_points in enumerate(img_points):
+            image_points = image_points.reshape(-1, 2)
+            column = np.clip((image_points[:, 0] / width * columns).astype(int), 0, columns - 1)
+            row = np.clip((image_points[:, 1] / height * rows).astype(int), 0, rows - 1)
+            cells[i, row * columns + column] = True
+
+        return cells
+
+
+    def select(self, obj_points, img_points, max_views):
+        # greedily pick the view farthest from the already selected poses, plus a bonus for image cells
+        # no selected view covers yet, returns the indices of the selected views in their original order
+        if len(img_points) <= max_views:
+            return list(range(len(img_points)))
+
+        features = self.pose_features(obj_points, img_points)
+        cells = self.coverage(img_points)
+
+        # start with the view covering the most cells
+        selected = [int(cells.sum(axis=1).argmax())]
+        covered = cells[selected[0]].copy()
+        distances = np.linalg.norm(features - features[selected[0]], axis=1)
+
+        while len(selected) < max_views:
+            new_cells = (cells & ~covered).sum(axis=1) / cells.shape[1]
+            score = distances + self.coverage_weight * new_cells
+            score[selected] = -np.inf
+
+            best = int(score.argmax())
+            selected.append(best)
+            covered |= cells[best]
+            distances = np.minimum(distances, np.linalg.norm(features - features[best], axis=1))
+
+        return sorted(selected)
+
+
+    def report(self, obj_points, img_points, sizes):
+        # solve time and reprojection error for several numbers of selected views, the error is measured
+        # on all views (poses solved with the subset's intrinsics) so the subsets are comparable
+        height, width = self.image_shape
+        results = []
+
+        for size in sorted(set(min(size, len(img_points)) for size in list(sizes) + [len(img_points)])):
+            views = self.select(obj_points, img_points, size)
+
+            start = time.perf_counter()
+            rms, mtx, dist, _, _ = cv2.calibrateCamera([obj_points[i] for i in views], [img_points[i] for i in views],
+                                                       (width, height), None, None)
+            duration = time.perf_counter() - start
+
+            errors = []
+            for object_points, image_points in zip(obj_points, img_points):
+                _, rvec, tvec = cv2.solvePnP(object_points, image_points, mtx, dist)
+                projected, _ = cv2.projectPoints(object_points, rvec, tvec, mtx, dist)
+                errors.append(np.linalg.norm(projected.reshape(-1, 2) - image_points.reshape(-1, 2), axis=1))
+            errors = np.concatenate(errors)
+
+            results.append({
+                'views': len(views),
+                'solve_time_s': duration,
+                'rms_selected_px': rms,
+                'rms_all_px': float(np.sqrt(np.mean(errors ** 2)))
+            })
+
+        print(f'{"views":>8}{"solve [s]":>12}{"rms selected":>15}{"rms all":>10}')
+        for result in results:
+            print(f'{result["views"]:>8}{result["solve_time_s"]:>12.2f}{result["rms_selected_px"]:>15.3f}{result["rms_all_px"]:>10.3f}')
+
+        return results
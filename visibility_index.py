@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import numpy as np
+import cv2
+import json
+import argparse
+
+from projection import HomographyProjection
+
+
+class VisibilityIndex:
+    def __init__(self, projection=None, x_range=(-5, 23), y_range=(-5, 14), resolution=0.05):
+        # raster of the court plane (meters) with a bit per camera that sees the cell's center
+        self.projection = HomographyProjection() if projection is None else projection
+        self.cameras = self.projection.cameras
+
+        self.x_range = x_range
+        self.y_range = y_range
+        self.resolution = resolution
+        self.shape = (int(np.ceil((y_range[1] - y_range[0]) / resolution)),
+                      int(np.ceil((x_range[1] - x_range[0]) / resolution)))
+
+        # bit of every camera in the cell masks
+        self.bits = np.uint64(1) << np.arange(len(self.cameras), dtype=np.uint64)
+        self.masks = self.build()
+
+
+    def build(self):
+        # project all cell centers into all cameras at once
+        rows, columns = self.shape
+        xs = self.x_range[0] + (np.arange(columns) + 0.5) * self.resolution
+        ys = self.y_range[0] + (np.arange(rows) + 0.5) * self.resolution
+        centers = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+
+        _, visible = self.projection.world_to_image(centers)
+        masks = (visible.astype(np.uint64) * self.bits[:, None]).sum(axis=0, dtype=np.uint64)
+
+        return masks.reshape(self.shape)
+
+
+    def lookup(self, points):
+        # camera bit masks (N,) of world points (N, 2) in meters, 0 outside the raster
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        columns = np.floor((points[:, 0] - self.x_range[0]) / self.resolution).astype(int)
+        rows = np.floor((points[:, 1] - self.y_range[0]) / self.resolution).astype(int)
+
+        inside = (columns >= 0) & (columns < self.shape[1]) & (rows >= 0) & (rows < self.shape[0])
+        masks = np.zeros(len(points), dtype=np.uint64)
+        masks[inside] = self.masks[rows[inside], columns[inside]]
+
+        return masks
+
+
+    def visible(self, points):
+        # boolean (N, cameras) - which cameras see each world point
+        return (self.lookup(points)[:, None] & self.bits[None, :]) != 0
+
+
+    def cameras_at(self, point):
+        # cameras seeing a single world point
+        return [camera for camera, is_visible in zip(self.cameras, self.visible(point)[0]) if is_visible]
+
+
+    def camera_counts(self):
+        # number of cameras seeing each cell
+        return self.visible_cells().sum(axis=0)
+
+
+    def coverage_statistics(self, court=((0, 18), (0, 9))):
+        # how well the court (x, y limits in meters) is covered by the cameras
+        counts = self.camera_counts()
+        cell_area = self.resolution ** 2
+
+        rows, columns = self.shape
+        xs = self.x_range[0] + (np.arange(columns) + 0.5) * self.resolution
+        ys = self.y_range[0] + (np.arange(rows) + 0.5) * self.resolution
+        on_court = ((xs[None, :] >= court[0][0]) & (xs[None, :] <= court[0][1])
+                    & (ys[:, None] >= court[1][0]) & (ys[:, None] <= court[1][1]))
+        court_counts = counts[on_court]
+
+        visible = self.visible_cells()
+        return {
+            'resolution_m': self.resolution,
+            'camera_area_m2': {camera: float(visible[i].sum() * cell_area) for i, camera in enumerate(self.cameras)},
+            'camera_court_fraction': {camera: float(visible[i][on_court].mean()) for i, camera in enumerate(self.cameras)},
+            'court_cells_by_camera_count': {int(n): int((court_counts == n).sum()) for n in range(len(self.cameras) + 1)},
+            'court_mean_cameras': float(court_counts.mean()),
+            'court_min_cameras': int(court_counts.min()),
+            'court_fraction_seen_by_at_least_2': float((court_counts >= 2).mean())
+        }
+
+
+    def visible_cells(self):
+        # boolean (cameras, rows, columns)
+        return np.moveaxis((self.masks[..., None] & self.bits) != 0, -1, 0)
+
+
+    def save_coverage_image(self, path):
+        # number of cameras per cell as a color map
+        counts = self.camera_counts()
+        image = cv2.applyColorMap((counts * (255 // max(1, len(self.cameras)))).astype(np.uint8), cv2.COLORMAP_VIRIDIS)
+        cv2.imwrite(path, image)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Camera coverage of the court plane from the homographies.')
+    parser.add_argument('--resolution', type=float, default=0.05, help='cell size in meters')
+    parser.add_argument('--output', default=None, help='JSON file for the coverage statistics')
+    parser.add_argument('--image', default=None, help='image file for the coverage map')
+    args = parser.parse_args()
+
+    vi = VisibilityIndex(resolution=args.resolution)
+    statistics = vi.coverage_statistics()
+    print(json.dumps(statistics, indent=4))
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(statistics, outfile, indent=4)
+    if args.image:
+        vi.save_coverage_image(args.image)